@@ -1,6 +1,30 @@
 import cv2
 import numpy as np
 from djitellopy import Tello
+import argparse
+import os
+import sys
+
+# Make the shared helpers in ArucoTagScripts/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.focal_calibration import collect_samples, fit_calibration, save_calibration, save_samples
+
+# Without flags this prints the pixel size of every marker in view.
+# With --calibrate it measures the focal length of this drone and stores it under its serial number:
+#   forward:  start facing a wall marker --start-distance cm away (tape measure), the drone backs off
+#             --step cm at a time and yaws a little at every stop
+#   downward: take off over a floor marker, the drone climbs --step cm at a time and reads the
+#             height from its time-of-flight sensor
+#     python ArucoTag/getSize.py --calibrate --camera forward --marker-size 20 --start-distance 60
+parser = argparse.ArgumentParser(description="Print marker sizes or calibrate the focal length")
+parser.add_argument("--calibrate", action="store_true")
+parser.add_argument("--camera", default="forward", choices=["forward", "downward"])
+parser.add_argument("--marker-size", type=float, default=20.0, help="printed marker width in cm")
+parser.add_argument("--start-distance", type=int, default=60, help="cm from the camera to the wall marker")
+parser.add_argument("--step", type=int, default=30, help="cm between calibration distances")
+parser.add_argument("--stops", type=int, default=6, help="number of calibration distances")
+parser.add_argument("--samples", default="calibration_samples.csv", help="CSV the raw samples are added to")
+args = parser.parse_args()
 
 # ArUco marker detection setup
 aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
@@ -30,22 +54,50 @@ def detect_aruco_marker(frame):
     
     return None
 
+# Function to measure the focal length at several distances and store it for this drone
+def calibrate():
+    serial = tello.query_serial_number()
+    if args.camera == "downward":
+        tello.set_video_direction(Tello.CAMERA_DOWNWARD)
+    distances = [args.start_distance + i * args.step for i in range(args.stops)]
+
+    # Function to get from one calibration distance to the next
+    def move(distance):
+        if distance == distances[0]:
+            return
+        if args.camera == "downward":
+            tello.move_up(args.step)
+        else:
+            tello.move_back(args.step)
+
+    yaw_offsets = (0,) if args.camera == "downward" else (0, 8, -16)
+    samples = collect_samples(tello, args.camera, args.marker_size, distances, move, yaw_offsets=yaw_offsets)
+    save_samples(args.samples, args.camera, samples)
+
+    calibration = fit_calibration(samples, args.marker_size, args.camera)
+    calibration.serial = serial
+    print(f"{calibration}, rms {calibration.rms_cm:.1f} cm over {calibration.samples} samples")
+    save_calibration(serial, calibration)
+
 try:
     # Take off and move down immediately
     tello.takeoff()
     tello.move_down(20)
     print("Drone has taken off and moved down to 20 units")
 
-    # Main loop to detect markers
-    while True:
-        frame = tello.get_frame_read().frame
-        detect_aruco_marker(frame)
-        
-        # Display the camera feed
-        cv2.imshow("Tello Camera Feed", frame)
-        
-        if cv2.waitKey(1) & 0xFF == ord('q'):  # Press 'q' to exit
-            break
+    if args.calibrate:
+        calibrate()
+    else:
+        # Main loop to detect markers
+        while True:
+            frame = tello.get_frame_read().frame
+            detect_aruco_marker(frame)
+            
+            # Display the camera feed
+            cv2.imshow("Tello Camera Feed", frame)
+            
+            if cv2.waitKey(1) & 0xFF == ord('q'):  # Press 'q' to exit
+                break
 
 finally:
     # Land the drone and cleanup
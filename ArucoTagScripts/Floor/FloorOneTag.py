@@ -2,6 +2,12 @@ import cv2
 import numpy as np
 from djitellopy import Tello
 import time
+import os
+import sys
+
+# Make the shared helpers in ArucoTagScripts/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.altitude_hold import AltitudeHold
 
 # ArUco marker detection setup
 aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)  # Larger dictionary for more robust detection
@@ -14,6 +20,10 @@ parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
 tello = Tello()
 tello.connect()
 
+# Hold the height above the floor so CLOSE_ENOUGH_MARKER_SIZE means the same distance all flight
+altitude_hold = AltitudeHold(tello)
+tello = altitude_hold.wrap()
+
 # Start video stream
 tello.streamon()
 
@@ -123,6 +133,7 @@ def fly_through_markers(last_marker_id):
 print(f"Battery: {tello.get_battery()}%")
 tello.takeoff()
 tello.move_down(20)  # Lower the drone's height to improve detection of floor markers
+altitude_hold.start()
 print("Drone has taken off and moved down closer to the floor")
 
 try:
@@ -133,6 +144,9 @@ try:
     fly_through_markers(last_marker_id)
 
 finally:
+    altitude_hold.stop()
+    print(altitude_hold.report())
+
     # Land the drone
     tello.land()
     print("Drone has landed")
@@ -2,6 +2,15 @@ import cv2
 import numpy as np
 from djitellopy import Tello
 import time
+import os
+import sys
+
+# Make the shared helpers in ArucoTagScripts/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.frame_buffers import FrameBuffers
+
+# Resized, grayscale and thresholded images are written into the same buffers every frame
+frame_buffers = FrameBuffers()
 
 # Initialize the Tello drone
 tello = Tello()
@@ -13,10 +22,10 @@ tello.streamon()
 # Function to detect the 'X' on the floor
 def find_x_marker(frame):
     # Convert the image to grayscale
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    gray = frame_buffers.gray(frame)
     
     # Apply thresholding to isolate the 'X' (adjust thresholds based on your lighting conditions)
-    _, thresh = cv2.threshold(gray, 100, 255, cv2.THRESH_BINARY_INV)
+    _, thresh = frame_buffers.threshold(gray, 100, 255, cv2.THRESH_BINARY_INV)
     
     # Find contours in the thresholded image
     contours, _ = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
@@ -70,7 +79,7 @@ def main():
             frame = tello.get_frame_read().frame
             
             # Resize the frame for better performance
-            frame = cv2.resize(frame, (640, 480))
+            frame = frame_buffers.resize(frame, (640, 480))
             
             # Find the 'X' marker on the floor
             center_x, center_y = find_x_marker(frame)
@@ -91,6 +100,7 @@ def main():
     finally:
         # Land the drone
         tello.land()
+        print(frame_buffers.report())
         cv2.destroyAllWindows()
 
 # Run the main function
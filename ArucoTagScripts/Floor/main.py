@@ -1,123 +1,243 @@
-import cv2
-import numpy as np
 from djitellopy import Tello
 import time
+import os
+import sys
+
+# Make the shared helpers in ArucoTagScripts/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.frame_quality import FrameQualityGate
+from common.aruco_detection import create_detector, detect_markers, find_marker
+from common.frame_buffers import FrameBuffers
+from common.yaw_alignment import YawAligner
+from common.focal_calibration import load_calibration
+from common.display import create_display
+from common.runtime import parse_args
+from common.altitude_hold import AltitudeHold, ground_distance
+from common.watchdog import CommandWatchdog, LinkLost
+from common.stream_control import StreamController
+from common.camera_scheduler import DOWNWARD, FORWARD, CameraScheduler
+from common.wall_alignment import RC_CM_PER_S, RC_VALUE
+from common.state_estimator import MarkerMap, StateEstimator, StateFeed
+from common.latency_compensation import MarkerPredictor
+from common.detection_feed import create_feed
+from common.detection_confirmation import DetectionConfirmer
+from common.station_transfer import StationClient
+from common.trajectory import TrajectoryFollower, Waypoint, load_route, plan_route, route_summary, save_route
+
+# Runtime flags (--headless, --viewer) and the matching camera display
+args = parse_args()
+display = create_display(args)
 
 # ArUco marker detection setup
-aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
-parameters = cv2.aruco.DetectorParameters()
+detector = create_detector("DICT_6X6_250", profile=args.detector_profile)
+
+# Reused grayscale buffers, the hot loop does not allocate a new image per frame
+frame_buffers = FrameBuffers()
 
 # Initialize Tello drone
 tello = Tello()
 tello.connect()
 
+# Focal length of this drone's cameras, stored under its serial number by ArucoTag/getSize.py --calibrate
+calibrations = load_calibration(tello)
+forward_calibration = calibrations["forward"]
+
+# Times every command and watches the state stream, hovers or lands on its own if the link goes bad
+watchdog = CommandWatchdog(tello)
+watchdog.start()
+tello = watchdog.wrap()
+
+# Hold the height above the floor between commands, the mission talks to the drone through the hold
+altitude_hold = AltitudeHold(tello)
+tello = altitude_hold.wrap()
+
+# Yaw correction onto the marker from its pixel offset, one rotation instead of 10 degree steps
+yaw_aligner = YawAligner(tello, focal_px=forward_calibration.focal_px)
+
 # Start video stream
 tello.streamon()
 
+# Bitrate, resolution and fps follow latency, frame loss and detector load
+stream_controller = StreamController(tello)
+stream_controller.start()
+CLOSE_RANGE_DISTANCE = 80  # cm, below this the stream may drop to 480p
+
+# Forward camera for the approach, downward camera for centering over the floor tag
+camera_scheduler = CameraScheduler(tello, (FORWARD._replace(focal_px=forward_calibration.focal_px),
+                                            DOWNWARD._replace(focal_px=calibrations["downward"].focal_px)))
+CENTER_TOLERANCE_CM = 5
+CENTER_ATTEMPTS = 10  # Frames, a correction waits for two that agree
+CENTER_TIMEOUT = 10  # s, also ends centering when no frame arrives at all
+MAX_RC_BURST = 1.0  # s, longest centering burst, a bad offset cannot send the drone far
+
+# Blur / decoding-artifact check that runs before the detector
+quality_gate = FrameQualityGate()
+MIN_MOVE_WEIGHT = 0.5  # Frames below this weight are not trusted for distance moves
+
+# Pose estimate from the state stream, updated at state-packet rate in the background.
+# The raw packets are recorded so the flight can be replayed with replay_state_log.
+state_estimator = StateEstimator()
+state_feed = StateFeed(tello, state_estimator, recorder_path="state_log.csv")
+state_feed.start()
+
+# Marker sightings correct the pose, without them it is IMU dead reckoning that drifts with every move
+marker_map = MarkerMap(state_estimator)
+
+# Marker detections moved from capture time to command time with the IMU yaw of the estimator
+marker_predictor = MarkerPredictor(state_estimator, focal_px=forward_calibration.focal_px)
+
+# Detections and telemetry of every frame for local subscribers (--feed), never waits for them
+detection_feed = create_feed(args)
+
+# Turns and moves only follow a marker that several frames agree on, not a single misread frame
+confirmer = DetectionConfirmer()
+
+# WSN stations to collect data from once their marker is reached: marker ID -> (station IP, port).
+# Run `python -m common.station_emulator` to test against a local stand-in.
+STATION_ADDRESSES = {}
+STATION_HOVER_BUDGET = 20  # Seconds of hover per station, an unfinished transfer resumes next flight
+station_client = StationClient()
+
+# Function to collect the data of the station at a marker
+def collect_station_data(marker_id):
+    address = STATION_ADDRESSES.get(marker_id)
+    if address is None:
+        return
+    try:
+        result = station_client.collect(address, "station", f"station_{marker_id}.csv", max_time=STATION_HOVER_BUDGET)
+    except OSError as error:
+        # A dead station must not end the flight, the next visit resumes its partial file
+        print(f"Station {marker_id}: transfer failed ({error}), continuing the route")
+        return
+    print(f"Station {marker_id}: complete={result.complete}, {result.received_bytes} bytes "
+          f"in {result.seconds:.1f} s ({result.throughput / 1000:.0f} kB/s)")
+
+# Station positions of the last leg-by-leg flight, flown as one trajectory with --trajectory
+ROUTE_PATH = "route.json"
+trajectory_follower = TrajectoryFollower(tello, state_estimator)
+
 # Distance calculation formula: d = (real_width * focallength) / pixel_width
 def calculate_distance(W_real, f, w_pixel):
     return ((W_real * f) / w_pixel) * 10 
 
+# Function to publish the detections of a frame with the current telemetry
+def publish_detections(detections, distances=None):
+    detection_feed.publish(detections, altitude_hold.height(), state_estimator.pose().yaw, tello.get_battery(),
+                           distances)
+
+# Function to calculate the distance along the floor to a marker, None for a reading closer than the floor
+def marker_distance(marker, frame, W_real, f):
+    # Distance using width (in pixels of the calibrated 960 px frame, corrected for the lens), then
+    # the part of it along the floor at the live height
+    marker_width = forward_calibration.corrected_width(marker.width, marker.center_x, marker.center_y,
+                                                       frame.shape[1], frame.shape[0])
+    distance = calculate_distance(W_real, f, marker_width) - forward_calibration.offset_cm
+    return ground_distance(distance, altitude_hold.height())
+
+# Function to correct the pose estimate with a forward camera sighting of a floor marker
+def fuse_marker(marker_id, center_x, frame, distance, t_frame):
+    forward, right = camera_scheduler.forward_offset(center_x, frame, distance)
+    marker_map.observe(marker_id, t_frame - marker_predictor.latency.latency, forward, right, altitude_hold.height())
+
 # Function to detect ArUco marker and calculate its width, height, and distance
+# Returns the marker data (or None) and all detections for the display
 def detect_aruco_marker(frame, marker_id, W_real, f):
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    gray = frame_buffers.gray(frame)
     
     # Detect markers
-    detector = cv2.aruco.ArucoDetector(aruco_dict, parameters)
-    corners, ids, _ = detector.detectMarkers(gray)
+    detections = detect_markers(detector, gray)
+    marker = find_marker(detections, marker_id)
     
-    if ids is not None:
-        for i, found_id in enumerate(ids):
-            if found_id == marker_id:
-                marker_corners = corners[i][0]
-                
-                # Calculate marker width and height
-                marker_width = np.linalg.norm(marker_corners[0] - marker_corners[1])
-                marker_height = np.linalg.norm(marker_corners[1] - marker_corners[2])
-                
-                # Calculate distance using width 
-                distance = calculate_distance(W_real, f, marker_width)
-                
-                # Draw the detected marker on the frame for visualization
-                cv2.aruco.drawDetectedMarkers(frame, corners)
-                
-                # Return the position, marker dimensions, and calculated distance
-                center_x = int((marker_corners[0][0] + marker_corners[2][0]) / 2)
-                center_y = int((marker_corners[0][1] + marker_corners[2][1]) / 2)
-                
-                return center_x, center_y, marker_width, marker_height, distance
+    if marker is None:
+        publish_detections(detections)
+        return None, detections
     
-    return None
-
-# Function to display battery percentage on the frame
-def display_battery_on_frame(frame, battery_level):
-    text = f"Battery: {battery_level}%"
-    cv2.putText(frame, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+    distance = marker_distance(marker, frame, W_real, f)
+    if distance is None:
+        # Closer than the floor is, a bad reading: no sighting in this frame
+        publish_detections(detections)
+        return None, detections
+    publish_detections(detections, {marker_id: distance})
+    
+    # Return the position, marker dimensions, and calculated distance
+    return (marker.center_x, marker.center_y, marker.width, marker.height, distance), detections
 
 # Function to search for and fly to markers
 def search_and_fly_to_marker(marker_id, W_real, f):
     found_once = False  # To track if the marker was found
-    counter = 0
+    confirmer.reset("search")
     while True:
-        frame = tello.get_frame_read().frame
+        # Only new frames of the forward camera, never one from before a camera switch
+        frame = camera_scheduler.frame()
+        if frame is None:
+            time.sleep(0.005)
+            continue
+        t_frame = time.monotonic()  # Arrival time, the predictor subtracts the video latency
         battery_level = tello.get_battery()  # Get the current battery level
+
+        # Skip motion-blurred or torn frames before running the detector
+        quality = quality_gate.check(frame)
+        if not quality.usable:
+            print(f"Skipping frame (sharpness {quality.sharpness:.1f}, tear {quality.tear:.1f}, "
+                  f"blockiness {quality.blockiness:.2f})")
+            # Only decoding artifacts count as stream loss, blur is no reason to lower the bitrate
+            stream_controller.record(frame, corrupt=quality.artifacts)
+            display.show(frame, text=f"Battery: {battery_level}%")
+            if display.stop_requested():
+                break
+            if quality_gate.stuck():
+                # Every frame rejected for a while, e.g. over a low-texture floor: search on instead of hovering
+                print(f"{quality_gate.rejected_in_row} frames in a row rejected, rotating...")
+                tello.rotate_clockwise(10)
+            continue
         
         # Detect the ArUco marker and calculate its distance
-        marker_data = detect_aruco_marker(frame, marker_id, W_real, f)
+        detect_start = time.perf_counter()
+        marker_data, detections = detect_aruco_marker(frame, marker_id, W_real, f)
+        stream_controller.record(frame, time.perf_counter() - detect_start)
         
-        # Display battery percentage on the frame
-        display_battery_on_frame(frame, battery_level)
-        
-        # Display the video stream with OpenCV
-        if frame is not None:
-            cv2.imshow("Tello Camera Feed", frame)
+        # Hand the frame, detections and battery percentage to the display
+        display.show(frame, detections, f"Battery: {battery_level}%")
+        if display.stop_requested():
+            break  # Press 'q' to stop the video stream manually
         
         if marker_data:
             center_x, center_y, marker_width, marker_height, distance = marker_data
+            stream_controller.close_range(distance < CLOSE_RANGE_DISTANCE)
             print(f"Marker {marker_id} found at position: ({center_x}, {center_y}), "
                   f"width: {marker_width}, height: {marker_height}, distance: {distance:.2f} cm")
             
-            frame_center_x = frame.shape[1] // 2  # Center of the frame
-
+            marker_predictor.observe(marker_id, center_x, frame.shape[1], t_frame)  # Refines the latency
             
-
-            # Adjust orientation to align horizontally
+            # Wait for more frames that agree before acting, then use their median size and distance
+            confirmation = confirmer.observe(center_x, center_y, marker_width, marker_height, frame.shape[1],
+                                             distance, t_frame)
+            if confirmation is None:
+                continue
+            marker_width, distance = confirmation.width, confirmation.distance
+            fuse_marker(marker_id, center_x, frame, distance, t_frame)
+            
+            # Turn onto the marker in one rotation sized from its pixel offset, checked again on the
+            # next frame before moving. The offset is where the marker is now, not at capture time.
             if not found_once:
-                
-                if abs(center_x - frame_center_x) > 30: 
-                    print(f"                 counter: {counter}")
-                    # Allow for a small tolerance
-                    if center_x < frame_center_x:
-                        
-                        if counter >= 4:
-                            print("plan B")
-                            tello.rotate_counter_clockwise(40)
-                            tello.rotate_clockwise(35)
-                            found_once = True
-                            counter = 0
-
-                        tello.rotate_counter_clockwise(10)
-                        counter = counter + 1
-                        print("Rotating left to center marker")
-                        
-                    else:
-                        
-                        if counter >= 4:
-                            print("plan B")
-                            tello.rotate_clockwise(40)
-                            tello.rotate_counter_clockwise(35)
-                            found_once = True
-                            counter = 0
-                        
-                        tello.rotate_clockwise(10)
-                        counter = counter + 1
-                        print("Rotating right to center marker")
-                else:
-                    print("Marker centered horizontally.")
-                    found_once = True  # Set the flag so this adjustment is done only once
+                prediction = marker_predictor.predict(marker_id, center_x, center_y, marker_width, frame.shape,
+                                                      t_frame, W_real)
+                found_once = yaw_aligner.step(marker_id, prediction.center_x, frame.shape[1])
+                # The frames before the turn show the marker where it was, the move distance is
+                # confirmed on frames of its own
+                confirmer.reset("approach" if found_once else "search")
+                continue
             
             # Move towards the marker if the orientation is adjusted
             if found_once:
+                # Do not move on a distance read from a soft frame, wait for a sharper one
+                if quality.weight < MIN_MOVE_WEIGHT:
+                    print(f"Frame weight {quality.weight:.2f} too low for a distance move, waiting")
+                    continue
+                # Distance at command time: the width scales with any forward drift since capture
+                prediction = marker_predictor.predict(marker_id, center_x, center_y, marker_width, frame.shape,
+                                                      t_frame, W_real)
+                distance *= marker_width / prediction.width
                 if distance > 20:  # Only move if the distance is significant (greater than 20 cm)
                     tello.move_forward(int(distance))
                     print(f"Moving forward by {int(distance)} cm towards marker {marker_id}")
@@ -127,41 +247,178 @@ def search_and_fly_to_marker(marker_id, W_real, f):
                 
                 break  
         else:
+            # Do not turn away from a sighting that is still being confirmed
+            if confirmer.miss(t_frame):
+                continue
             print(f"Marker {marker_id} not found, rotating...")
             tello.rotate_clockwise(10)
-        
-        # Ensure that the frame stays on screen
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break  # Press 'q' to stop the video stream manually
+
+# Function to center over a floor marker with the downward camera, then switch back
+def center_over_marker(marker_id, W_real):
+    if not camera_scheduler.use("downward"):
+        print("Downward camera did not come up, skipping centering")
+        camera_scheduler.use("forward")
+        return
+    attempts = 0
+    deadline = time.monotonic() + CENTER_TIMEOUT
+    # Straight above the marker the ToF height is the distance its size must imply
+    confirmer.reset("center", expected_distance=altitude_hold.height())
+    while attempts < CENTER_ATTEMPTS and time.monotonic() < deadline:
+        frame = camera_scheduler.frame()
+        if frame is None:
+            time.sleep(0.01)
+            continue
+        attempts += 1
+        detections = camera_scheduler.detect(frame)
+        display.show(frame, detections, "Downward camera")
+        marker = find_marker(detections, marker_id)
+        if marker is None:
+            confirmer.miss()
+            print(f"Marker {marker_id} not below the drone")
+            continue
+        distance = W_real * camera_scheduler.focal_px(frame) / marker.width
+        if confirmer.observe(marker.center_x, marker.center_y, marker.width, marker.height, frame.shape[1],
+                             distance) is None:
+            continue
+        height = altitude_hold.height()
+        if height is None:
+            # Without a height the pixel offset has no scale, wait for the next reading
+            print(f"Height unknown, not correcting over marker {marker_id}")
+            continue
+        forward, right = camera_scheduler.ground_offset(marker, frame, height)
+        # Straight below, the most exact fix of the pose there is
+        marker_map.observe(marker_id, time.monotonic() - marker_predictor.latency.latency, forward, right, height,
+                           noise=4.0)
+        if abs(forward) < CENTER_TOLERANCE_CM and abs(right) < CENTER_TOLERANCE_CM:
+            print(f"Centered over marker {marker_id}")
+            break
+        # Short rc burst towards the tag, the offsets here are below the 20 cm move minimum
+        left_right = RC_VALUE if right > CENTER_TOLERANCE_CM else -RC_VALUE if right < -CENTER_TOLERANCE_CM else 0
+        for_back = RC_VALUE if forward > CENTER_TOLERANCE_CM else -RC_VALUE if forward < -CENTER_TOLERANCE_CM else 0
+        tello.send_rc_control(left_right, for_back, 0, 0)
+        time.sleep(min(max(abs(forward), abs(right)) / RC_CM_PER_S, MAX_RC_BURST))
+        tello.send_rc_control(0, 0, 0, 0)
+        confirmer.reset(expected_distance=altitude_hold.height())  # Moved, the next offset needs its own frames
+    if not camera_scheduler.use("forward"):
+        # The scheduler keeps holding back frames until the forward camera is really there
+        print("Forward camera not confirmed yet, the search waits for its frames")
 
 # Main function to fly through all markers till the last one
 def fly_through_markers(last_marker_id, W_real, f):
+    start = time.monotonic()
+    waypoints = []
     for marker_id in range(last_marker_id + 1):  # Loop through marker IDs starting from 0
+        if watchdog.should_return():
+            print(f"Link degraded, landing before marker {marker_id}")
+            break
+        search_and_fly_to_marker(marker_id, W_real, f)
+        center_over_marker(marker_id, W_real)
+        collect_station_data(marker_id)
+        pose = state_estimator.pose()
+        print(f"Estimated pose at marker {marker_id}: x {pose.x:.0f} cm, y {pose.y:.0f} cm, "
+              f"height {pose.height:.0f} cm, yaw {pose.yaw:.0f} deg")
+        waypoints.append(Waypoint(marker_id, pose.x, pose.y, pose.z))
+
+    # Keep the station positions for the next flight with --trajectory
+    leg_seconds = time.monotonic() - start
+    if not waypoints:
+        print(f"No station reached, {ROUTE_PATH} not written")
+        return
+    save_route(ROUTE_PATH, waypoints, leg_seconds)
+    print(f"Leg by leg route: {leg_seconds:.1f} s, stations saved to {ROUTE_PATH}")
+
+# Function to return the marker IDs in the newest frame, for checking stations while flying past.
+# Stations seen on the way correct the pose the trajectory is flown on.
+def observe_markers(W_real, f):
+    frame = camera_scheduler.frame()
+    if frame is None:
+        return []
+    t_frame = time.monotonic()
+    detections = detect_markers(detector, frame_buffers.gray(frame))
+    display.show(frame, detections)
+    for detection in detections:
+        if detection.marker_id in marker_map.positions:
+            distance = marker_distance(detection, frame, W_real, f)
+            if distance is not None:
+                fuse_marker(detection.marker_id, detection.center_x, frame, distance, t_frame)
+    return [detection.marker_id for detection in detections]
+
+# Main function to fly past all stations of the recorded route without stopping
+def fly_route(last_marker_id, W_real, f):
+    waypoints, leg_seconds = load_route(ROUTE_PATH)
+    if not waypoints:
+        # A route without stations has nothing to fly through, go the slow way instead
+        print(f"No stations in {ROUTE_PATH}, flying leg by leg")
+        fly_through_markers(last_marker_id, W_real, f)
+        return
+    # The drone was centered over each station marker when its waypoint was recorded
+    for waypoint in waypoints:
+        marker_map.set(waypoint.marker_id, waypoint.x, waypoint.y)
+    pose = state_estimator.pose()
+    # Stations with data to collect are passed at zero speed and hovered at
+    path = plan_route((pose.x, pose.y, pose.z), waypoints, stop_ids=STATION_ADDRESSES.keys())
+    report = trajectory_follower.fly(path, waypoints, observe=lambda: observe_markers(W_real, f),
+                                     at_stop=collect_station_data, stop_requested=display.stop_requested)
+    print(route_summary(report, leg_seconds))
+
+    # Stations the camera did not confirm are visited the slow way
+    for marker_id in report.missed:
+        print(f"Marker {marker_id} not seen on the pass, searching for it")
         search_and_fly_to_marker(marker_id, W_real, f)
 
 # Takeoff and immediately move closer to the floor
 print(f"Battery: {tello.get_battery()}%")
 tello.takeoff()
-tello.move_down(20)
-print("Drone has taken off and moved down closer to the floor")
 
 try:
+    # Inside the try, the drone lands even if the lowering or the hold fails
+    tello.move_down(20)
+    altitude_hold.start()  # Keep this height for the rest of the mission
+    print("Drone has taken off and moved down closer to the floor")
+    
     # Set the real width of the ArUco tag and the focal length
     W_real = 20  # Real width of the ArUco tag in cm
-    f = 77.4     # Estimated focal length in pixels (based on calibration)
+    f = forward_calibration.focal_px / 10  # Focal length in pixels / 10, from the calibration profile
     
     # Set the last marker ID (e.g., if the last marker is ID 4)
     last_marker_id = 2
 
-    # Fly through all markers up to the last marker ID
-    fly_through_markers(last_marker_id, W_real, f)
+    if args.trajectory and os.path.exists(ROUTE_PATH):
+        # Smooth pass through the stations recorded by an earlier flight
+        fly_route(last_marker_id, W_real, f)
+    else:
+        # Fly through all markers up to the last marker ID
+        fly_through_markers(last_marker_id, W_real, f)
 
 finally:
-    # Land the drone
-    tello.rotate_clockwise(360)
+    altitude_hold.stop()
+    print(altitude_hold.report())
+
+    # Land the drone, without the turn if the link is bad. The watchdog keeps guarding until
+    # the last flight command, land itself always goes through.
+    try:
+        if not watchdog.should_return():
+            tello.rotate_clockwise(360)
+    except LinkLost as error:
+        print(f"Skipping the final turn: {error}")
     tello.land()
     print("Drone has landed")
+    watchdog.stop()
+    print(watchdog.report())
+    print(quality_gate.summary())
+    state_feed.stop()
+    stream_controller.stop()
+    print(stream_controller.report())
+    print(camera_scheduler.report())
 
     # Turn off video stream and close the window
     tello.streamoff()
-    cv2.destroyAllWindows()
\ No newline at end of file
+    print(frame_buffers.report())
+    print(yaw_aligner.report())
+    print(marker_predictor.report())
+    print(marker_map.report())
+    print(detection_feed.report())
+    print(confirmer.report())
+    detection_feed.close()
+    print(display.summary())
+    display.close()
\ No newline at end of file
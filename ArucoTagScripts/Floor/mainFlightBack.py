@@ -1,144 +1,244 @@
-import cv2
-import numpy as np
 from djitellopy import Tello
 import time
+import os
+import sys
+
+# Make the shared helpers in ArucoTagScripts/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.frame_quality import FrameQualityGate
+from common.aruco_detection import create_detector, detect_markers, find_marker
+from common.frame_buffers import FrameBuffers
+from common.yaw_alignment import YawAligner
+from common.focal_calibration import load_calibration
+from common.display import create_display
+from common.runtime import parse_args
+from common.altitude_hold import AltitudeHold, ground_distance
+from common.watchdog import CommandWatchdog, LinkLost
+from common.energy import BatteryLogger, EnergyModel, MissionScheduler
+from common.state_estimator import StateEstimator, StateFeed
+from common.latency_compensation import MarkerPredictor
+from common.detection_feed import create_feed
+from common.detection_confirmation import DetectionConfirmer
+
+# Runtime flags (--headless, --viewer) and the matching camera display
+args = parse_args()
+display = create_display(args)
 
 # ArUco marker detection setup
-aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
-parameters = cv2.aruco.DetectorParameters()
+detector = create_detector("DICT_6X6_250", profile=args.detector_profile)
+
+# Reused grayscale buffers, the hot loop does not allocate a new image per frame
+frame_buffers = FrameBuffers()
 
 # Initialize Tello drone
 tello = Tello()
 tello.connect()
 
+# Focal length of this drone's cameras, stored under its serial number by ArucoTag/getSize.py --calibrate
+calibrations = load_calibration(tello)
+forward_calibration = calibrations["forward"]
+
+# Times every command and watches the state stream, hovers or lands on its own if the link goes bad
+watchdog = CommandWatchdog(tello)
+watchdog.start()
+tello = watchdog.wrap()
+
+# Hold the height above the floor between commands, the mission talks to the drone through the hold
+altitude_hold = AltitudeHold(tello)
+tello = altitude_hold.wrap()
+
+# Logs the battery drop of every move and rotation to battery_log.csv, the energy model is fitted on it
+battery_logger = BatteryLogger(tello)
+tello = battery_logger.wrap()
+
+# Yaw correction onto the marker from its pixel offset, one rotation instead of 10 degree steps
+yaw_aligner = YawAligner(tello, focal_px=forward_calibration.focal_px)
+
 # Start video stream
 tello.streamon()
 
+# Blur / decoding-artifact check that runs before the detector
+quality_gate = FrameQualityGate()
+MIN_MOVE_WEIGHT = 0.5  # Frames below this weight are not trusted for distance moves
+
+# IMU yaw from the state stream, detections are moved from capture time to command time with it
+state_estimator = StateEstimator()
+state_feed = StateFeed(tello, state_estimator)
+state_feed.start()
+marker_predictor = MarkerPredictor(state_estimator, focal_px=forward_calibration.focal_px)
+
+# Detections and telemetry of every frame for local subscribers (--feed), never waits for them
+detection_feed = create_feed(args)
+
+# Turns and moves only follow a marker that several frames agree on, not a single misread frame
+confirmer = DetectionConfirmer()
+
 # Initialize flight log
 flight_log = []  # To log movements for reverse flight
 
+# Energy model fitted from earlier flights, and the scheduler that decides when to return
+energy_model = EnergyModel.fit_from_log(battery_logger.path)
+scheduler = MissionScheduler(energy_model, reserve=15)
+DEFAULT_LEG_DISTANCE = 100  # cm, assumed length of the next leg before any leg was flown
+MIN_TAKEOFF_BATTERY = 20
+
 # Distance calculation formula: d = (real_width * focal_length) / pixel_width
 def calculate_distance(W_real, f, w_pixel):
     return ((W_real * f) / w_pixel) * 10 
 
+# Function to publish the detections of a frame with the current telemetry
+def publish_detections(detections, distances=None):
+    detection_feed.publish(detections, altitude_hold.height(), state_estimator.pose().yaw, tello.get_battery(),
+                           distances)
+
 # Function to detect ArUco marker and calculate its width, height, and distance
+# Returns the marker data (or None) and all detections for the display
 def detect_aruco_marker(frame, marker_id, W_real, f):
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    gray = frame_buffers.gray(frame)
     
     # Detect markers
-    detector = cv2.aruco.ArucoDetector(aruco_dict, parameters)
-    corners, ids, _ = detector.detectMarkers(gray)
+    detections = detect_markers(detector, gray)
+    marker = find_marker(detections, marker_id)
     
-    if ids is not None:
-        for i, found_id in enumerate(ids):
-            if found_id == marker_id:
-                marker_corners = corners[i][0]
-                
-                # Calculate marker width and height
-                marker_width = np.linalg.norm(marker_corners[0] - marker_corners[1])
-                marker_height = np.linalg.norm(marker_corners[1] - marker_corners[2])
-                
-                # Calculate distance using width 
-                distance = calculate_distance(W_real, f, marker_width)
-                
-                # Draw the detected marker on the frame for visualization
-                cv2.aruco.drawDetectedMarkers(frame, corners)
-                
-                # Return the position, marker dimensions, and calculated distance
-                center_x = int((marker_corners[0][0] + marker_corners[2][0]) / 2)
-                center_y = int((marker_corners[0][1] + marker_corners[2][1]) / 2)
-                
-                return center_x, center_y, marker_width, marker_height, distance
+    if marker is None:
+        publish_detections(detections)
+        return None, detections
     
-    return None
-
-# Function to display battery percentage on the frame
-def display_battery_on_frame(frame, battery_level):
-    text = f"Battery: {battery_level}%"
-    cv2.putText(frame, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+    # Calculate distance using width (corrected for the lens), then the part of it along the floor
+    # at the live height
+    marker_width = forward_calibration.corrected_width(marker.width, marker.center_x, marker.center_y,
+                                                       frame.shape[1], frame.shape[0])
+    distance = calculate_distance(W_real, f, marker_width) - forward_calibration.offset_cm
+    distance = ground_distance(distance, altitude_hold.height())
+    if distance is None:
+        # Closer than the floor is, a bad reading: no sighting in this frame
+        publish_detections(detections)
+        return None, detections
+    publish_detections(detections, {marker_id: distance})
+    
+    # Return the position, marker dimensions, and calculated distance
+    return (marker.center_x, marker.center_y, marker.width, marker.height, distance), detections
 
 # Function to search for and fly to markers
 def search_and_fly_to_marker(marker_id, W_real, f, direction):
     found_once = False  # To track if the marker was found
-    counter = 0
+    confirmer.reset("search")
+    last_frame = None
     while True:
         frame = tello.get_frame_read().frame
+        # The same frame again until the next one is decoded, it must not vote twice
+        if frame is None or frame is last_frame:
+            time.sleep(0.005)
+            continue
+        last_frame = frame
+        t_frame = time.monotonic()  # Arrival time, the predictor subtracts the video latency
         battery_level = tello.get_battery()  # Get the current battery level
+
+        # Skip motion-blurred or torn frames before running the detector
+        quality = quality_gate.check(frame)
+        if not quality.usable:
+            print(f"Skipping frame (sharpness {quality.sharpness:.1f}, tear {quality.tear:.1f}, "
+                  f"blockiness {quality.blockiness:.2f})")
+            display.show(frame, text=f"Battery: {battery_level}%")
+            if display.stop_requested():
+                break
+            if quality_gate.stuck():
+                # Every frame rejected for a while, e.g. over a low-texture floor: search on instead of hovering
+                print(f"{quality_gate.rejected_in_row} frames in a row rejected, rotating...")
+                search_rotation(direction)
+            continue
         
         # Detect the ArUco marker and calculate its distance
-        marker_data = detect_aruco_marker(frame, marker_id, W_real, f)
+        marker_data, detections = detect_aruco_marker(frame, marker_id, W_real, f)
         
-        # Display battery percentage on the frame
-        display_battery_on_frame(frame, battery_level)
-        
-        # Display the video stream with OpenCV
-        if frame is not None:
-            cv2.imshow("Tello Camera Feed", frame)
+        # Hand the frame, detections and battery percentage to the display
+        display.show(frame, detections, f"Battery: {battery_level}%")
+        if display.stop_requested():
+            break  # Press 'q' to stop the video stream manually
         
         if marker_data:
             center_x, center_y, marker_width, marker_height, distance = marker_data
             print(f"Marker {marker_id} found at position: ({center_x}, {center_y}), "
                   f"width: {marker_width}, height: {marker_height}, distance: {distance:.2f} cm")
             
-            frame_center_x = frame.shape[1] // 2  # Center of the frame
-
-            # Adjust orientation to align horizontally
+            marker_predictor.observe(marker_id, center_x, frame.shape[1], t_frame)  # Refines the latency
+            
+            # Wait for more frames that agree before acting, then use their median size and distance
+            confirmation = confirmer.observe(center_x, center_y, marker_width, marker_height, frame.shape[1],
+                                             distance, t_frame)
+            if confirmation is None:
+                continue
+            marker_width, distance = confirmation.width, confirmation.distance
+            
+            # Turn onto the marker in one rotation sized from its pixel offset, checked again on the
+            # next frame before moving. The offset is where the marker is now, not at capture time.
             if not found_once:
-                
-                if abs(center_x - frame_center_x) > 30: 
-                    print(f"                 counter: {counter}")
-                    # Allow for a small tolerance
-                    if center_x < frame_center_x:
-                        
-                        if counter >= 4:
-                            print("plan B")
-                            tello.rotate_counter_clockwise(40)
-                            tello.rotate_clockwise(35)
-                            found_once = True
-                            counter = 0
-
-                        tello.rotate_counter_clockwise(10)
-                        flight_log.append(('rotate_ccw', 10))  # Log the rotation
-                        counter = counter + 1
-                        print("Rotating left to center marker")
-                        
-                    else:
-                        
-                        if counter >= 4:
-                            print("plan B")
-                            tello.rotate_clockwise(40)
-                            tello.rotate_counter_clockwise(35)
-                            found_once = True
-                            counter = 0
-                        
-                        tello.rotate_clockwise(10)
-                        flight_log.append(('rotate_cw', 10))  # Log the rotation
-                        counter = counter + 1
-                        print("Rotating right to center marker")
-                else:
-                    print("Marker centered horizontally.")
-                    found_once = True  # Set the flag so this adjustment is done only once
+                prediction = marker_predictor.predict(marker_id, center_x, center_y, marker_width, frame.shape,
+                                                      t_frame, W_real)
+                found_once = yaw_aligner.step(marker_id, prediction.center_x, frame.shape[1])
+                if yaw_aligner.last_turn:
+                    flight_log.append(('rotate_cw' if yaw_aligner.last_turn > 0 else 'rotate_ccw',
+                                       abs(yaw_aligner.last_turn)))  # Log the rotation
+                # The frames before the turn show the marker where it was, the move distance is
+                # confirmed on frames of its own
+                confirmer.reset("approach" if found_once else "search")
+                continue
             
             # Move towards the marker if the orientation is adjusted
             if found_once:
+                # Do not move on a distance read from a soft frame, wait for a sharper one
+                if quality.weight < MIN_MOVE_WEIGHT:
+                    print(f"Frame weight {quality.weight:.2f} too low for a distance move, waiting")
+                    continue
+                # Distance at command time: the width scales with any forward drift since capture
+                prediction = marker_predictor.predict(marker_id, center_x, center_y, marker_width, frame.shape,
+                                                      t_frame, W_real)
+                distance *= marker_width / prediction.width
                 if distance > 20:  # Only move if the distance is significant (greater than 20 cm)
-                    tello.move_forward(int(distance))
+                    fly_leg(int(distance))
                     flight_log.append(('move_forward', int(distance)))  # Log the forward movement
                     print(f"Moving forward by {int(distance)} cm towards marker {marker_id}")
                 else:
                     print(f"Close enough to marker {marker_id}, stopping movement.")
                 break  # Break the loop after reaching the marker
         else:
+            # Do not turn away from a sighting that is still being confirmed
+            if confirmer.miss(t_frame):
+                continue
             print(f"Marker {marker_id} not found, rotating...")
-            if (direction == 0):
-                tello.rotate_clockwise(10)
-            else: 
-                tello.rotate_counter_clockwise(10)
-            flight_log.append(('rotate_cw', 10))  # Log the rotation
-        
-        # Ensure that the frame stays on screen
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break  # Press 'q' to stop the video stream manually
+            search_rotation(direction)
+
+# Function to turn one search step, clockwise on the way out and counterclockwise on the way back
+def search_rotation(direction):
+    if (direction == 0):
+        tello.rotate_clockwise(10)
+        flight_log.append(('rotate_cw', 10))  # Log the rotation
+    else: 
+        tello.rotate_counter_clockwise(10)
+        flight_log.append(('rotate_ccw', 10))
+
+# Function to fly a forward leg at the cruise speed with the lowest predicted battery drop
+def fly_leg(distance):
+    speed = energy_model.best_speed(distance)
+    if speed != battery_logger.speed:
+        battery_logger.run('set_speed', speed)
+    battery_logger.run('move_forward', distance)
+
+
+# Function to predict the battery needed to fly home after the next station
+def return_cost_after_next(next_leg_distance):
+    # Flying back replays the logged route plus the next leg, after a 180° turn
+    return (energy_model.log_cost(flight_log) + energy_model.rotate_cost(180)
+            + energy_model.move_cost(next_leg_distance, energy_model.best_speed(next_leg_distance)))
+
+
+# Function to get the length of the last forward leg, as estimate for the next one
+def last_leg_distance():
+    for command, value in reversed(flight_log):
+        if command == 'move_forward':
+            return value
+    return DEFAULT_LEG_DISTANCE
+
 
 # Function to combine consecutive turns
 def combine_consecutive_turns(flight_log):
@@ -202,7 +302,7 @@ def fly_back():
     
     for command, value in reversed(new_optimized_log):
         if command == 'move_forward':
-            tello.move_forward(value)  # Fly forward by the logged distance (since we rotated)
+            fly_leg(value)  # Fly forward by the logged distance (since we rotated)
             print(f"Flying forward by {value} cm")
         elif command == 'rotate_cw':
             tello.rotate_counter_clockwise(value)  # Reverse clockwise rotation
@@ -214,21 +314,38 @@ def fly_back():
 # Main function to fly through all markers till the last one
 def fly_through_markers(first_marker, last_marker_id, W_real, f, direction):
     for marker_id in range(first_marker, last_marker_id + 1):  # Loop through marker IDs starting from 0
+        # Trim the remaining stations if the return home would no longer fit into the battery
+        next_leg = last_leg_distance()
+        battery = tello.get_battery()
+        if direction == 0 and scheduler.should_return(battery, next_leg, return_cost_after_next(next_leg)):
+            print(f"Battery {battery}% is not enough for marker {marker_id} and the way back, returning early")
+            break
+        if direction == 0 and watchdog.should_return():
+            print(f"Link degraded, returning before marker {marker_id}")
+            break
         search_and_fly_to_marker(marker_id, W_real, f, direction)
     if (direction == 0): 
         fly_back()  # Fly back after reaching the last marker
 
 # Takeoff and immediately move closer to the floor
-print(f"Battery: {tello.get_battery()}%")
+battery_level = tello.get_battery()
+if battery_level < MIN_TAKEOFF_BATTERY:
+    print("Battery too low! Please charge the drone.")
+    tello.streamoff()
+    exit()
+print(f"Battery: {battery_level}%")
 tello.takeoff()
 time.sleep(500 / 1000)
-tello.move_down(20)
-print("Drone has taken off and moved down closer to the floor")
 
 try:
+    # Inside the try, the drone lands even if the lowering or the hold fails
+    tello.move_down(20)
+    altitude_hold.start()  # Keep this height for the rest of the mission
+    print("Drone has taken off and moved down closer to the floor")
+    
     # Set the real width of the ArUco tag and the focal length
     W_real = 20  # Real width of the ArUco tag in cm
-    f = 77.4     # Estimated focal length in pixels (based on calibration)
+    f = forward_calibration.focal_px / 10  # Focal length in pixels / 10, from the calibration profile
     
     # Set the last marker ID (e.g., if the last marker is ID 4)
     last_marker_id = 2
@@ -239,16 +356,33 @@ try:
     fly_through_markers(first_maker_id, last_marker_id, W_real, f, 0)
 
 finally:
-    # Land the drone
-
-     
-
-    fly_through_markers(3, 3, 20, 77.4, 1)
-
+    # Land the drone, at the home marker unless the link is bad. The watchdog keeps guarding
+    # until the last flight command, land itself always goes through.
+    try:
+        if not watchdog.should_return():
+            fly_through_markers(3, 3, 20, forward_calibration.focal_px / 10, 1)
+    except LinkLost as error:
+        print(f"Landing where the drone is: {error}")
+
+    # The return leg is flown at the held height too, the hold ends right before landing
+    altitude_hold.stop()
+    print(altitude_hold.report())
     tello.land()
     print("Drone has landed")
+    watchdog.stop()
+    print(watchdog.report())
+    state_feed.stop()
+    print(quality_gate.summary())
+    battery_logger.close()
 
     # Turn off video stream and close the window
     tello.streamoff()
-    cv2.destroyAllWindows()
+    print(frame_buffers.report())
+    print(yaw_aligner.report())
+    print(marker_predictor.report())
+    print(detection_feed.report())
+    print(confirmer.report())
+    detection_feed.close()
+    print(display.summary())
+    display.close()
 
@@ -0,0 +1,70 @@
+from djitellopy import Tello
+import os
+import sys
+
+# Make the shared helpers in ArucoTagScripts/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.display import create_display
+from common.runtime import parse_args
+from common.energy import EnergyModel
+from common.focal_calibration import load_calibration
+from common.watchdog import CommandWatchdog, LinkLost
+from common.mission import MissionAbort, MissionError, MissionRunner, compile_mission, load_mission, plan_summary
+
+# Flies a declarative mission file (see missions/floor_route.json). The whole command plan,
+# its duration, battery use and the return paths are computed and checked before takeoff:
+#     python Floor/runMission.py --mission missions/floor_route.json --plan-only
+
+args = parse_args()
+mission_path = args.mission or os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'missions',
+                                            'floor_route.json')
+
+# Compile first, a mission with errors never reaches the drone
+try:
+    plan = compile_mission(load_mission(mission_path), EnergyModel.fit_from_log())
+except MissionError as error:
+    print(f"Mission rejected: {error}")
+    sys.exit(1)
+print(plan_summary(plan))
+if args.plan_only:
+    sys.exit(0)
+
+display = create_display(args)
+
+# Initialize Tello drone
+tello = Tello()
+tello.connect()
+calibrations = load_calibration(tello)
+
+first_checkpoint = next(step for step in plan.steps if step.command == "checkpoint")
+battery_level = tello.get_battery()
+if battery_level < first_checkpoint.value:
+    print(f"Battery {battery_level}% is below the {first_checkpoint.value}% the first leg needs")
+    sys.exit(1)
+
+watchdog = CommandWatchdog(tello)
+watchdog.start()
+tello = watchdog.wrap()
+
+tello.streamon()
+runner = MissionRunner(tello, plan, display, calibrations)
+
+try:
+    runner.run()
+except (MissionAbort, LinkLost) as error:
+    print(f"Mission ended early: {error}")
+finally:
+    print(runner.report())
+    print(runner.confirmer.report())
+    print(runner.cameras.report())
+    try:
+        if tello.is_flying:  # The plan ends with its own land
+            tello.land()
+    except LinkLost as error:
+        print(f"Land not confirmed: {error}")
+    finally:
+        # The stream and the display are closed even if land fails
+        watchdog.stop()  # After the last flight command
+        print(watchdog.report())
+        tello.streamoff()
+        display.close()
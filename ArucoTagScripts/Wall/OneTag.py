@@ -1,46 +1,56 @@
-import cv2
-import numpy as np
 from djitellopy import Tello
 import time
-
-# ArUco marker detection setup
-aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)  # Larger dictionary for more robust detection
-parameters = cv2.aruco.DetectorParameters()
-
-# Enable corner refinement for better detection at angles
-parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
+import os
+import sys
+
+# Make the shared helpers in ArucoTagScripts/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.frame_quality import FrameQualityGate
+from common.aruco_detection import create_detector, detect_markers, find_marker
+from common.frame_buffers import FrameBuffers
+from common.wall_alignment import WallAligner
+from common.focal_calibration import load_calibration
+from common.display import create_display
+from common.runtime import parse_args
+
+# Runtime flags (--headless, --viewer) and the matching camera display
+args = parse_args()
+
+# Printed width of the tag. It scales every forward go distance, so it is measured, not guessed.
+if args.marker_width is None:
+    sys.exit("Pass --marker-width CM, the printed width of the tag")
+display = create_display(args)
+
+# ArUco marker detection setup, larger dictionary for more robust detection
+# and corner refinement for better detection at angles
+detector = create_detector("DICT_6X6_250", corner_refinement=True, profile=args.detector_profile)
+
+# Reused grayscale buffers, the hot loop does not allocate a new image per frame
+frame_buffers = FrameBuffers()
 
 # Initialize Tello drone
 tello = Tello()
 tello.connect()
 
+# Focal length of this drone's forward camera, the defaults for drones without a profile
+forward_calibration = load_calibration(tello)["forward"]
+
 # Start video stream
 tello.streamon()
 
+# Blur / decoding-artifact check that runs before the detector
+quality_gate = FrameQualityGate()
+
 # Function to detect ArUco marker and get its position
 def detect_aruco_marker(frame, marker_id=0):
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    gray = frame_buffers.gray(frame)
     
-    # Detect markers
-    detector = cv2.aruco.ArucoDetector(aruco_dict, parameters)
-    corners, ids, _ = detector.detectMarkers(gray)
+    # Detect markers and pick the one we are looking for (default 0)
+    detections = detect_markers(detector, gray)
+    marker = find_marker(detections, marker_id)
     
-    if ids is not None:
-        for i, found_id in enumerate(ids):
-            if found_id == marker_id:  # We're looking for the specific marker ID (default 0)
-                marker_corners = corners[i][0]
-                center_x = int((marker_corners[0][0] + marker_corners[2][0]) / 2)
-                center_y = int((marker_corners[0][1] + marker_corners[2][1]) / 2)
-                
-                # Calculate marker size (distance from the camera)
-                marker_size = np.linalg.norm(marker_corners[0] - marker_corners[2])
-                
-                # Draw the detected marker on the frame for visualization
-                cv2.aruco.drawDetectedMarkers(frame, corners)
-                
-                return (center_x, center_y, marker_size)
-    
-    return None
+    # The display draws the detections, the frame itself is left untouched
+    return marker, detections
 
 
 print(f"Battery: {tello.get_battery()}%")
@@ -51,80 +61,73 @@ tello.move_down(50)  # Lower the drone's height to improve detection of floor ma
 print("Drone has taken off and moved down closer to the floor")
 
 # Start looking for the marker
-original_position = (0, 0)  # Assume the drone starts at 0,0 position
 marker_found = False
-close_to_marker = False
 
 # Thresholds for when the drone is considered "close enough" to the marker
 CLOSE_ENOUGH_MARKER_SIZE = 200  # Adjust marker size threshold based on your setup
-FORWARD_STEP_SIZE = 20  # Move forward in smaller steps
+MARKER_WIDTH_CM = args.marker_width
+
+# Converts the marker pose into one go x y z command per correction
+aligner = WallAligner(tello, MARKER_WIDTH_CM, CLOSE_ENOUGH_MARKER_SIZE, focal_px=forward_calibration.focal_px)
 
 try:
     while not marker_found:
         # Get the latest frame from the drone's camera
         frame = tello.get_frame_read().frame
         
+        # Frames from before the last move finished still show the old view
+        if aligner.settling():
+            time.sleep(0.01)
+            continue
+        
+        # Skip motion-blurred or torn frames before running the detector
+        quality = quality_gate.check(frame)
+        if not quality.usable:
+            print(f"Skipping frame (sharpness {quality.sharpness:.1f}, tear {quality.tear:.1f})")
+            display.show(frame)
+            if display.stop_requested():
+                break
+            if quality_gate.stuck():
+                # Every frame rejected for a while, e.g. over a low-texture floor: search on instead of hovering
+                print(f"{quality_gate.rejected_in_row} frames in a row rejected, rotating...")
+                tello.rotate_clockwise(30)
+                aligner.moved()
+            continue
+
         # Detect the ArUco marker
-        marker_data = detect_aruco_marker(frame, marker_id=0)  # Change marker_id as needed
+        marker_data, detections = detect_aruco_marker(frame, marker_id=0)  # Change marker_id as needed
 
-        # Display the video stream with OpenCV
-        cv2.imshow("Tello Camera Feed", frame)
-        
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        # Hand the frame and detections to the display
+        display.show(frame, detections)
+        if display.stop_requested():
             break  # Press 'q' to stop the video stream manually
 
         if marker_data is not None:
-            center_x, center_y, marker_size = marker_data
-            print(f"Marker found at position: {center_x}, {center_y} with size {marker_size}")
-            
-            # Move towards the marker
-            frame_center_x = frame.shape[1] // 2
-            frame_center_y = frame.shape[0] // 2
-            
-            # Align horizontally
-            if abs(center_x - frame_center_x) > 30:
-                if center_x < frame_center_x:
-                    tello.move_left(20)
-                    print("Moving left")
-                else:
-                    tello.move_right(20)
-                    print("Moving right")
-            
-            # Align vertically
-            if abs(center_y - frame_center_y) > 30:
-                if center_y < frame_center_y:
-                    tello.move_up(20)
-                    print("Moving up")
-                else:
-                    tello.move_down(20)
-                    print("Moving down")
-            
-            # Move forward if not yet close enough to the marker
-            if marker_size < CLOSE_ENOUGH_MARKER_SIZE:
-                tello.move_forward(FORWARD_STEP_SIZE)
-                print("Moving forward closer to the marker")
-                time.sleep(1)  # Allow time to move
-            else:
-                print("Close enough to the marker")
-                close_to_marker = True
+            print(f"Marker found at position: {marker_data.center_x}, {marker_data.center_y} "
+                  f"with size {marker_data.size}")
             
-            # If drone is close enough to the marker, stop moving forward
-            if close_to_marker:
+            # One combined go x y z move towards the standoff point in front of the marker
+            if aligner.step(marker_data, frame.shape):
                 print("Finish: Reached the ArUco marker with ID 0")
                 marker_found = True
         else:
             print("Marker not found, rotating...")
             tello.rotate_clockwise(30)  # Keep searching by rotating
+            aligner.moved()
 
     # After reaching the marker, return to the original position
     print("Returning to original position...")
-    tello.move_back(100)  # Adjust this value based on how much the drone moved forward
+    aligner.return_from(0)
 
 finally:
     # Land the drone
     tello.land()
     print("Drone has landed")
+    print(quality_gate.summary())
+    print(aligner.report())
 
     # Turn off video stream and close the window
     tello.streamoff()
-    cv2.destroyAllWindows()
+    print(frame_buffers.report())
+    print(display.summary())
+    display.close()
@@ -0,0 +1,6 @@
+# Shared helpers for the ArUco mission scripts in Floor/ and Wall/.
+#
+# The mission scripts are started directly (e.g. `python Floor/main.py`), so they
+# add the ArucoTagScripts folder to sys.path before importing from this package.
+# Modules with a benchmark or demo can be run from the ArucoTagScripts folder:
+#     python -m common.frame_quality
@@ -0,0 +1,184 @@
+import math
+import threading
+import time
+
+from common.state_estimator import TOF_MAX, TOF_MIN
+
+# Commands that move the drone by themselves; the hold stays quiet while one of them runs
+DISCRETE_COMMANDS = {
+    "move_up", "move_down", "move_left", "move_right", "move_forward", "move_back",
+    "rotate_clockwise", "rotate_counter_clockwise", "go_xyz_speed", "curve_xyz_speed",
+    "flip_left", "flip_right", "flip_forward", "flip_back", "takeoff", "land", "emergency",
+}
+
+RC_SILENCE = 0.5  # Seconds after a mission rc command during which the hold does not send rc
+
+
+def ground_distance(slant_cm, height_cm):
+    """ Horizontal distance to a floor tag from the line-of-sight distance the marker width gives.
+        The slant distance itself while the height is unknown, None when the slant distance is not
+        above the height: the width or the height reading is wrong then, not the drone close.
+    """
+    if height_cm is None:
+        return slant_cm
+    if slant_cm <= height_cm:
+        return None
+    return math.sqrt(slant_cm ** 2 - height_cm ** 2)
+
+
+class HeldTello(object):
+    """ Stands in for the Tello in the mission scripts. Discrete commands pause the
+        altitude hold while they run, rc commands from the mission silence it briefly,
+        everything else goes straight to the Tello.
+    """
+
+    def __init__(self, tello, hold):
+        self._tello = tello
+        self._hold = hold
+
+    def __getattr__(self, name):
+        attribute = getattr(self._tello, name)
+        if name in DISCRETE_COMMANDS:
+            def command(*args, **kwargs):
+                with self._hold.paused():
+                    return attribute(*args, **kwargs)
+            return command
+        if name == "send_rc_control":
+            def rc(*args, **kwargs):
+                self._hold.external_rc()
+                return attribute(*args, **kwargs)
+            return rc
+        return attribute
+
+
+class _Paused(object):
+    def __init__(self, hold):
+        self.hold = hold
+
+    def __enter__(self):
+        with self.hold.lock:
+            self.hold.pause_depth += 1
+            if self.hold.sent_throttle:
+                # Leave the sticks centered before the command starts
+                self.hold.tello.send_rc_control(0, 0, 0, 0)
+                self.hold.sent_throttle = 0
+
+    def __exit__(self, *exc):
+        with self.hold.lock:
+            self.hold.pause_depth -= 1
+            self.hold.integral = 0.0
+        return False
+
+
+class AltitudeHold(object):
+    """ Keeps the height above the floor with rc throttle corrections at rate Hz while the
+        mission hovers between commands. Height is the ToF reading (the barometric h when the
+        ToF is out of range), or the fused height of a StateEstimator if one is given.
+        start() holds the current height unless a target is given.
+    """
+
+    def __init__(self, tello, estimator=None, rate=10, gain=0.8, integral_gain=0.1, deadband=4, max_throttle=30):
+        self.tello = tello
+        self.estimator = estimator
+        self.period = 1.0 / rate
+        self.gain = gain  # rc units per cm of height error
+        self.integral_gain = integral_gain  # rc units per cm*s
+        self.deadband = deadband  # cm
+        self.max_throttle = max_throttle
+
+        self.target = None
+        self.integral = 0.0
+        self.pause_depth = 0
+        self.sent_throttle = 0
+        self.last_external_rc = 0.0
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+        # Statistics for the report
+        self.samples = 0
+        self.abs_error = 0.0
+        self.outside = 0  # Samples more than 10 cm off target
+        self.corrections = 0
+
+    def wrap(self):
+        """ The Tello to use for the rest of the mission """
+        return HeldTello(self.tello, self)
+
+    def height(self):
+        """ Live height above the floor in cm, or None without a valid reading """
+        if self.estimator is not None:
+            return self.estimator.pose().height
+        state = self.tello.get_current_state()
+        if not state:
+            return None
+        tof = float(state.get('tof', 0))
+        if TOF_MIN <= tof <= TOF_MAX:
+            return tof
+        return float(state['h']) if 'h' in state else None
+
+    def paused(self):
+        return _Paused(self)
+
+    def external_rc(self):
+        self.last_external_rc = time.monotonic()
+
+    def start(self, target=None):
+        """ Hold target cm, or the current height. Without a height reading yet the hold takes
+            the first valid one as its target.
+        """
+        self.target = target if target is not None else self.height()
+        if self.target is None:
+            print("Altitude hold waiting for a height reading")
+        else:
+            print(f"Altitude hold at {self.target:.0f} cm")
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def set_target(self, target):
+        with self.lock:
+            self.target = target
+            self.integral = 0.0
+
+    def _run(self):
+        while self.running:
+            height = self.height()
+            with self.lock:
+                idle = self.pause_depth == 0 and time.monotonic() - self.last_external_rc > RC_SILENCE
+                if self.target is None and height is not None:
+                    self.target = height
+                    print(f"Altitude hold at {self.target:.0f} cm")
+                if height is not None and self.target is not None:
+                    error = self.target - height
+                    self.samples += 1
+                    self.abs_error += abs(error)
+                    self.outside += abs(error) > 10
+
+                    throttle = 0
+                    if idle and abs(error) > self.deadband:
+                        self.integral += error * self.period
+                        limit = self.max_throttle / max(self.integral_gain, 1e-6)
+                        self.integral = max(-limit, min(limit, self.integral))
+                        throttle = self.gain * error + self.integral_gain * self.integral
+                        throttle = int(max(-self.max_throttle, min(self.max_throttle, throttle)))
+                    if idle and (throttle or self.sent_throttle):
+                        self.tello.send_rc_control(0, 0, throttle, 0)
+                        self.corrections += throttle != 0
+                        self.sent_throttle = throttle
+            time.sleep(self.period)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        if self.sent_throttle:
+            self.tello.send_rc_control(0, 0, 0, 0)
+            self.sent_throttle = 0
+
+    def report(self):
+        if not self.samples:
+            return "Altitude hold: no height samples"
+        return (f"Altitude hold: mean error {self.abs_error / self.samples:.1f} cm, "
+                f"{self.outside / self.samples:.0%} of the time more than 10 cm off, "
+                f"{self.corrections} throttle corrections")
@@ -0,0 +1,122 @@
+import json
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+# Dictionaries used by the mission scripts, by name so they can be passed between processes
+DICTIONARIES = {
+    "DICT_4X4_50": cv2.aruco.DICT_4X4_50,
+    "DICT_6X6_250": cv2.aruco.DICT_6X6_250,
+}
+
+# Corner refinement methods by name, as stored in detector profiles
+CORNER_REFINEMENT = {
+    "none": cv2.aruco.CORNER_REFINE_NONE,
+    "subpix": cv2.aruco.CORNER_REFINE_SUBPIX,
+    "contour": cv2.aruco.CORNER_REFINE_CONTOUR,
+    "apriltag": cv2.aruco.CORNER_REFINE_APRILTAG,
+}
+
+# Named detector profiles written by common.detector_tuning
+PROFILES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "detector_profiles.json")
+
+# One detected marker, measured the same way as in the mission scripts:
+# width and height are the first two edges, size is the corner-to-corner diagonal
+Detection = namedtuple("Detection", ["marker_id", "center_x", "center_y", "width", "height", "size", "corners"])
+
+
+class _RemappedDetector(object):
+    """ Detector over a reduced dictionary that only holds the deployed IDs.
+        The reduced dictionary numbers its markers 0..n-1, detectMarkers maps them
+        back to the IDs of the full dictionary so callers see the printed IDs.
+    """
+
+    def __init__(self, detector, marker_ids):
+        self.detector = detector
+        self.marker_ids = np.array(marker_ids, dtype=np.int32)
+
+    def detectMarkers(self, gray):
+        corners, ids, rejected = self.detector.detectMarkers(gray)
+        if ids is not None:
+            ids = self.marker_ids[ids]
+        return corners, ids, rejected
+
+
+# Function to load a named detector profile, e.g. load_profile("forward_960x720_balanced")
+def load_profile(name, path=PROFILES_PATH):
+    with open(path) as profiles_file:
+        profiles = json.load(profiles_file)
+    if name not in profiles:
+        raise KeyError(f"No detector profile {name} in {path}, run common.detector_tuning first")
+    return profiles[name]
+
+
+# Function to build an ArUco detector from profile settings (a dict as stored by detector_tuning)
+def detector_from_profile(profile):
+    aruco_dict = cv2.aruco.getPredefinedDictionary(DICTIONARIES[profile["dictionary"]])
+    marker_ids = profile.get("marker_ids")
+    if marker_ids:
+        # Fewer candidate codes: faster identification and fewer false positives
+        aruco_dict = cv2.aruco.Dictionary(aruco_dict.bytesList[marker_ids], aruco_dict.markerSize,
+                                          aruco_dict.maxCorrectionBits)
+
+    parameters = cv2.aruco.DetectorParameters()
+    parameters.adaptiveThreshWinSizeMin = profile.get("win_size_min", parameters.adaptiveThreshWinSizeMin)
+    parameters.adaptiveThreshWinSizeMax = profile.get("win_size_max", parameters.adaptiveThreshWinSizeMax)
+    parameters.adaptiveThreshWinSizeStep = profile.get("win_size_step", parameters.adaptiveThreshWinSizeStep)
+    parameters.minMarkerPerimeterRate = profile.get("min_perimeter_rate", parameters.minMarkerPerimeterRate)
+    parameters.maxMarkerPerimeterRate = profile.get("max_perimeter_rate", parameters.maxMarkerPerimeterRate)
+    parameters.polygonalApproxAccuracyRate = profile.get("polygon_accuracy", parameters.polygonalApproxAccuracyRate)
+    parameters.cornerRefinementMethod = CORNER_REFINEMENT[profile.get("corner_refinement", "none")]
+
+    detector = cv2.aruco.ArucoDetector(aruco_dict, parameters)
+    if marker_ids:
+        return _RemappedDetector(detector, marker_ids)
+    return detector
+
+
+# Function to create an ArUco detector with the settings used by the missions,
+# or with a tuned profile by name (see common.detector_tuning)
+def create_detector(dictionary="DICT_6X6_250", corner_refinement=False, profile=None):
+    if profile is not None:
+        return detector_from_profile(load_profile(profile))
+
+    aruco_dict = cv2.aruco.getPredefinedDictionary(DICTIONARIES[dictionary])
+    parameters = cv2.aruco.DetectorParameters()
+
+    # Corner refinement gives better sizes at angles but costs some time
+    if corner_refinement:
+        parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
+
+    return cv2.aruco.ArucoDetector(aruco_dict, parameters)
+
+
+# Function to detect all markers in a grayscale image
+def detect_markers(detector, gray):
+    corners, ids, _ = detector.detectMarkers(gray)
+
+    detections = []
+    if ids is None:
+        return detections
+
+    for i, found_id in enumerate(ids.flatten()):
+        marker_corners = corners[i][0]
+        center_x = int((marker_corners[0][0] + marker_corners[2][0]) / 2)
+        center_y = int((marker_corners[0][1] + marker_corners[2][1]) / 2)
+        marker_width = float(np.linalg.norm(marker_corners[0] - marker_corners[1]))
+        marker_height = float(np.linalg.norm(marker_corners[1] - marker_corners[2]))
+        marker_size = float(np.linalg.norm(marker_corners[0] - marker_corners[2]))
+        detections.append(Detection(int(found_id), center_x, center_y, marker_width, marker_height,
+                                    marker_size, marker_corners))
+
+    return detections
+
+
+# Function to pick one marker ID out of a detection list
+def find_marker(detections, marker_id):
+    for detection in detections:
+        if detection.marker_id == marker_id:
+            return detection
+    return None
@@ -0,0 +1,132 @@
+import math
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from common.aruco_detection import create_detector, detect_markers
+from common.frame_buffers import FrameBuffers
+from common.wall_alignment import FORWARD_FOCAL_PX
+
+# Forward / downward camera switching for missions that need both views.
+#
+# set_video_direction switches the camera, but the decoder keeps handing out frames of the old
+# camera for a few hundred ms. After a switch the scheduler keeps returning None from frame()
+# until it sees the scene cut to the new camera (a large difference of a small thumbnail against
+# the last frame of the old camera), or until max_latency has passed. Only frames decoded after
+# that point reach the mission, each one with the detector and calibration of its camera.
+
+CAMERA_FORWARD = 0  # Tello.CAMERA_FORWARD
+CAMERA_DOWNWARD = 1  # Tello.CAMERA_DOWNWARD
+
+CameraProfile = namedtuple("CameraProfile", ["name", "direction", "width", "height", "focal_px", "dictionary",
+                                             "detector_profile"])
+
+# focal_px is at the native width of the camera, the downward value is a first estimate,
+# measure it with ArucoTag/getSize.py over a floor tag at a known height
+FORWARD = CameraProfile("forward", CAMERA_FORWARD, 960, 720, FORWARD_FOCAL_PX, "DICT_6X6_250", None)
+DOWNWARD = CameraProfile("downward", CAMERA_DOWNWARD, 320, 240, 220.0, "DICT_6X6_250", None)
+
+THUMBNAIL = (64, 48)
+SCENE_CUT = 25.0  # Mean absolute thumbnail difference (0-255) that marks the new camera
+
+
+def _thumbnail(frame):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    return cv2.resize(gray, THUMBNAIL, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+class CameraScheduler(object):
+    """ Switches the Tello camera on request and hands out only frames of the active camera """
+
+    def __init__(self, tello, profiles=(FORWARD, DOWNWARD), max_latency=1.5):
+        self.tello = tello
+        self.frame_read = tello.get_frame_read()
+        self.profiles = {profile.name: profile for profile in profiles}
+        self.detectors = {profile.name: create_detector(profile.dictionary, profile=profile.detector_profile)
+                          for profile in profiles}
+        self.buffers = FrameBuffers()  # One grayscale buffer per camera resolution
+        self.max_latency = max_latency
+
+        self.active = next(iter(self.profiles))
+        self.switching = False
+        self.switch_started = 0.0
+        self.reference = None  # Thumbnail of the last frame of the old camera
+        self.last_frame = None  # Last frame handed out, the same frame is never handed out twice
+        self.latencies = []
+        self.stale_frames = 0
+        self.timeouts = 0
+
+    def request(self, name):
+        """ Start switching to camera name, returns at once """
+        if name == self.active and not self.switching:
+            return
+        frame = self.frame_read.frame
+        self.reference = _thumbnail(frame) if frame is not None else None
+        self.last_frame = frame
+        self.tello.set_video_direction(self.profiles[name].direction)
+        self.active = name
+        self.switching = True
+        self.switch_started = time.monotonic()
+
+    def use(self, name, timeout=None):
+        """ Switch to camera name and wait until its first frame arrived. False on timeout. """
+        self.request(name)
+        deadline = time.monotonic() + (timeout or self.max_latency + 0.5)
+        while self.switching and time.monotonic() < deadline:
+            self.frame()
+            time.sleep(0.01)
+        return not self.switching
+
+    def frame(self):
+        """ Newest frame of the active camera, or None while switching or when nothing new arrived """
+        frame = self.frame_read.frame
+        if frame is None or frame is self.last_frame:
+            return None
+        self.last_frame = frame
+
+        if self.switching:
+            waited = time.monotonic() - self.switch_started
+            cut = self.reference is None or np.abs(_thumbnail(frame) - self.reference).mean() > SCENE_CUT
+            if not cut and waited < self.max_latency:
+                self.stale_frames += 1
+                return None
+            if cut:
+                self.latencies.append(waited)
+            else:
+                self.timeouts += 1  # Scenes too similar to tell apart, trust the time instead
+            self.switching = False
+        return frame
+
+    def profile(self):
+        return self.profiles[self.active]
+
+    def detect(self, frame):
+        """ Detections in a frame of the active camera, with its own detector settings """
+        return detect_markers(self.detectors[self.active], self.buffers.gray(frame))
+
+    def focal_px(self, frame):
+        """ Focal length of the active camera at the size the frame was decoded at """
+        profile = self.profile()
+        return profile.focal_px * frame.shape[1] / profile.width
+
+    def ground_offset(self, detection, frame, height_cm):
+        """ (forward, right) in cm from the drone to a floor marker seen by the downward camera """
+        cm_per_px = height_cm / self.focal_px(frame)
+        forward = (frame.shape[0] / 2 - detection.center_y) * cm_per_px  # Top of the image is forward
+        right = (detection.center_x - frame.shape[1] / 2) * cm_per_px
+        return forward, right
+
+    def forward_offset(self, center_x, frame, distance_cm):
+        """ (forward, right) in cm to a marker distance_cm away along the floor, seen by the forward camera """
+        bearing = math.atan2(center_x - frame.shape[1] / 2, self.focal_px(frame))
+        return distance_cm * math.cos(bearing), distance_cm * math.sin(bearing)
+
+    def report(self):
+        if not self.latencies:
+            return f"Camera switches: none measured, {self.timeouts} timeouts"
+        latencies = sorted(self.latencies)
+        return (f"Camera switches: {len(latencies) + self.timeouts}, latency median "
+                f"{latencies[len(latencies) // 2] * 1000:.0f} ms, max {latencies[-1] * 1000:.0f} ms, "
+                f"{self.stale_frames} stale frames held back, {self.timeouts} timeouts")
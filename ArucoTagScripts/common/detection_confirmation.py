@@ -0,0 +1,211 @@
+import argparse
+import random
+import time
+from collections import Counter, deque, namedtuple
+
+# Multi-frame confirmation of a target marker before a command is sent on it.
+#
+# A single misdecoded ID or a broken corner set used to be enough for a rotation or a
+# move_forward. Now every frame is one vote: a sighting of the target that passes the
+# single-frame checks, or None. A sighting is confirmed when `required` of the last `window`
+# frames agree with the newest one on position (max_shift of the frame width) and size
+# (max_size_change), none older than max_age seconds. The confirmed values are the newest
+# position and the median width, height and distance of the agreeing frames.
+#
+# Single-frame checks, cheap enough for every frame:
+#   tiny      a side below MIN_SIDE px, most decoding errors are small quads
+#   aspect    sides further apart than MAX_ASPECT, a square marker cannot look like that
+#   range     a distance outside 0..max_distance cm
+#   size      the distance implied by the marker size more than max_size_error away from the
+#             expected distance, only when the caller knows one from a source independent of the
+#             camera: the ToF height when the downward camera looks at a floor marker straight
+#             below (centering in Floor/main.py, verify of a downward mission). The IMU-only pose
+#             drifts too much for the forward camera, there it is left out.
+#
+# A sighting that never gets confirmed is a command the single-frame logic would have sent in
+# vain, report() counts them as prevented.
+#
+# Simulated misdecodes with and without confirmation, from the ArucoTagScripts folder:
+#     python -m common.detection_confirmation
+
+MIN_SIDE = 8  # px
+MAX_ASPECT = 4.0  # Floor markers seen from low height are strongly foreshortened
+MAX_DISTANCE = 600  # cm, a 20 cm marker is about 25 px wide there
+
+# required of the last window frames, max_age in s, max_shift as share of the frame width,
+# max_size_change and max_size_error relative
+PhaseConfig = namedtuple("PhaseConfig", ["required", "window", "max_age", "max_shift", "max_size_change",
+                                         "max_size_error"])
+PHASES = {
+    "search": PhaseConfig(3, 5, 1.0, 0.10, 0.25, 0.5),  # Before the yaw alignment turn
+    "approach": PhaseConfig(4, 6, 0.8, 0.05, 0.15, 0.35),  # The distance of a move_forward
+    "center": PhaseConfig(2, 3, 0.5, 0.15, 0.30, 0.5),  # Downward camera, short rc bursts
+    "verify": PhaseConfig(3, 5, 1.5, 0.10, 0.25, 0.5),  # Station check of a mission plan
+}
+
+Sighting = namedtuple("Sighting", ["t", "center_x", "center_y", "width", "height", "distance"])
+Confirmation = namedtuple("Confirmation", ["center_x", "center_y", "width", "height", "distance", "votes"])
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+class DetectionConfirmer(object):
+    """ N-of-M confirmation of one target marker, see the top of the file.
+        reset() whenever the target, the phase or the view changes (after a turn or a move).
+    """
+
+    def __init__(self, phases=None, max_distance=MAX_DISTANCE):
+        self.phases = dict(PHASES, **(phases or {}))
+        self.max_distance = max_distance
+        self.phase = "search"
+        self.config = self.phases[self.phase]
+        self.expected_distance = None
+        self.history = deque(maxlen=self.config.window)
+        self.state = "idle"  # idle, pending (seen, not confirmed yet) or confirmed
+        self.pending_frames = 0
+
+        self.sightings = 0
+        self.confirmed = 0
+        self.prevented = 0
+        self.confirm_frames = 0
+        self.rejected = Counter()
+
+    def reset(self, phase=None, expected_distance=None):
+        """ Forget the earlier frames, optionally switch to another phase """
+        self._give_up()
+        if phase is not None:
+            self.phase = phase
+            self.config = self.phases[phase]
+        self.expected_distance = expected_distance
+        self.history = deque(maxlen=self.config.window)
+        self.state = "idle"
+
+    def _give_up(self):
+        if self.state == "pending":
+            self.prevented += 1  # The single-frame logic would have acted on this sighting
+        self.state = "idle"
+
+    def _check(self, width, height, distance):
+        """ Single-frame reason to reject a sighting, None if it passes """
+        short, long = min(width, height), max(width, height)
+        if short < MIN_SIDE:
+            return "tiny"
+        if long > MAX_ASPECT * short:
+            return "aspect"
+        if distance is not None:
+            if not 0 <= distance <= self.max_distance:
+                return "range"
+            if self.expected_distance and \
+                    abs(distance - self.expected_distance) > self.config.max_size_error * self.expected_distance:
+                return "size"
+        return None
+
+    def _still_pending(self, t):
+        return any(sighting is not None and t - sighting.t <= self.config.max_age for sighting in self.history)
+
+    def miss(self, t=None):
+        """ A frame without the target. True while an earlier sighting is still being confirmed. """
+        t = time.monotonic() if t is None else t
+        self.history.append(None)
+        if self.state == "pending":
+            self.pending_frames += 1
+        if self.state != "idle" and not self._still_pending(t):
+            self._give_up()
+        return self.state == "pending"
+
+    def observe(self, center_x, center_y, width, height, frame_width, distance=None, t=None):
+        """ A frame with the target. The Confirmation once enough frames agree, None before. """
+        t = time.monotonic() if t is None else t
+        self.sightings += 1
+        if self.state == "idle":
+            self.state = "pending"
+            self.pending_frames = 0
+        if self.state == "pending":
+            self.pending_frames += 1
+
+        reason = self._check(width, height, distance)
+        if reason is not None:
+            self.rejected[reason] += 1
+            self.history.append(None)
+            if not self._still_pending(t):
+                self._give_up()
+            return None
+        newest = Sighting(t, center_x, center_y, width, height, distance)
+        self.history.append(newest)
+
+        config = self.config
+        votes = [sighting for sighting in self.history
+                 if sighting is not None and t - sighting.t <= config.max_age
+                 and abs(sighting.center_x - center_x) <= config.max_shift * frame_width
+                 and abs(sighting.width - width) <= config.max_size_change * width]
+        if len(votes) < config.required:
+            return None
+
+        if self.state == "pending":
+            self.confirmed += 1
+            self.confirm_frames += self.pending_frames
+            self.state = "confirmed"
+        distances = [sighting.distance for sighting in votes if sighting.distance is not None]
+        return Confirmation(center_x, center_y, _median([s.width for s in votes]), _median([s.height for s in votes]),
+                            _median(distances) if distances else None, len(votes))
+
+    def report(self):
+        frames = self.confirm_frames / self.confirmed if self.confirmed else 0.0
+        rejected = ", ".join(f"{reason} {count}" for reason, count in self.rejected.most_common()) or "none"
+        return (f"Detection confirmation: {self.sightings} sightings, {self.confirmed} confirmed after "
+                f"{frames:.1f} frames on average, {self.prevented} commands prevented on unconfirmed sightings "
+                f"(rejected frames: {rejected})")
+
+
+# --- Simulation -------------------------------------------------------------------------
+
+def simulate(frames=20000, misdecode_rate=0.01, dropout=0.15, visible_share=0.5, seed=0):
+    """ A target that is in view half of the time, missed in some frames, plus misdecodes of
+        other markers as the target at random places. Returns (false sightings, false
+        confirmations, confirmer).
+    """
+    rng = random.Random(seed)
+    confirmer = DetectionConfirmer()
+    wrong_sightings = wrong_confirmations = 0
+    visible = False
+    t = 0.0
+    true_x, true_width = 480.0, 60.0
+    for _ in range(frames):
+        t += 1 / 30
+        if rng.random() < 0.01:
+            visible = rng.random() < visible_share
+            true_x, true_width = rng.uniform(100, 860), rng.uniform(20, 150)
+            confirmer.reset("search")  # The drone turned
+        if visible and rng.random() > dropout:
+            x, width, real = true_x + rng.gauss(0, 3), true_width * rng.gauss(1, 0.03), True
+        elif rng.random() < misdecode_rate:
+            x, width, real = rng.uniform(0, 960), rng.uniform(5, 120), False
+        else:
+            confirmer.miss(t)
+            continue
+        height = width * rng.uniform(0.4, 1.0) if real else width * rng.uniform(0.1, 1.5)
+        wrong_sightings += not real
+        confirmation = confirmer.observe(x, 360, width, height, 960, 2000 / width, t)
+        if confirmation is not None:
+            wrong_confirmations += not real
+            confirmer.reset()  # The command is sent, the view changes
+    return wrong_sightings, wrong_confirmations, confirmer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate multi-frame confirmation against misdecodes")
+    parser.add_argument("--misdecode-rate", type=float, default=0.01, help="share of frames with a false target")
+    args = parser.parse_args()
+
+    wrong_sightings, wrong_confirmations, confirmer = simulate(misdecode_rate=args.misdecode_rate)
+    print(f"Misdecode rate {args.misdecode_rate:.0%}: {wrong_sightings} false sightings of the target, each acted "
+          f"on by the single-frame logic, {wrong_confirmations} of them confirmed")
+    print(confirmer.report())
+    start = time.perf_counter()
+    for i in range(100000):
+        confirmer.observe(480.0, 360.0, 60.0, 58.0, 960, 120.0, i / 30)
+    print(f"{(time.perf_counter() - start) * 10:.2f} us per observed frame")
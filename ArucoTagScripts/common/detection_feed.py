@@ -0,0 +1,219 @@
+import argparse
+import errno
+import glob
+import os
+import socket
+import struct
+import tempfile
+import time
+from collections import namedtuple
+
+# Local publish/subscribe feed of the mission's detections and telemetry.
+#
+# Every published frame is one fixed-size datagram, packed into a preallocated buffer:
+#   header   magic, version, marker count, sequence, time (time.time), height (cm, NaN if unknown), yaw (deg),
+#            battery (%)
+#   markers  MAX_MARKERS x (marker id, center x, center y, width px, distance cm or 0)
+#
+# Two transports, both without backpressure: the publisher never waits for a subscriber.
+#   multicast  one sendto to a multicast group on this host (TTL 0), any number of subscribers join it.
+#   unix       every subscriber binds a datagram socket in FEED_DIR, the publisher sends to each one.
+#              A subscriber whose queue is full misses the message, one that is gone is forgotten.
+# A subscriber sees lost messages as gaps in the sequence numbers.
+#
+# Subscribe from the ArucoTagScripts folder while a mission runs with --feed multicast:
+#     python -m common.detection_feed
+#     python -m common.detection_feed --transport unix
+#     python -m common.detection_feed --benchmark
+
+MAGIC = b"TD"
+VERSION = 1
+MAX_MARKERS = 8
+FEED_HEADER = struct.Struct("<2sBBIdffbxxx")
+FEED_MARKER = struct.Struct("<hhhff")
+MESSAGE_SIZE = FEED_HEADER.size + MAX_MARKERS * FEED_MARKER.size
+
+MULTICAST_GROUP = "239.255.42.99"
+MULTICAST_PORT = 5007
+FEED_DIR = os.path.join(tempfile.gettempdir(), "tello_detection_feed")
+NAN = float("nan")
+RESCAN_SECONDS = 1.0  # How often the unix publisher looks for new subscribers
+
+FeedMessage = namedtuple("FeedMessage", ["seq", "t", "height", "yaw", "battery", "markers"])
+FeedMarker = namedtuple("FeedMarker", ["marker_id", "center_x", "center_y", "width", "distance"])
+
+
+def decode_message(data):
+    magic, version, count, seq, t, height, yaw, battery = FEED_HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a detection feed message")
+    markers = [FeedMarker(*FEED_MARKER.unpack_from(data, FEED_HEADER.size + i * FEED_MARKER.size))
+               for i in range(count)]
+    return FeedMessage(seq, t, height, yaw, battery, markers)
+
+
+class DetectionPublisher(object):
+    """ Publishes one message per frame, see the top of the file """
+
+    def __init__(self, transport="multicast", group=MULTICAST_GROUP, port=MULTICAST_PORT, feed_dir=FEED_DIR):
+        self.transport = transport
+        self.buffer = bytearray(MESSAGE_SIZE)
+        self.view = memoryview(self.buffer)
+        self.seq = 0
+        self.published = 0
+        self.dropped = 0
+        self.publish_seconds = 0.0
+
+        if transport == "multicast":
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 0)  # Never leaves this host
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            self.destinations = [(group, port)]
+        elif transport == "unix":
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.feed_dir = feed_dir
+            self.destinations = []
+            self.next_scan = 0.0
+        else:
+            raise ValueError(f"Unknown feed transport {transport}")
+        self.sock.setblocking(False)
+
+    def _scan(self, now):
+        self.destinations = glob.glob(os.path.join(self.feed_dir, "*.sock"))
+        self.next_scan = now + RESCAN_SECONDS
+
+    def publish(self, detections, height=0.0, yaw=0.0, battery=-1, distances=None):
+        """ One message for the detections of a frame. distances: marker ID -> cm, optional. """
+        start = time.perf_counter()
+        count = min(len(detections), MAX_MARKERS)
+        height = NAN if height is None else height
+        FEED_HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, count, self.seq & 0xFFFFFFFF, time.time(),
+                              height, yaw, battery)
+        offset = FEED_HEADER.size
+        for i in range(count):
+            detection = detections[i]
+            distance = distances.get(detection.marker_id, 0.0) if distances else 0.0
+            FEED_MARKER.pack_into(self.buffer, offset, detection.marker_id, detection.center_x, detection.center_y,
+                                  detection.width, distance)
+            offset += FEED_MARKER.size
+        self.seq += 1
+
+        if self.transport == "unix" and start >= self.next_scan:
+            self._scan(start)
+        for destination in self.destinations:
+            try:
+                self.sock.sendto(self.view, destination)
+                self.published += 1
+            except BlockingIOError:
+                self.dropped += 1  # Subscriber behind, it sees a sequence gap
+            except OSError as error:
+                if error.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    self.destinations = [d for d in self.destinations if d != destination]
+                else:
+                    self.dropped += 1
+        self.publish_seconds += time.perf_counter() - start
+
+    def report(self):
+        mean = self.publish_seconds / self.seq * 1e6 if self.seq else 0.0
+        return (f"Detection feed ({self.transport}): {self.seq} frames, {self.published} messages sent, "
+                f"{self.dropped} dropped, {mean:.1f} us per frame")
+
+    def close(self):
+        self.sock.close()
+
+
+class NullPublisher(object):
+    """ Stands in when the feed is off """
+
+    def publish(self, detections, height=0.0, yaw=0.0, battery=-1, distances=None):
+        pass
+
+    def report(self):
+        return "Detection feed: off"
+
+    def close(self):
+        pass
+
+
+class DetectionSubscriber(object):
+    """ Receives feed messages and counts the ones it missed """
+
+    def __init__(self, transport="multicast", group=MULTICAST_GROUP, port=MULTICAST_PORT, feed_dir=FEED_DIR,
+                 name=None):
+        self.transport = transport
+        self.path = None
+        if transport == "multicast":
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Many subscribers on one port
+            self.sock.bind(("", port))
+            membership = struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton("0.0.0.0"))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            os.makedirs(feed_dir, exist_ok=True)
+            self.path = os.path.join(feed_dir, f"{name or os.getpid()}.sock")
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(self.path)
+        self.received = 0
+        self.missed = 0
+        self.last_seq = None
+
+    def receive(self, timeout=None):
+        """ Next message, or None after timeout seconds """
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(MESSAGE_SIZE)
+        except socket.timeout:
+            return None
+        message = decode_message(data)
+        if self.last_seq is not None and message.seq > self.last_seq + 1:
+            self.missed += message.seq - self.last_seq - 1
+        self.last_seq = message.seq
+        self.received += 1
+        return message
+
+    def close(self):
+        self.sock.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def create_feed(args):
+    """ Publisher for the --feed flag from common.runtime.parse_args """
+    return DetectionPublisher(args.feed) if args.feed else NullPublisher()
+
+
+def benchmark(transport, subscribers=4, frames=20000):
+    """ Publish cost per frame with a number of subscribers that never read """
+    Marker = namedtuple("Marker", ["marker_id", "center_x", "center_y", "width"])
+    detections = [Marker(i, 100 + i, 200, 55.5) for i in range(3)]
+    listeners = [DetectionSubscriber(transport, name=f"bench{i}") for i in range(subscribers)]
+    publisher = DetectionPublisher(transport)
+    for _ in range(frames):
+        publisher.publish(detections, 80.0, 12.5, 90)
+    print(publisher.report())
+    for listener in listeners:
+        listener.receive(timeout=0.5)
+        listener.close()
+    publisher.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Subscribe to the mission's detection feed")
+    parser.add_argument("--transport", default="multicast", choices=["multicast", "unix"])
+    parser.add_argument("--benchmark", action="store_true", help="measure the publish cost per frame")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.transport)
+    else:
+        subscriber = DetectionSubscriber(args.transport)
+        try:
+            while True:
+                message = subscriber.receive()
+                markers = ", ".join(f"{m.marker_id}@({m.center_x},{m.center_y})" for m in message.markers) or "-"
+                print(f"#{message.seq} h {message.height:.0f} cm yaw {message.yaw:.0f} battery {message.battery}% "
+                      f"markers {markers} (missed {subscriber.missed})")
+        except KeyboardInterrupt:
+            subscriber.close()
@@ -0,0 +1,281 @@
+import multiprocessing as mp
+import os
+import queue
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from common.aruco_detection import create_detector, detect_markers
+from common.frame_buffers import FrameBuffers
+
+# Fixed-size result record sent back from a worker for every frame:
+# header = stream index, frame sequence, marker count, capture time, done time
+# followed by MAX_MARKERS entries of (marker id, center x, center y, diagonal size)
+MAX_MARKERS = 8
+RECORD_HEADER = struct.Struct("<HIBxdd")
+RECORD_MARKER = struct.Struct("<hhhf")
+RECORD_SIZE = RECORD_HEADER.size + MAX_MARKERS * RECORD_MARKER.size
+
+# Slot states in the ring buffer
+SLOT_FREE = 0
+SLOT_BUSY = 1
+
+FrameResult = namedtuple("FrameResult", ["stream", "seq", "t_capture", "t_done", "markers"])
+MarkerRecord = namedtuple("MarkerRecord", ["marker_id", "center_x", "center_y", "size"])
+
+
+def attach_shared_memory(name, own_tracker=False):
+    """ Attach to an existing shared memory block without handing it to the resource tracker.
+        Only the process that created the block may unlink it.
+        own_tracker: this process was not started by multiprocessing (e.g. subprocess.Popen) and
+        runs its own tracker, which would unlink the block when the process exits. Workers started
+        by multiprocessing share the tracker of their parent and must not unregister the parent's block.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13 has no track argument
+        shm = shared_memory.SharedMemory(name=name)
+        if own_tracker:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _ring_views(buffer, slots, shape):
+    """ Numpy views on the frame slots and the slot state array of one ring """
+    frame_bytes = int(np.prod(shape))
+    frames = np.ndarray((slots,) + tuple(shape), dtype=np.uint8, buffer=buffer)
+    states = np.ndarray((slots,), dtype=np.int32, buffer=buffer, offset=slots * frame_bytes)
+    return frames, states
+
+
+def encode_record(stream_index, seq, t_capture, t_done, detections):
+    record = bytearray(RECORD_SIZE)
+    count = min(len(detections), MAX_MARKERS)
+    RECORD_HEADER.pack_into(record, 0, stream_index, seq, count, t_capture, t_done)
+    for i in range(count):
+        detection = detections[i]
+        RECORD_MARKER.pack_into(record, RECORD_HEADER.size + i * RECORD_MARKER.size,
+                                detection.marker_id, detection.center_x, detection.center_y, detection.size)
+    return bytes(record)
+
+
+def decode_record(record):
+    stream_index, seq, count, t_capture, t_done = RECORD_HEADER.unpack_from(record, 0)
+    markers = [MarkerRecord(*RECORD_MARKER.unpack_from(record, RECORD_HEADER.size + i * RECORD_MARKER.size))
+               for i in range(count)]
+    return FrameResult(stream_index, seq, t_capture, t_done, markers)
+
+
+def _worker(tasks, results, dictionary, corner_refinement, profile):
+    """ Worker process: read frames straight from shared memory and send back fixed-size records """
+    cv2.setNumThreads(1)  # One process per core, no nested OpenCV threads
+    detector = create_detector(dictionary, corner_refinement, profile)
+    buffers = FrameBuffers()
+    rings = {}  # Shared memory name -> (handle, frame views, state view)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        stream_index, name, slots, shape, slot, seq, t_capture = task
+
+        if name not in rings:
+            shm = attach_shared_memory(name)
+            rings[name] = (shm,) + _ring_views(shm.buf, slots, shape)
+        _, frames, states = rings[name]
+
+        # cvtColor reads the slot in place into a reused buffer, the frame itself is never copied or pickled
+        frame = frames[slot]
+        gray = buffers.gray(frame)
+        detections = detect_markers(detector, gray)
+        states[slot] = SLOT_FREE
+
+        results.put(encode_record(stream_index, seq, t_capture, time.monotonic(), detections))
+
+    # Drop every numpy view before closing the shared memory handles
+    frame = gray = frames = states = None
+    for name in list(rings):
+        shm = rings.pop(name)[0]
+        shm.close()
+
+
+class FrameStream(object):
+    """ One camera stream feeding the detection service through a shared memory ring """
+
+    def __init__(self, service, index, name, shape, slots):
+        self.service = service
+        self.index = index
+        self.name = name
+        self.shape = tuple(shape)
+        self.slots = slots
+
+        frame_bytes = int(np.prod(self.shape))
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * (frame_bytes + 4))
+        self.frames, self.states = _ring_views(self.shm.buf, slots, self.shape)
+        self.states[:] = SLOT_FREE
+
+        self.next_slot = 0
+        self.seq = 0
+        self.submitted = 0
+        self.dropped = 0
+
+        # Filled by the result collector thread
+        self.latest = None
+        self.done_times = deque(maxlen=120)
+        self.latencies = deque(maxlen=500)
+
+    def submit(self, frame):
+        """ Queue a frame for detection. Returns the sequence number, or None if the ring was full """
+        if frame.shape != self.shape:
+            raise ValueError(f"Stream {self.name} expects frames of shape {self.shape}, got {frame.shape}")
+
+        slot = self.next_slot
+        if self.states[slot] != SLOT_FREE:
+            # Workers are behind: drop this frame instead of blocking the camera loop
+            self.dropped += 1
+            return None
+
+        t_capture = time.monotonic()
+        np.copyto(self.frames[slot], frame)
+        self.states[slot] = SLOT_BUSY
+        self.seq += 1
+        self.submitted += 1
+        self.next_slot = (slot + 1) % self.slots
+
+        self.service.tasks.put((self.index, self.shm.name, self.slots, self.shape, slot, self.seq, t_capture))
+        return self.seq
+
+    def fps(self):
+        """ Detection rate over the recent result window """
+        if len(self.done_times) < 2:
+            return 0.0
+        span = self.done_times[-1] - self.done_times[0]
+        return (len(self.done_times) - 1) / span if span > 0 else 0.0
+
+    def latency_ms(self, percentile):
+        if not self.latencies:
+            return 0.0
+        return float(np.percentile(self.latencies, percentile)) * 1000
+
+    def close(self):
+        del self.frames, self.states
+        self.shm.close()
+        self.shm.unlink()
+
+
+class DetectionService(object):
+    """ Runs detectMarkers for several camera streams on a pool of worker processes.
+        Frames go through one shared memory ring per stream, workers only receive the slot
+        number and send back fixed-size records. Use one worker per core by default.
+        The workers are spawned, which imports the __main__ module again in every worker: a script
+        that starts the service must keep its mission code under `if __name__ == '__main__':`,
+        the mission scripts in Floor/ and Wall/ do not yet.
+    """
+
+    def __init__(self, dictionary="DICT_6X6_250", corner_refinement=False, workers=None, slots=4, profile=None):
+        self.dictionary = dictionary
+        self.corner_refinement = corner_refinement
+        self.profile = profile
+        self.worker_count = workers or os.cpu_count() or 1
+        self.slots = slots
+
+        context = mp.get_context("spawn")
+        self.context = context
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.workers = []
+        self.streams = []
+        self.collector = None
+        self.running = False
+
+    def add_stream(self, name, shape, slots=None):
+        stream = FrameStream(self, len(self.streams), name, shape, slots or self.slots)
+        self.streams.append(stream)
+        return stream
+
+    def start(self):
+        self.running = True
+        for _ in range(self.worker_count):
+            worker = self.context.Process(target=_worker,
+                                          args=(self.tasks, self.results, self.dictionary,
+                                                self.corner_refinement, self.profile),
+                                          daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def _collect(self):
+        """ Collector thread: decode result records and update per-stream statistics """
+        while self.running:
+            try:
+                record = self.results.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            result = decode_record(record)
+            stream = self.streams[result.stream]
+            stream.done_times.append(result.t_done)
+            stream.latencies.append(time.monotonic() - result.t_capture)
+            if stream.latest is None or result.seq > stream.latest.seq:
+                stream.latest = result
+
+    def report(self):
+        """ Per-stream FPS and end-to-end latency (submit to result received) """
+        lines = []
+        for stream in self.streams:
+            lines.append(f"{stream.name}: {stream.fps():5.1f} fps, latency p50 {stream.latency_ms(50):6.1f} ms, "
+                         f"p95 {stream.latency_ms(95):6.1f} ms, dropped {stream.dropped}/{stream.submitted + stream.dropped}")
+        return "\n".join(lines)
+
+    def stop(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=2)
+        self.running = False
+        if self.collector is not None:
+            self.collector.join(timeout=1)
+        for stream in self.streams:
+            stream.close()
+
+
+# --- Benchmark -------------------------------------------------------------------------
+# Run from the ArucoTagScripts folder: python -m common.detection_pool
+
+def benchmark(stream_count=4, rate=30, duration=5.0):
+    from common.frame_quality import _synthetic_frame
+
+    aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
+    frame = _synthetic_frame(np.random.default_rng(0), aruco_dict)
+
+    worker_counts = sorted({1, max(1, (os.cpu_count() or 1) // 2), os.cpu_count() or 1})
+    for workers in worker_counts:
+        service = DetectionService(workers=workers)
+        streams = [service.add_stream(f"stream{i}", frame.shape) for i in range(stream_count)]
+        service.start()
+        time.sleep(1.0)  # Let the workers import OpenCV
+
+        period = 1.0 / rate
+        next_time = time.monotonic()
+        end_time = next_time + duration
+        while time.monotonic() < end_time:
+            for stream in streams:
+                stream.submit(frame)
+            next_time += period
+            time.sleep(max(0.0, next_time - time.monotonic()))
+
+        time.sleep(0.5)
+        print(f"--- {workers} workers, {stream_count} streams at {rate} fps")
+        print(service.report())
+        service.stop()
+
+
+if __name__ == '__main__':
+    benchmark()
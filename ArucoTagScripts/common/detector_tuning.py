@@ -0,0 +1,291 @@
+import argparse
+import csv
+import json
+import multiprocessing as mp
+import os
+import random
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from common.aruco_detection import CORNER_REFINEMENT, DICTIONARIES, PROFILES_PATH, detector_from_profile
+
+# Offline autotuner for the ArUco detector settings.
+#
+# A corpus is a folder of frames plus labels.csv with one row per labelled marker:
+#     image,marker_id,center_x,center_y
+# Frames without any marker get one row with marker_id -1 so they still count for false positives.
+# Run from the ArucoTagScripts folder, e.g. for the forward and the downward camera:
+#     python -m common.detector_tuning --corpus corpus/forward --resolution 960x720 --ids 0 1 2 3 --name forward_960x720
+#     python -m common.detector_tuning --corpus corpus/down --resolution 320x240 --ids 0 1 2 3 --name down_320x240
+# --synthetic N first writes N generated frames into the corpus folder, for trying it out without footage.
+# The Pareto front (recall vs ms/frame) goes to <corpus>/pareto_<name>.csv and three profiles
+# <name>_fast, <name>_balanced and <name>_robust are stored for create_detector(profile=...).
+
+# Search space, one value per setting is drawn for each candidate
+SEARCH_SPACE = {
+    "win_size_min": [3, 5, 7],
+    "win_size_max": [15, 23, 33, 53],
+    "win_size_step": [4, 10, 20],
+    "min_perimeter_rate": [0.01, 0.02, 0.03, 0.05],
+    "max_perimeter_rate": [2.0, 4.0],
+    "polygon_accuracy": [0.03, 0.05, 0.08],
+    "corner_refinement": list(CORNER_REFINEMENT),
+}
+
+LABELS_FILE = "labels.csv"
+MATCH_TOLERANCE = 0.02  # Detected centre within this share of the frame width counts as a hit
+
+Result = namedtuple("Result", ["profile", "recall", "false_per_frame", "ms_per_frame"])
+
+_corpus = None  # Frames and labels of the worker process
+
+
+def parse_resolution(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def load_corpus(folder, resolution):
+    """ Grayscale frames at resolution=(width, height) with their labels scaled to match """
+    labels = {}
+    with open(os.path.join(folder, LABELS_FILE), newline="") as labels_file:
+        for row in csv.DictReader(labels_file):
+            markers = labels.setdefault(row["image"], [])
+            if int(row["marker_id"]) >= 0:
+                markers.append((int(row["marker_id"]), float(row["center_x"]), float(row["center_y"])))
+
+    corpus = []
+    for image, markers in sorted(labels.items()):
+        gray = cv2.imread(os.path.join(folder, image), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            print(f"Skipping unreadable frame {image}")
+            continue
+        scale_x = resolution[0] / gray.shape[1]
+        scale_y = resolution[1] / gray.shape[0]
+        if gray.shape[1] != resolution[0] or gray.shape[0] != resolution[1]:
+            gray = cv2.resize(gray, resolution, interpolation=cv2.INTER_AREA)
+        corpus.append((gray, [(marker_id, x * scale_x, y * scale_y) for marker_id, x, y in markers]))
+    return corpus
+
+
+def _init_worker(folder, resolution):
+    global _corpus
+    # One thread per process, the pool already uses every core and the timings stay comparable
+    cv2.setNumThreads(1)
+    _corpus = load_corpus(folder, resolution)
+
+
+def evaluate(profile):
+    """ Recall, false positives per frame and mean detection time of one profile on the worker's corpus """
+    detector = detector_from_profile(profile)
+    detector.detectMarkers(_corpus[0][0])  # Warm up
+
+    labelled = found = false = 0
+    seconds = 0.0
+    for gray, markers in _corpus:
+        start = time.perf_counter()
+        corners, ids, _ = detector.detectMarkers(gray)
+        seconds += time.perf_counter() - start
+
+        tolerance = MATCH_TOLERANCE * gray.shape[1]
+        unmatched = list(markers)
+        labelled += len(markers)
+        if ids is None:
+            continue
+        for marker_corners, marker_id in zip(corners, ids.flatten()):
+            center = marker_corners[0].mean(axis=0)
+            hit = next((label for label in unmatched if label[0] == marker_id
+                        and abs(label[1] - center[0]) < tolerance and abs(label[2] - center[1]) < tolerance), None)
+            if hit is None:
+                false += 1
+            else:
+                unmatched.remove(hit)
+                found += 1
+
+    return Result(profile, found / labelled if labelled else 1.0, false / len(_corpus),
+                  seconds / len(_corpus) * 1000)
+
+
+def candidate_profiles(dictionary, marker_ids, count, seed=0):
+    """ The settings the mission scripts use today, followed by count random draws from SEARCH_SPACE """
+    rng = random.Random(seed)
+    profiles = [
+        {"dictionary": dictionary, "corner_refinement": "none"},
+        {"dictionary": dictionary, "corner_refinement": "subpix"},
+    ]
+    seen = set()
+    while len(profiles) < count + 2:
+        profile = {name: rng.choice(values) for name, values in SEARCH_SPACE.items()}
+        if profile["win_size_max"] < profile["win_size_min"]:
+            continue
+        profile["dictionary"] = dictionary
+        # Half the candidates use a dictionary reduced to the deployed IDs
+        if marker_ids and rng.random() < 0.5:
+            profile["marker_ids"] = list(marker_ids)
+        key = json.dumps(profile, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            profiles.append(profile)
+    return profiles
+
+
+def pareto_front(results, max_false_per_frame):
+    """ Results nobody beats on both recall and speed, fastest first """
+    front = []
+    best_recall = -1.0
+    for result in sorted(results, key=lambda r: (r.ms_per_frame, -r.recall)):
+        if result.false_per_frame > max_false_per_frame:
+            continue
+        if result.recall > best_recall:
+            front.append(result)
+            best_recall = result.recall
+    return front
+
+
+def pick_profiles(front, name):
+    """ Named profiles from the front: the most robust one and the fastest within 1% and 5% recall of it """
+    robust = max(front, key=lambda r: (r.recall, -r.ms_per_frame))
+    balanced = next(r for r in front if r.recall >= robust.recall - 0.01)
+    fast = next(r for r in front if r.recall >= robust.recall - 0.05)
+    return {f"{name}_fast": fast, f"{name}_balanced": balanced, f"{name}_robust": robust}
+
+
+def save_profiles(picked, resolution, path=PROFILES_PATH):
+    """ Merge the picked profiles into the profiles file next to aruco_detection.py """
+    profiles = {}
+    if os.path.exists(path):
+        with open(path) as profiles_file:
+            profiles = json.load(profiles_file)
+    for name, result in picked.items():
+        profiles[name] = dict(result.profile, resolution=f"{resolution[0]}x{resolution[1]}",
+                              recall=round(result.recall, 4), ms_per_frame=round(result.ms_per_frame, 3))
+    with open(path, "w") as profiles_file:
+        json.dump(profiles, profiles_file, indent=2, sort_keys=True)
+
+
+def write_front(front, path):
+    with open(path, "w", newline="") as front_file:
+        writer = csv.writer(front_file)
+        writer.writerow(["recall", "false_per_frame", "ms_per_frame", "profile"])
+        for result in front:
+            writer.writerow([f"{result.recall:.4f}", f"{result.false_per_frame:.4f}", f"{result.ms_per_frame:.3f}",
+                             json.dumps(result.profile, sort_keys=True)])
+
+
+def tune(folder, resolution, dictionary, marker_ids, name, candidates=200, workers=None, max_false_per_frame=0.02):
+    profiles = candidate_profiles(dictionary, marker_ids, candidates)
+    workers = workers or os.cpu_count() or 1
+    print(f"Evaluating {len(profiles)} detector settings on {workers} processes...")
+
+    start = time.perf_counter()
+    context = mp.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker, initargs=(folder, resolution)) as pool:
+        results = pool.map(evaluate, profiles, chunksize=1)
+    print(f"Done in {time.perf_counter() - start:.1f} s")
+
+    for label, result in (("defaults", results[0]), ("defaults + subpix", results[1])):
+        print(f"{label:18s}: recall {result.recall:.3f}, {result.false_per_frame:.3f} false/frame, "
+              f"{result.ms_per_frame:.2f} ms/frame")
+
+    front = pareto_front(results, max_false_per_frame)
+    if not front:
+        print(f"No setting stays below {max_false_per_frame} false detections per frame")
+        return None
+    write_front(front, os.path.join(folder, f"pareto_{name}.csv"))
+
+    picked = pick_profiles(front, name)
+    save_profiles(picked, resolution)
+    for profile_name, result in picked.items():
+        print(f"{profile_name:28s}: recall {result.recall:.3f}, {result.false_per_frame:.3f} false/frame, "
+              f"{result.ms_per_frame:.2f} ms/frame")
+    return picked
+
+
+def make_synthetic_corpus(folder, count, resolution, dictionary="DICT_6X6_250", marker_ids=(0, 1, 2, 3), seed=0):
+    """ Frames with up to four tilted, blurred, JPEG-degraded markers on a textured background """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    aruco_dict = cv2.aruco.getPredefinedDictionary(DICTIONARIES[dictionary])
+    width, height = resolution
+    rows = []
+
+    for index in range(count):
+        frame = rng.integers(60, 200, size=(height // 6, width // 6), dtype=np.uint8)
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_LINEAR)
+        image = f"frame_{index:05d}.png"
+
+        # One marker at most per quadrant so they never overlap
+        placed = 0
+        for cell_x, cell_y in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            if rng.random() < 0.45:
+                continue
+            marker_id = int(rng.choice(marker_ids))
+            side = 200
+            marker = cv2.aruco.generateImageMarker(aruco_dict, marker_id, side)
+            marker = cv2.copyMakeBorder(marker, 20, 20, 20, 20, cv2.BORDER_CONSTANT, value=255)
+
+            # Random size, position, rotation and perspective inside the quadrant
+            cell_w, cell_h = width / 2, height / 2
+            target = rng.uniform(0.08, 0.7) * min(cell_w, cell_h)
+            center = np.array([(cell_x + 0.5) * cell_w, (cell_y + 0.5) * cell_h])
+            center += rng.uniform(-0.5, 0.5, 2) * (np.array([cell_w, cell_h]) - target)
+            angle = rng.uniform(0, 2 * np.pi)
+            rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+            square = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float64) * target / 2
+            quad = square @ rotation.T + center + rng.normal(0, target * 0.06, (4, 2))
+
+            source = np.array([[0, 0], [marker.shape[1], 0], [marker.shape[1], marker.shape[0]],
+                               [0, marker.shape[0]]], dtype=np.float32)
+            homography = cv2.getPerspectiveTransform(source, quad.astype(np.float32))
+            warped = cv2.warpPerspective(marker, homography, (width, height), borderValue=0)
+            mask = cv2.warpPerspective(np.full(marker.shape, 255, np.uint8), homography, (width, height))
+            frame[mask > 0] = warped[mask > 0]
+
+            # The label is the centre of the marker itself, without its white border
+            inner = np.array([[[20, 20], [20 + side, 20], [20 + side, 20 + side], [20, 20 + side]]],
+                             dtype=np.float32)
+            inner = cv2.perspectiveTransform(inner, homography)[0]
+            x, y = inner.mean(axis=0)
+            rows.append((image, marker_id, f"{x:.1f}", f"{y:.1f}"))
+            placed += 1
+
+        if not placed:
+            rows.append((image, -1, "", ""))
+
+        # Motion blur on some frames, JPEG blocking on all of them like the H.264 stream
+        if rng.random() < 0.3:
+            length = int(rng.integers(3, 15))
+            kernel = np.zeros((length, length), dtype=np.float32)
+            kernel[length // 2, :] = 1.0 / length
+            frame = cv2.filter2D(frame, -1, kernel)
+        _, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(25, 70))])
+        cv2.imwrite(os.path.join(folder, image), cv2.imdecode(encoded, cv2.IMREAD_GRAYSCALE))
+
+    with open(os.path.join(folder, LABELS_FILE), "w", newline="") as labels_file:
+        writer = csv.writer(labels_file)
+        writer.writerow(["image", "marker_id", "center_x", "center_y"])
+        writer.writerows(rows)
+    print(f"Wrote {count} synthetic frames to {folder}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tune ArUco detector settings on a labelled corpus")
+    parser.add_argument("--corpus", required=True, help="folder with the frames and labels.csv")
+    parser.add_argument("--resolution", default="960x720", help="960x720 forward camera, 320x240 downward camera")
+    parser.add_argument("--dictionary", default="DICT_6X6_250", choices=sorted(DICTIONARIES))
+    parser.add_argument("--ids", type=int, nargs="*", default=[0, 1, 2, 3], help="deployed marker IDs")
+    parser.add_argument("--name", help="profile name prefix, default <resolution>")
+    parser.add_argument("--candidates", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-false", type=float, default=0.02, help="allowed false detections per frame")
+    parser.add_argument("--synthetic", type=int, default=0, help="generate this many labelled frames first")
+    args = parser.parse_args()
+
+    resolution = parse_resolution(args.resolution)
+    if args.synthetic:
+        make_synthetic_corpus(args.corpus, args.synthetic, resolution, args.dictionary, args.ids)
+    tune(args.corpus, resolution, args.dictionary, args.ids, args.name or args.resolution,
+         args.candidates, args.workers, args.max_false)
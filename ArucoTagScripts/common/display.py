@@ -0,0 +1,197 @@
+import os
+import struct
+import subprocess
+import sys
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from common.aruco_detection import Detection
+from common.detection_pool import attach_shared_memory
+
+# Shared memory layout between the mission and the viewer process:
+#   header:  sequence (odd while a frame is being written), height, width, marker count, text length
+#   control: quit flag (set by the viewer on 'q'), closed flag (set by the mission)
+#   markers: MAX_MARKERS x (id, 4 corners as x/y float32)
+#   text:    overlay text like the battery level, utf-8
+#   frame:   MAX_HEIGHT x MAX_WIDTH x 3 bytes
+MAX_MARKERS = 16
+MAX_TEXT = 256
+MAX_HEIGHT = 720
+MAX_WIDTH = 960
+HEADER = struct.Struct("<QHHHH")
+MARKER = struct.Struct("<i8f")
+CONTROL_OFFSET = HEADER.size
+QUIT = CONTROL_OFFSET
+CLOSED = CONTROL_OFFSET + 1
+MARKERS_OFFSET = CONTROL_OFFSET + 2
+TEXT_OFFSET = MARKERS_OFFSET + MAX_MARKERS * MARKER.size
+FRAME_OFFSET = TEXT_OFFSET + MAX_TEXT
+SHM_SIZE = FRAME_OFFSET + MAX_HEIGHT * MAX_WIDTH * 3
+
+
+def draw_overlay(frame, detections, text):
+    """ Draw the detected markers and the overlay text into frame """
+    if detections:
+        cv2.aruco.drawDetectedMarkers(frame, [np.asarray(d.corners, dtype=np.float32).reshape(1, 4, 2)
+                                              for d in detections],
+                                      np.array([[d.marker_id] for d in detections], dtype=np.int32))
+    if text:
+        cv2.putText(frame, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+
+
+class _Timed(object):
+    """ Keeps track of the time the control thread spends in the display """
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+    def add(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        self.worst = max(self.worst, seconds)
+
+    def summary(self):
+        mean = self.total / self.calls * 1000 if self.calls else 0.0
+        return f"{type(self).__name__}: {mean:.2f} ms mean, {self.worst * 1000:.2f} ms worst per frame on the control thread"
+
+
+class InlineDisplay(_Timed):
+    """ The original behaviour: draw and imshow on the control thread """
+
+    def __init__(self, window_name):
+        super().__init__()
+        self.window_name = window_name
+        self.stopped = False
+
+    def show(self, frame, detections=(), text=None):
+        start = time.perf_counter()
+        if frame is not None:
+            draw_overlay(frame, detections, text)
+            cv2.imshow(self.window_name, frame)
+        # Press 'q' to stop the mission manually
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            self.stopped = True
+        self.add(time.perf_counter() - start)
+
+    def stop_requested(self):
+        return self.stopped
+
+    def close(self):
+        cv2.destroyAllWindows()
+
+
+class HeadlessDisplay(_Timed):
+    """ No GUI work at all """
+
+    def show(self, frame, detections=(), text=None):
+        pass
+
+    def stop_requested(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def run_viewer(name, window_name, parent_pid):
+    """ Viewer process: copy the newest frame out of shared memory, draw the overlays, show it """
+    shm = attach_shared_memory(name, own_tracker=True)  # Started with Popen, not by multiprocessing
+    buffer = shm.buf
+    last_seq = 0
+    # Stop when the mission closes the display or dies without doing so
+    while not buffer[CLOSED] and os.getppid() == parent_pid:
+        seq, height, width, count, text_length = HEADER.unpack_from(buffer, 0)
+        if seq != last_seq and seq % 2 == 0 and height and width:
+            frame = np.ndarray((height, width, 3), dtype=np.uint8, buffer=buffer, offset=FRAME_OFFSET).copy()
+            markers = [MARKER.unpack_from(buffer, MARKERS_OFFSET + i * MARKER.size) for i in range(count)]
+            text = bytes(buffer[TEXT_OFFSET:TEXT_OFFSET + text_length]).decode("utf-8", "replace")
+            # The mission may have started the next frame meanwhile, then this copy is torn
+            if HEADER.unpack_from(buffer, 0)[0] == seq:
+                last_seq = seq
+                detections = [Detection(marker[0], 0, 0, 0.0, 0.0, 0.0, np.array(marker[1:]).reshape(4, 2))
+                              for marker in markers]
+                draw_overlay(frame, detections, text)
+                cv2.imshow(window_name, frame)
+        if cv2.waitKey(15) & 0xFF == ord('q'):
+            buffer[QUIT] = 1
+    cv2.destroyAllWindows()
+    buffer = None
+    shm.close()
+
+
+class ViewerDisplay(_Timed):
+    """ Hands frames and detection records to a separate viewer process through shared memory.
+        The control thread only copies the frame into the shared block, drawing, imshow and
+        waitKey all happen in the viewer. The viewer is started as `python -m common.display`
+        rather than through multiprocessing, which would re-run the mission script in the child.
+    """
+
+    def __init__(self, window_name):
+        super().__init__()
+        self.shm = shared_memory.SharedMemory(create=True, size=SHM_SIZE)
+        self.shm.buf[:MARKERS_OFFSET] = bytes(MARKERS_OFFSET)
+        self.seq = 0
+        package_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        self.process = subprocess.Popen([sys.executable, "-m", "common.display", self.shm.name, window_name,
+                                         str(os.getpid())], cwd=package_root)
+
+    def show(self, frame, detections=(), text=None):
+        start = time.perf_counter()
+        if frame is not None:
+            buffer = self.shm.buf
+            height, width = frame.shape[:2]
+            height, width = min(height, MAX_HEIGHT), min(width, MAX_WIDTH)
+
+            self.seq += 1  # Odd: frame is being written
+            struct.pack_into("<Q", buffer, 0, self.seq)
+            target = np.ndarray((height, width, 3), dtype=np.uint8, buffer=buffer, offset=FRAME_OFFSET)
+            if frame.ndim == 2:
+                cv2.cvtColor(frame[:height, :width], cv2.COLOR_GRAY2BGR, dst=target)
+            else:
+                np.copyto(target, frame[:height, :width])
+            count = min(len(detections), MAX_MARKERS)
+            for i in range(count):
+                corners = np.asarray(detections[i].corners, dtype=np.float32).reshape(8)
+                MARKER.pack_into(buffer, MARKERS_OFFSET + i * MARKER.size, detections[i].marker_id, *corners)
+            encoded = (text or "").encode("utf-8")[:MAX_TEXT]
+            buffer[TEXT_OFFSET:TEXT_OFFSET + len(encoded)] = encoded
+            self.seq += 1  # Even: frame complete
+            HEADER.pack_into(buffer, 0, self.seq, height, width, count, len(encoded))
+            del target
+        self.add(time.perf_counter() - start)
+
+    def stop_requested(self):
+        return bool(self.shm.buf[QUIT])
+
+    def close(self):
+        self.shm.buf[CLOSED] = 1
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.shm.close()
+        self.shm.unlink()
+
+
+def create_display(args, window_name="Tello Camera Feed"):
+    """ Pick the display for the runtime flags from common.runtime.parse_args """
+    if args.viewer:
+        display = ViewerDisplay(window_name)
+    elif args.headless:
+        display = HeadlessDisplay()
+    else:
+        display = InlineDisplay(window_name)
+    if args.preview:
+        from common.preview_server import PreviewDisplay  # Imports this module
+        display = PreviewDisplay(display, args.preview)
+    return display
+
+
+if __name__ == '__main__':
+    # Started by ViewerDisplay: shared memory name, window name, pid of the mission
+    run_viewer(sys.argv[1], sys.argv[2], int(sys.argv[3]))
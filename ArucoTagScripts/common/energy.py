@@ -0,0 +1,183 @@
+import csv
+import os
+import time
+
+import numpy as np
+
+# Default model for a Tello with a healthy battery, used until a battery log has been fitted.
+# About 13 minutes of hover from 100% gives roughly 0.13% per second in the air.
+DEFAULT_HOVER_RATE = 0.13  # % per second airborne
+DEFAULT_MOVE_RATE = 0.004  # % per cm on top of hovering
+DEFAULT_DRAG_RATE = 0.002  # % per cm per (speed / 100 cm/s)^2
+DEFAULT_ROTATE_RATE = 0.002  # % per degree on top of hovering
+ROTATE_SPEED = 60.0  # deg/s the Tello turns at
+SETTLE_TIME = 1.5  # s for acceleration and settling around every command
+SPEED_CHOICES = (20, 30, 40, 50, 60, 80, 100)  # cm/s allowed by set_speed (10-100)
+
+# Next to this file like the camera calibration, so every script reads and extends the same log
+# whatever folder it is started from
+BATTERY_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "battery_log.csv")
+
+MOVE_COMMANDS = ('move_forward', 'move_back', 'move_left', 'move_right', 'move_up', 'move_down')
+ROTATE_COMMANDS = ('rotate_clockwise', 'rotate_counter_clockwise')
+LOGGED_COMMANDS = MOVE_COMMANDS + ROTATE_COMMANDS + ('set_speed',)  # Everything the EnergyModel charges for
+
+
+class BatteryLogger(object):
+    """ Logs the battery drop of every flight command to a CSV file for fitting the EnergyModel.
+        The battery level comes from the state stream, so logging adds no extra commands.
+    """
+
+    FIELDS = ['time', 'command', 'amount', 'speed', 'duration', 'battery_before', 'battery_after']
+
+    def __init__(self, tello, path=BATTERY_LOG_PATH):
+        self.tello = tello
+        self.path = path
+        self.speed = 100  # Tello default until set_speed is called
+        new_file = not os.path.exists(path)
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(self.FIELDS)
+
+    def run(self, command, amount=0):
+        """ Run a Tello command like tello.<command>(amount) and log its battery drop """
+        battery_before = self.tello.get_battery()
+        start = time.time()
+        method = getattr(self.tello, command)
+        result = method(amount) if amount else method()
+        duration = time.time() - start
+        if command == 'set_speed':
+            self.speed = amount
+        self.writer.writerow([f"{start:.3f}", command, amount, self.speed, f"{duration:.3f}",
+                              battery_before, self.tello.get_battery()])
+        self.file.flush()
+        return result
+
+    def wrap(self):
+        """ The Tello to use for the rest of the mission, every move and rotation is logged """
+        return LoggedTello(self.tello, self)
+
+    def close(self):
+        self.file.close()
+
+
+class LoggedTello(object):
+    """ Stands in for the Tello in the mission scripts. Moves, rotations and set_speed go through
+        BatteryLogger.run, everything else goes straight to the Tello.
+    """
+
+    def __init__(self, tello, logger):
+        self._tello = tello
+        self._logger = logger
+
+    def __getattr__(self, name):
+        if name in LOGGED_COMMANDS:
+            def command(amount=0):
+                return self._logger.run(name, amount)
+            return command
+        return getattr(self._tello, name)
+
+
+class EnergyModel(object):
+    """ Predicts battery drop (in %) per command from hover time, distance and speed """
+
+    def __init__(self, hover_rate=DEFAULT_HOVER_RATE, move_rate=DEFAULT_MOVE_RATE,
+                 drag_rate=DEFAULT_DRAG_RATE, rotate_rate=DEFAULT_ROTATE_RATE):
+        self.hover_rate = hover_rate
+        self.move_rate = move_rate
+        self.drag_rate = drag_rate
+        self.rotate_rate = rotate_rate
+
+    @classmethod
+    def fit_from_log(cls, path=BATTERY_LOG_PATH):
+        """ Least-squares fit of the model coefficients to a BatteryLogger CSV.
+            Falls back to the defaults if there are too few samples.
+        """
+        if not os.path.exists(path):
+            return cls()
+
+        rows = []
+        targets = []
+        with open(path, newline='') as log_file:
+            for row in csv.DictReader(log_file):
+                command = row['command']
+                amount = float(row['amount'])
+                speed = float(row['speed'])
+                duration = float(row['duration'])
+                drop = float(row['battery_before']) - float(row['battery_after'])
+                if command in MOVE_COMMANDS:
+                    rows.append([duration, amount, amount * (speed / 100.0) ** 2, 0.0])
+                elif command in ROTATE_COMMANDS:
+                    rows.append([duration, 0.0, 0.0, amount])
+                else:
+                    continue
+                targets.append(drop)
+
+        # Battery percentages are integers, so many samples are needed before a fit is meaningful
+        if len(rows) < 20:
+            return cls()
+
+        coefficients, _, _, _ = np.linalg.lstsq(np.array(rows), np.array(targets), rcond=None)
+        defaults = (DEFAULT_HOVER_RATE, DEFAULT_MOVE_RATE, DEFAULT_DRAG_RATE, DEFAULT_ROTATE_RATE)
+        # Negative coefficients are noise from the 1% resolution, keep the default for those
+        values = [c if c > 0 else d for c, d in zip(coefficients, defaults)]
+        return cls(*values)
+
+    def move_cost(self, distance, speed):
+        """ Battery drop for one straight move of distance cm at speed cm/s """
+        duration = distance / speed + SETTLE_TIME
+        return (self.hover_rate * duration + self.move_rate * distance
+                + self.drag_rate * distance * (speed / 100.0) ** 2)
+
+    def rotate_cost(self, degrees):
+        duration = abs(degrees) / ROTATE_SPEED + SETTLE_TIME
+        return self.hover_rate * duration + self.rotate_rate * abs(degrees)
+
+    def hover_cost(self, seconds):
+        return self.hover_rate * seconds
+
+    def best_speed(self, distance):
+        """ Cruise speed with the lowest battery drop for a leg """
+        return min(SPEED_CHOICES, key=lambda speed: self.move_cost(distance, speed))
+
+    def command_cost(self, command, amount, speed=100):
+        if command in MOVE_COMMANDS:
+            return self.move_cost(amount, speed)
+        if command in ROTATE_COMMANDS or command in ('rotate_cw', 'rotate_ccw'):
+            return self.rotate_cost(amount)
+        return 0.0
+
+    def log_cost(self, flight_log):
+        """ Battery drop to replay a list of (command, value) entries like the flight_log in mainFlightBack """
+        return sum(self.command_cost(command, value, self.best_speed(value) if command == 'move_forward' else 100)
+                   for command, value in flight_log)
+
+
+class MissionScheduler(object):
+    """ Decides when to go home with the current battery.
+        reserve is the battery (%) that must be left after landing at home.
+        service_time is the hover time spent at every station.
+    """
+
+    def __init__(self, model, reserve=15.0, service_time=5.0, landing_cost=1.0, turn_degrees=90):
+        self.model = model
+        self.reserve = reserve
+        self.service_time = service_time
+        self.landing_cost = landing_cost
+        self.turn_degrees = turn_degrees
+
+    def leg_cost(self, distance):
+        return (self.model.move_cost(distance, self.model.best_speed(distance))
+                + self.model.rotate_cost(self.turn_degrees))
+
+    def station_cost(self, distance):
+        return self.leg_cost(distance) + self.model.hover_cost(self.service_time)
+
+    def should_return(self, battery, next_leg_distance, return_cost_after):
+        """ True if flying the next leg and servicing the station would leave too little
+            battery for the return home. return_cost_after is the predicted cost of the
+            return flight from the next station.
+        """
+        needed = self.station_cost(next_leg_distance) + return_cost_after + self.landing_cost
+        return battery - needed < self.reserve
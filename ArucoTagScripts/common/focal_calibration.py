@@ -0,0 +1,220 @@
+import argparse
+import csv
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from common.aruco_detection import create_detector, detect_markers
+from common.frame_buffers import FrameBuffers
+from common.wall_alignment import FORWARD_FOCAL_PX
+
+# Per-drone focal length calibration from marker widths at known distances.
+#
+# Model, with the width scaled to the native frame width and r the distance of the marker
+# center from the image center in half frame widths:
+#
+#     distance = focal_px * marker_size / width * (1 + radial * r^2) - offset_cm
+#
+# radial takes up the lens distortion (markers near the edge look larger or smaller than the
+# pinhole model says) and offset_cm the distance between the reference the tape was measured
+# from and the camera. The model is linear in (focal_px, focal_px * radial, offset_cm) and is
+# fitted by iteratively reweighted least squares with Huber weights, so frames with a bad
+# detection do not pull the fit.
+#
+# Results are stored per drone, keyed by the serial number the drone reports to `sn?`, and
+# load_calibration(tello) picks them up after connect. Drones without a profile get the
+# defaults below. Collect samples with ArucoTag/getSize.py --calibrate, refit saved samples
+# from the ArucoTagScripts folder with:
+#     python -m common.focal_calibration calibration_samples.csv --serial 0TQZK7xxxx --marker-size 20
+
+CALIBRATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "camera_calibration.json")
+
+# Native frame widths and default focal lengths of the two cameras
+DEFAULTS = {"forward": (960, FORWARD_FOCAL_PX), "downward": (320, 220.0)}
+
+HUBER_K = 1.345  # Huber tuning constant in robust standard deviations
+SAMPLE_FIELDS = ["camera", "distance", "width", "center_x", "center_y", "frame_width", "frame_height"]
+
+
+class CameraCalibration(object):
+    """ Focal length, radial correction and distance offset of one camera of one drone """
+
+    def __init__(self, camera, focal_px, radial=0.0, offset_cm=0.0, width=None, rms_cm=None, samples=0,
+                 serial=None):
+        self.camera = camera
+        self.focal_px = focal_px
+        self.radial = radial
+        self.offset_cm = offset_cm
+        self.width = width or DEFAULTS[camera][0]
+        self.rms_cm = rms_cm
+        self.samples = samples
+        self.serial = serial
+
+    def corrected_width(self, width_px, center_x, center_y, frame_width, frame_height):
+        """ Marker width in pixels of the native frame width, with the radial correction applied """
+        scale = self.width / frame_width
+        r = math.hypot(center_x - frame_width / 2, center_y - frame_height / 2) / (frame_width / 2)
+        return width_px * scale / (1 + self.radial * r * r)
+
+    def distance(self, marker_size, width_px, center_x, center_y, frame_width, frame_height):
+        """ Distance in cm to a marker of marker_size cm """
+        width = self.corrected_width(width_px, center_x, center_y, frame_width, frame_height)
+        return self.focal_px * marker_size / width - self.offset_cm
+
+    def to_dict(self):
+        return {"focal_px": self.focal_px, "radial": self.radial, "offset_cm": self.offset_cm, "width": self.width,
+                "rms_cm": self.rms_cm, "samples": self.samples, "date": time.strftime("%Y-%m-%d")}
+
+    def __repr__(self):
+        source = f"drone {self.serial}" if self.serial else "default"
+        return (f"{self.camera} camera ({source}): focal {self.focal_px:.1f} px at {self.width} px width, "
+                f"radial {self.radial:+.3f}, offset {self.offset_cm:+.1f} cm")
+
+
+def fit_calibration(samples, marker_size, camera="forward", iterations=20):
+    """ Robust fit of a CameraCalibration to (distance, width, center_x, center_y, frame_width, frame_height) """
+    native_width = DEFAULTS[camera][0]
+    rows = []
+    targets = []
+    for distance, width, center_x, center_y, frame_width, frame_height in samples:
+        inverse = marker_size / (width * native_width / frame_width)
+        r = math.hypot(center_x - frame_width / 2, center_y - frame_height / 2) / (frame_width / 2)
+        rows.append([inverse, inverse * r * r, -1.0])
+        targets.append(distance)
+    a = np.array(rows)
+    b = np.array(targets, dtype=np.float64)
+    if len(b) < 10:
+        raise ValueError(f"Only {len(b)} samples, need at least 10 over several distances")
+
+    weights = np.ones(len(b))
+    for _ in range(iterations):
+        root = np.sqrt(weights)
+        params, _, _, _ = np.linalg.lstsq(a * root[:, None], b * root, rcond=None)
+        residuals = b - a @ params
+        # Robust spread from the median absolute deviation
+        sigma = max(1.4826 * np.median(np.abs(residuals - np.median(residuals))), 1e-6)
+        scaled = np.abs(residuals) / (HUBER_K * sigma)
+        new_weights = np.where(scaled <= 1.0, 1.0, 1.0 / np.maximum(scaled, 1e-12))
+        if np.allclose(new_weights, weights, atol=1e-4):
+            break
+        weights = new_weights
+
+    focal, focal_radial, offset = params
+    inliers = weights >= 1.0
+    rms = float(np.sqrt(np.mean(residuals[inliers] ** 2))) if inliers.any() else float("nan")
+    return CameraCalibration(camera, float(focal), float(focal_radial / focal), float(offset), native_width,
+                             rms, int(len(b)))
+
+
+def _load_profiles(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as profiles_file:
+        return json.load(profiles_file)
+
+
+def save_calibration(serial, calibration, path=CALIBRATION_PATH):
+    profiles = _load_profiles(path)
+    profiles.setdefault(serial, {})[calibration.camera] = calibration.to_dict()
+    with open(path + ".tmp", "w") as profiles_file:
+        json.dump(profiles, profiles_file, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def load_calibration(tello, path=CALIBRATION_PATH):
+    """ Calibration of both cameras of the connected drone, defaults for cameras without a profile """
+    serial = tello.query_serial_number()
+    stored = _load_profiles(path).get(serial, {})
+    calibrations = {}
+    for camera, (width, focal_px) in DEFAULTS.items():
+        if camera in stored:
+            values = stored[camera]
+            calibrations[camera] = CameraCalibration(camera, values["focal_px"], values["radial"],
+                                                     values["offset_cm"], values["width"], values.get("rms_cm"),
+                                                     values.get("samples", 0), serial)
+        else:
+            calibrations[camera] = CameraCalibration(camera, focal_px, width=width)
+        print(f"Calibration {calibrations[camera]}")
+    return calibrations
+
+
+def collect_samples(tello, camera, marker_size, distances, move, samples_per_pose=30, yaw_offsets=(0,),
+                    dictionary="DICT_6X6_250", display=None):
+    """ Marker widths at each known distance. move(distance) puts the drone there, for the downward
+        camera the distance of each sample is read from the time-of-flight sensor instead.
+        Small yaw offsets move the marker across the image so the radial term can be fitted.
+    """
+    detector = create_detector(dictionary)
+    buffers = FrameBuffers()
+    frame_read = tello.get_frame_read()
+    samples = []
+    for distance in distances:
+        move(distance)
+        for yaw in yaw_offsets:
+            if yaw > 0:
+                tello.rotate_clockwise(yaw)
+            elif yaw < 0:
+                tello.rotate_counter_clockwise(-yaw)
+            time.sleep(0.5)  # Let the drone settle and the video catch up
+            collected = 0
+            last_frame = None
+            deadline = time.monotonic() + samples_per_pose / 5.0
+            while collected < samples_per_pose and time.monotonic() < deadline:
+                frame = frame_read.frame
+                if frame is None or frame is last_frame:
+                    time.sleep(0.01)
+                    continue
+                last_frame = frame
+                detections = detect_markers(detector, buffers.gray(frame))
+                if display is not None:
+                    display.show(frame, detections, f"Calibrating at {distance} cm")
+                if len(detections) != 1:
+                    continue
+                marker = detections[0]
+                measured = tello.get_distance_tof() if camera == "downward" else distance
+                samples.append((measured, marker.width, marker.center_x, marker.center_y, frame.shape[1],
+                                frame.shape[0]))
+                collected += 1
+        if sum(yaw_offsets):
+            rotation = sum(yaw_offsets)
+            if rotation > 0:
+                tello.rotate_counter_clockwise(rotation)
+            else:
+                tello.rotate_clockwise(-rotation)
+        print(f"{distance} cm: {len(samples)} samples so far")
+    return samples
+
+
+def save_samples(path, camera, samples):
+    new_file = not os.path.exists(path)
+    with open(path, "a", newline="") as samples_file:
+        writer = csv.writer(samples_file)
+        if new_file:
+            writer.writerow(SAMPLE_FIELDS)
+        for sample in samples:
+            writer.writerow([camera] + list(sample))
+
+
+def load_samples(path, camera):
+    with open(path, newline="") as samples_file:
+        return [tuple(float(row[field]) for field in SAMPLE_FIELDS[1:])
+                for row in csv.DictReader(samples_file) if row["camera"] == camera]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fit a focal length calibration to saved marker width samples")
+    parser.add_argument("samples", help="CSV written by ArucoTag/getSize.py --calibrate")
+    parser.add_argument("--serial", required=True, help="drone serial number (sn?) to store the result under")
+    parser.add_argument("--camera", default="forward", choices=sorted(DEFAULTS))
+    parser.add_argument("--marker-size", type=float, default=20.0, help="printed marker width in cm")
+    parser.add_argument("--dry-run", action="store_true", help="print the fit without saving it")
+    args = parser.parse_args()
+
+    calibration = fit_calibration(load_samples(args.samples, args.camera), args.marker_size, args.camera)
+    print(f"{calibration}, rms {calibration.rms_cm:.1f} cm over {calibration.samples} samples")
+    if not args.dry_run:
+        save_calibration(args.serial, calibration)
+        print(f"Saved to {CALIBRATION_PATH}")
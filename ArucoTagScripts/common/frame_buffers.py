@@ -0,0 +1,121 @@
+import argparse
+import gc
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+# Preallocated output buffers for the per-frame OpenCV work (grayscale, resize, threshold, ...).
+#
+# Every cv2 call without dst= returns a new array, at 30 fps on 960x720 frames that is tens of
+# MB per second through the allocator for images that are thrown away a few milliseconds later.
+# FrameBuffers keeps one array per (name, shape, dtype) and passes it as dst=, so in steady state
+# the hot loop allocates nothing. A buffer is overwritten by the next call with the same name:
+# copy it if it has to outlive the current frame.
+#
+# The decoded frame itself comes from the djitellopy decoder and the detector's internal
+# threshold images are allocated inside OpenCV, neither can be pooled from Python.
+#
+# Benchmark, from the ArucoTagScripts folder:
+#     python -m common.frame_buffers --frames 600
+
+
+class FrameBuffers(object):
+    """ Pool of reusable output arrays, one per name and shape """
+
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+        self.reuses = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        key = (name, shape, np.dtype(dtype).str)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[key] = buffer
+            self.allocations += 1
+        else:
+            self.reuses += 1
+        return buffer
+
+    def gray(self, frame, name="gray"):
+        """ Grayscale of a BGR frame, a grayscale frame is returned as is """
+        if frame.ndim == 2:
+            return frame
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.get(name, frame.shape[:2]))
+
+    def resize(self, frame, size, interpolation=cv2.INTER_LINEAR, name="resized"):
+        """ frame resized to size = (width, height) """
+        shape = (size[1], size[0]) + frame.shape[2:]
+        return cv2.resize(frame, size, dst=self.get(name, shape, frame.dtype), interpolation=interpolation)
+
+    def threshold(self, gray, thresh, maxval, kind, name="threshold"):
+        """ Like cv2.threshold, returns (threshold used, image) """
+        return cv2.threshold(gray, thresh, maxval, kind, dst=self.get(name, gray.shape, gray.dtype))
+
+    def laplacian(self, gray, depth=cv2.CV_16S, name="laplacian"):
+        dtype = {cv2.CV_16S: np.int16, cv2.CV_32F: np.float32, cv2.CV_64F: np.float64}[depth]
+        return cv2.Laplacian(gray, depth, dst=self.get(name, gray.shape, dtype))
+
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
+    def report(self):
+        return (f"Frame buffers: {len(self.buffers)} held ({self.nbytes() / 1e6:.1f} MB), "
+                f"{self.allocations} allocations, {self.reuses} reuses")
+
+
+# Function to run the findX.py style pipeline (resize, grayscale, threshold) once per frame
+def _pipeline(frame, buffers):
+    if buffers is None:
+        small = cv2.resize(frame, (640, 480))
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        _, thresh = cv2.threshold(gray, 100, 255, cv2.THRESH_BINARY_INV)
+        full_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    else:
+        small = buffers.resize(frame, (640, 480))
+        gray = buffers.gray(small, name="small_gray")
+        _, thresh = buffers.threshold(gray, 100, 255, cv2.THRESH_BINARY_INV)
+        full_gray = buffers.gray(frame)
+    return int(thresh[0, 0]) + int(full_gray[0, 0])
+
+
+def benchmark(frames=600, width=960, height=720):
+    """ Per-frame latency and traced memory of the pipeline with fresh arrays and with the pool """
+    rng = np.random.default_rng(0)
+    source = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(4)]
+    results = {}
+    for label, buffers in (("fresh arrays", None), ("buffer pool", FrameBuffers())):
+        for i in range(30):  # Warm up, the pool fills here
+            _pipeline(source[i % len(source)], buffers)
+        gc.collect()
+        tracemalloc.start()
+        base, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        latencies = []
+        for i in range(frames):
+            start = time.perf_counter()
+            _pipeline(source[i % len(source)], buffers)
+            latencies.append(time.perf_counter() - start)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        latencies = np.array(latencies) * 1000
+        results[label] = latencies
+        print(f"{label:13s}: p50 {np.percentile(latencies, 50):.2f} ms, p99 {np.percentile(latencies, 99):.2f} ms, "
+              f"jitter (std) {latencies.std():.3f} ms, peak new memory {(peak - base) / 1e6:.2f} MB, "
+              f"left after the loop {(current - base) / 1e6:.2f} MB")
+        if buffers is not None:
+            print(f"  {buffers.report()}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the frame buffer pool against fresh arrays")
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--width", type=int, default=960)
+    parser.add_argument("--height", type=int, default=720)
+    args = parser.parse_args()
+    benchmark(args.frames, args.width, args.height)
@@ -0,0 +1,198 @@
+import time
+from collections import deque, namedtuple
+
+import cv2
+import numpy as np
+
+from common.frame_buffers import FrameBuffers
+
+# Result of the quality check for one frame
+# sharpness:  variance of the Laplacian on the downsampled grayscale image
+# blockiness: gradient energy on the 8px H.264 block grid relative to the rest of the image
+# tear:       strongest row-to-row jump relative to the median jump (torn / smeared frames)
+# flat:       fraction of rows without texture (grey or green decoder fill)
+# weight:     0..1 confidence the controller can use to down-weight a detection
+# usable:     False if the frame should not be passed to the detector at all
+# artifacts:  True if it was rejected for decoding artifacts rather than blur, i.e. a corrupt frame
+FrameQuality = namedtuple("FrameQuality", ["sharpness", "blockiness", "tear", "flat", "weight", "usable",
+                                           "artifacts"])
+
+
+class FrameQualityGate(object):
+    """ Cheap blur and decoding-artifact check that runs before detectMarkers.
+        All metrics except blockiness are computed on a small grayscale copy of the
+        frame, so the gate costs about 1-2 ms on a 960x720 frame (benchmark() below),
+        a fraction of what detectMarkers spends on the frames it rejects.
+        The sharpness threshold follows the rolling median of recent frames, so a
+        scene with little texture is not rejected forever. A low-texture floor can still fail
+        the flat check on every frame, stuck() tells the mission to search on regardless.
+    """
+
+    def __init__(self, small_width=160, min_sharpness=15.0, relative_sharpness=0.35,
+                 max_blockiness=1.8, max_tear=8.0, max_flat=0.3, history=30, max_rejected_in_row=15):
+        self.small_width = small_width
+        self.min_sharpness = min_sharpness  # Absolute floor for the sharpness threshold
+        self.relative_sharpness = relative_sharpness  # Fraction of the rolling median a frame must reach
+        self.max_blockiness = max_blockiness
+        self.max_tear = max_tear
+        self.max_flat = max_flat
+        self.sharpness_history = deque(maxlen=history)
+        self.buffers = FrameBuffers()  # Small image, its grayscale and Laplacian are reused every frame
+
+        # Counters so the mission can print how many frames were dropped
+        self.checked = 0
+        self.rejected = 0
+        self.rejected_in_row = 0
+        self.max_rejected_in_row = max_rejected_in_row
+        self.last_quality = None
+
+    def sharpness_threshold(self):
+        """ Threshold a frame has to reach to count as sharp """
+        if not self.sharpness_history:
+            return self.min_sharpness
+        median = float(np.median(self.sharpness_history))
+        return max(self.min_sharpness, self.relative_sharpness * median)
+
+    def check(self, frame):
+        """ Return the FrameQuality of a BGR or grayscale frame """
+        height, width = frame.shape[:2]
+        small_height = max(1, int(height * self.small_width / width))
+
+        # Downsample first and convert the small image only
+        small = self.buffers.resize(frame, (self.small_width, small_height), interpolation=cv2.INTER_AREA)
+        small = self.buffers.gray(small)
+
+        # Sharpness: motion blur removes the high frequencies the Laplacian responds to
+        laplacian = self.buffers.laplacian(small)
+        sharpness = float(laplacian.var())
+
+        # Row statistics on the small image
+        small_f = small.astype(np.float32)
+        row_jumps = np.abs(np.diff(small_f, axis=0)).mean(axis=1)
+        tear = float(row_jumps.max() / (np.median(row_jumps) + 1.0))
+        flat = float(np.mean(small_f.std(axis=1) < 2.0))
+
+        blockiness = self.block_grid_ratio(frame)
+
+        threshold = self.sharpness_threshold()
+        artifacts = blockiness > self.max_blockiness or tear > self.max_tear or flat > self.max_flat
+        usable = sharpness >= threshold and not artifacts
+
+        # Sharp frames get weight 1, blurrier ones fade out towards the threshold
+        weight = min(1.0, sharpness / (2.0 * threshold)) if usable else 0.0
+
+        # Only feed clean frames into the rolling median
+        if not artifacts:
+            self.sharpness_history.append(sharpness)
+
+        self.checked += 1
+        if not usable:
+            self.rejected += 1
+            self.rejected_in_row += 1
+        else:
+            self.rejected_in_row = 0
+
+        self.last_quality = FrameQuality(sharpness, blockiness, tear, flat, weight, usable, artifacts)
+        return self.last_quality
+
+    def stuck(self):
+        """ True after every max_rejected_in_row rejected frames in a row: the mission should not wait
+            for a usable frame any longer and go on searching
+        """
+        return self.rejected_in_row > 0 and self.rejected_in_row % self.max_rejected_in_row == 0
+
+    @staticmethod
+    def block_grid_ratio(frame, band_height=64):
+        """ Ratio of horizontal gradient energy on the 8px block grid to the energy off the grid.
+            H.264 artifacts line up with the macroblock grid, natural edges do not.
+            Only a horizontal band through the middle of the full-resolution frame is used.
+        """
+        height = frame.shape[0]
+        top = max(0, height // 2 - band_height // 2)
+        band = frame[top:top + band_height]
+        if band.ndim == 3:
+            band = band[:, :, 1]  # The green channel is close enough to luma here
+
+        column_jumps = np.abs(np.diff(band.astype(np.int16), axis=1)).mean(axis=0)
+        on_grid = column_jumps[7::8]
+        off_grid = np.delete(column_jumps, np.s_[7::8])
+        return float(on_grid.mean() / (off_grid.mean() + 1.0))
+
+    def summary(self):
+        """ Short text for the end-of-flight log """
+        return f"frame quality gate: {self.rejected}/{self.checked} frames skipped"
+
+
+# --- Benchmark -------------------------------------------------------------------------
+# Run from the ArucoTagScripts folder: python -m common.frame_quality
+
+def _synthetic_frame(rng, aruco_dict, marker_id=0, size=(720, 960)):
+    """ Textured background with one ArUco marker, similar to a floor tag seen by the Tello """
+    frame = rng.integers(60, 200, size=(size[0] // 6, size[1] // 6), dtype=np.uint8)
+    frame = cv2.resize(frame, (size[1], size[0]), interpolation=cv2.INTER_LINEAR)
+    marker = cv2.aruco.generateImageMarker(aruco_dict, marker_id, 200)
+    marker = cv2.copyMakeBorder(marker, 20, 20, 20, 20, cv2.BORDER_CONSTANT, value=255)
+    y, x = 200, 360
+    frame[y:y + marker.shape[0], x:x + marker.shape[1]] = marker
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def _motion_blur(frame, length=25):
+    """ Horizontal blur like the one right after rotate_clockwise """
+    kernel = np.zeros((length, length), dtype=np.float32)
+    kernel[length // 2, :] = 1.0 / length
+    return cv2.filter2D(frame, -1, kernel)
+
+
+def _torn(frame):
+    """ Lower half replaced by a smeared grey block like a lost H.264 slice """
+    torn = frame.copy()
+    torn[frame.shape[0] // 2:] = 128
+    return torn
+
+
+def benchmark(repeats=200):
+    aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_6X6_250)
+    detector = cv2.aruco.ArucoDetector(aruco_dict, cv2.aruco.DetectorParameters())
+    rng = np.random.default_rng(0)
+
+    sharp = _synthetic_frame(rng, aruco_dict)
+    frames = {"sharp": sharp, "blurred": _motion_blur(sharp), "torn": _torn(sharp)}
+
+    results = {}
+    for name, frame in frames.items():
+        # Fresh gate per case, warmed up with sharp frames as in normal flight
+        gate = FrameQualityGate()
+        for _ in range(10):
+            gate.check(sharp)
+        quality = gate.check(frame)  # Verdict on the first bad frame after sharp ones
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            gate.check(frame)
+        gate_ms = (time.perf_counter() - start) * 1000 / repeats
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            detector.detectMarkers(gray)
+        detect_ms = (time.perf_counter() - start) * 1000 / repeats
+
+        results[name] = (gate_ms, detect_ms, quality.usable)
+        print(f"{name:8s} gate {gate_ms:6.3f} ms  detect {detect_ms:6.3f} ms  "
+              f"usable={quality.usable}  sharpness={quality.sharpness:.1f}  "
+              f"blockiness={quality.blockiness:.2f}  tear={quality.tear:.1f}  flat={quality.flat:.2f}")
+
+    # Expected cost per frame for a stream where a share of frames is bad
+    gate_ms = np.mean([r[0] for r in results.values()])
+    sharp_detect_ms = results["sharp"][1]
+    bad_detect_ms = np.mean([results["blurred"][1], results["torn"][1]])
+    for bad_share in (0.1, 0.3, 0.5):
+        without_gate = (1 - bad_share) * sharp_detect_ms + bad_share * bad_detect_ms
+        with_gate = gate_ms + (1 - bad_share) * sharp_detect_ms
+        print(f"{int(bad_share * 100):2d}% bad frames: {without_gate:.3f} ms/frame without gate, "
+              f"{with_gate:.3f} ms/frame with gate")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,284 @@
+import argparse
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+# Raw H.264 recording of the Tello video without decoding or re-encoding.
+#
+# The drone is told to send its video to TEE_PORT instead of 11111 (SDK `port 8890 11112`).
+# A small tee process started with H264Recorder receives every datagram there, forwards it
+# unchanged to 127.0.0.1:11111 where djitellopy decodes it as before, and while recording
+# appends the payload to the current segment file. The Tello packets are pieces of an Annex-B
+# byte stream, so the segment is a playable .h264 file as is (ffplay, VLC, cv2.VideoCapture).
+#
+# Next to every segment an .idx sidecar holds one INDEX_ENTRY per frame: byte offset of its
+# first NAL, receive time and a keyframe flag. Segments only start and roll over at a keyframe
+# (SPS), so every segment and every keyframe entry is a random access point: extract_clip cuts
+# a time range out of a segment starting at the keyframe before it.
+#
+# Run from the ArucoTagScripts folder to look at an index:
+#     python -m common.h264_recorder --show recordings/flight_0000.h264
+
+VIDEO_PORT = 11111
+TEE_PORT = 11112
+STATE_PORT = 8890
+
+INDEX_ENTRY = struct.Struct("<QdBxxxI")  # offset, receive time (time.time), flags, frame number
+FLAG_KEYFRAME = 1
+
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SPS = 7
+
+# Control datagrams from the mission to the tee, sent from localhost
+CONTROL_RECORD = b"TEE:RECORD"
+CONTROL_PAUSE = b"TEE:PAUSE"
+CONTROL_QUIT = b"TEE:QUIT"
+
+IndexEntry = namedtuple("IndexEntry", ["offset", "t", "keyframe", "frame"])
+
+
+def find_nals(data, start=0):
+    """ (position of the NAL header byte, NAL type, first byte of the slice header) for each start code """
+    nals = []
+    position = data.find(b"\x00\x00\x01", start)
+    while position >= 0 and position + 3 < len(data):
+        header = position + 3
+        following = data[header + 1] if header + 1 < len(data) else None
+        nals.append((header, data[header] & 0x1F, following))
+        position = data.find(b"\x00\x00\x01", header)
+    return nals
+
+
+class _Segment(object):
+    """ One .h264 file with its .idx sidecar """
+
+    def __init__(self, path):
+        self.path = path
+        self.video = open(path, "wb", buffering=1 << 20)
+        self.index = open(os.path.splitext(path)[0] + ".idx", "wb", buffering=1 << 16)
+        self.size = 0
+        self.frames = 0
+        self.started = time.monotonic()
+
+    def write(self, payload, frame_starts, t):
+        """ frame_starts: (offset in payload, keyframe) of each frame beginning in this payload """
+        for offset, keyframe in frame_starts:
+            self.index.write(INDEX_ENTRY.pack(self.size + offset, t, FLAG_KEYFRAME if keyframe else 0, self.frames))
+            self.frames += 1
+        self.video.write(payload)
+        self.size += len(payload)
+
+    def close(self):
+        self.video.close()
+        self.index.close()
+
+
+class _SegmentWriter(object):
+    """ Splits the recorded byte stream into segments that each start at a keyframe.
+        A keyframe starts at its SPS, which usually arrives in its own datagram together with the
+        PPS before the slice. The bytes from a pending SPS on are held back until the slice shows
+        whether they start a new segment, so the parameter sets always open the segment they belong to.
+    """
+
+    def __init__(self, folder, prefix, segment_seconds, segment_bytes):
+        self.folder = folder
+        self.prefix = prefix
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.segment = None
+        self.segment_number = 0
+        self.reset()
+
+    def reset(self):
+        """ Recording paused, the next bytes do not continue the earlier stream """
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        self.tail = b""  # Last bytes of the previous packet, a start code can be split across packets
+        self.pending = bytearray()  # Received bytes not written yet, from stream position pending_start on
+        self.pending_start = 0
+        self.position = 0  # Stream position of the next payload
+        self.key_at = None  # Stream position of an SPS whose keyframe slice has not arrived yet
+
+    def _due(self):
+        return self.segment is None or (time.monotonic() - self.segment.started > self.segment_seconds
+                                        or self.segment.size > self.segment_bytes)
+
+    def _write(self, upto, entries, t):
+        """ Write the pending bytes before stream position upto, with their frame entries """
+        cut = upto - self.pending_start
+        if self.segment is not None:
+            self.segment.write(bytes(self.pending[:cut]), [(p - self.pending_start, k) for p, k in entries], t)
+        # Without a segment these are the bytes before the first keyframe, a decoder cannot start there
+        del self.pending[:cut]
+        self.pending_start = upto
+
+    def feed(self, payload, t=None):
+        t = time.time() if t is None else t
+        scan = self.tail + payload
+        base = self.position - len(self.tail)
+        frame_starts = []  # (stream position, keyframe)
+        for header, nal_type, following in find_nals(scan):
+            start = header - 3
+            if start > 0 and scan[start - 1] == 0:
+                start -= 1  # Four-byte start code
+            # A start code split across packets may begin in bytes that are written already
+            start = max(base + start, self.pending_start)
+            if nal_type == NAL_SPS:
+                if self.key_at is None:
+                    self.key_at = start
+            elif nal_type in (NAL_SLICE, NAL_IDR) and following is not None and following & 0x80:
+                # first_mb_in_slice == 0: this slice starts a new frame. Keyframes start at their SPS
+                # so a decoder starting there has the parameter sets.
+                keyframe = self.key_at is not None or nal_type == NAL_IDR
+                frame_starts.append((self.key_at if self.key_at is not None else start, keyframe))
+                self.key_at = None
+        self.tail = scan[-4:]
+        self.position += len(payload)
+        self.pending += payload
+
+        entries = []
+        for start, keyframe in frame_starts:
+            if keyframe and self._due():
+                # Roll over at the keyframe: the part before it still belongs to the old segment
+                self._write(start, entries, t)
+                entries = []
+                if self.segment is not None:
+                    self.segment.close()
+                self.segment = _Segment(os.path.join(self.folder, f"{self.prefix}_{self.segment_number:04d}.h264"))
+                self.segment_number += 1
+            if self.segment is not None:
+                entries.append((start, keyframe))
+        # Everything up to a pending SPS, its keyframe decides which segment the SPS belongs to
+        self._write(self.key_at if self.key_at is not None else self.position, entries, t)
+
+    def close(self):
+        self.reset()
+
+
+def run_tee(folder, prefix, segment_seconds, segment_bytes, tee_port=TEE_PORT, forward_port=VIDEO_PORT,
+            record=False):
+    """ Tee loop, runs in its own process so recording never competes with detection for the GIL """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(("0.0.0.0", tee_port))
+    forward = ("127.0.0.1", forward_port)
+    buffer = bytearray(65536)
+    view = memoryview(buffer)
+
+    recording = record
+    os.makedirs(folder, exist_ok=True)
+    writer = _SegmentWriter(folder, prefix, segment_seconds, segment_bytes)
+    try:
+        while True:
+            size, sender = sock.recvfrom_into(buffer)
+            if sender[0] == "127.0.0.1" and bytes(view[:4]) == b"TEE:":
+                command = bytes(view[:size])
+                if command == CONTROL_QUIT:
+                    break
+                recording = command == CONTROL_RECORD
+                if not recording:
+                    writer.reset()
+                continue
+
+            sock.sendto(view[:size], forward)
+            if recording:
+                writer.feed(bytes(view[:size]))
+    finally:
+        writer.close()
+        sock.close()
+
+
+class H264Recorder(object):
+    """ Starts the tee process and switches recording on and off.
+        Call setup_drone(tello) after connect and before streamon.
+    """
+
+    def __init__(self, folder="recordings", prefix=None, segment_seconds=300, segment_bytes=200 * 1024 * 1024,
+                 tee_port=TEE_PORT):
+        self.folder = folder
+        self.prefix = prefix or time.strftime("flight_%Y%m%d_%H%M%S")
+        self.tee_port = tee_port
+        package_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        self.process = subprocess.Popen([sys.executable, "-m", "common.h264_recorder", "--tee",
+                                         "--folder", os.path.abspath(folder), "--prefix", self.prefix,
+                                         "--segment-seconds", str(segment_seconds),
+                                         "--segment-bytes", str(segment_bytes), "--port", str(tee_port)],
+                                        cwd=package_root)
+        self.control = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.recording = False
+
+    def setup_drone(self, tello):
+        """ Point the drone's video at the tee, djitellopy keeps reading 11111 """
+        tello.send_control_command(f"port {STATE_PORT} {self.tee_port}")
+
+    def _send(self, command):
+        self.control.sendto(command, ("127.0.0.1", self.tee_port))
+
+    def start(self):
+        self.recording = True
+        self._send(CONTROL_RECORD)
+
+    def pause(self):
+        self.recording = False
+        self._send(CONTROL_PAUSE)
+
+    def close(self):
+        self._send(CONTROL_QUIT)
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.control.close()
+
+
+def read_index(segment_path):
+    entries = []
+    with open(os.path.splitext(segment_path)[0] + ".idx", "rb") as index_file:
+        data = index_file.read()
+    for offset, t, flags, frame in INDEX_ENTRY.iter_unpack(data[:len(data) // INDEX_ENTRY.size * INDEX_ENTRY.size]):
+        entries.append(IndexEntry(offset, t, bool(flags & FLAG_KEYFRAME), frame))
+    return entries
+
+
+def extract_clip(segment_path, start_time, end_time, out_path):
+    """ Copy the frames between two receive times into a new .h264, starting at the keyframe before
+        start_time. Returns the number of leading frames before start_time the decoder should skip.
+    """
+    entries = read_index(segment_path)
+    keyframes = [e for e in entries if e.keyframe and e.t <= start_time] or [e for e in entries if e.keyframe]
+    first = keyframes[-1]
+    after = [e for e in entries if e.t > end_time]
+    end_offset = after[0].offset if after else os.path.getsize(segment_path)
+    with open(segment_path, "rb") as video, open(out_path, "wb") as clip:
+        video.seek(first.offset)
+        clip.write(video.read(end_offset - first.offset))
+    return sum(1 for e in entries if first.frame <= e.frame and e.t < start_time)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Raw H.264 tee and recorder for the Tello video")
+    parser.add_argument("--tee", action="store_true", help="run the tee (started by H264Recorder)")
+    parser.add_argument("--folder", default="recordings")
+    parser.add_argument("--prefix", default="flight")
+    parser.add_argument("--segment-seconds", type=float, default=300)
+    parser.add_argument("--segment-bytes", type=int, default=200 * 1024 * 1024)
+    parser.add_argument("--port", type=int, default=TEE_PORT)
+    parser.add_argument("--show", help="print the index of a recorded segment")
+    args = parser.parse_args()
+
+    if args.tee:
+        run_tee(args.folder, args.prefix, args.segment_seconds, args.segment_bytes, args.port)
+    elif args.show:
+        entries = read_index(args.show)
+        keyframes = [e for e in entries if e.keyframe]
+        duration = entries[-1].t - entries[0].t if entries else 0.0
+        print(f"{args.show}: {len(entries)} frames, {len(keyframes)} keyframes, {duration:.1f} s, "
+              f"{os.path.getsize(args.show) / 1e6:.1f} MB")
+        for entry in keyframes:
+            print(f"  keyframe at frame {entry.frame}, byte {entry.offset}, +{entry.t - entries[0].t:.2f} s")
@@ -0,0 +1,238 @@
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import struct
+import time
+
+import cv2
+import numpy as np
+
+from common.aruco_detection import create_detector, detect_markers, load_profile
+from common.wall_alignment import FORWARD_FOCAL_PX
+
+# Batch ground-truth labelling of recorded flights, e.g. the drone_recording.avi files of pygame.py.
+# Run from the ArucoTagScripts folder:
+#     python -m common.labelling recordings/*.avi --marker-size 20 --out labels
+#
+# Every video is split into chunks of frames and all chunks of all videos go to one process
+# pool, so a single long video still keeps every core busy. A chunk decodes its frame range,
+# runs the mission detector and tracks markers it loses for a few frames with optical flow.
+# Chunk results are cached under <out>/cache/<key>/ where key is the hash of the video content,
+# the detector settings, the marker size and the chunk length (tracking restarts at every chunk,
+# so the labels depend on it), so an interrupted or repeated run only does the missing chunks. The chunks of a video are then joined into one indexed .labels file:
+#
+#   header   magic, version, frame count, record count, marker size (cm), detector key
+#   index    frame count + 1 uint32: records of frame i are index[i]:index[i + 1]
+#   records  LABEL_DTYPE, sorted by frame
+
+MAGIC = b"TLBL"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sHIIf32s")
+
+FLAG_TRACKED = 1  # Corners carried over by optical flow, not detected in this frame
+LABEL_DTYPE = np.dtype([
+    ("frame", "<u4"), ("marker_id", "<i2"), ("flags", "u1"),
+    ("corners", "<f4", (4, 2)), ("rvec", "<f4", 3), ("tvec", "<f4", 3),
+])
+
+CHUNK_FRAMES = 600
+TRACK_FRAMES = 5  # Frames a lost marker is tracked before it is dropped
+
+
+def file_hash(path, block=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as video:
+        for data in iter(lambda: video.read(block), b""):
+            sha.update(data)
+    return path, sha.hexdigest()
+
+
+def detector_key(video_hash, dictionary, profile, marker_size, chunk_frames=CHUNK_FRAMES):
+    """ Cache key: same video content, detector settings, marker size and chunks give the same labels """
+    settings = load_profile(profile) if profile else {"dictionary": dictionary}
+    text = json.dumps({"video": video_hash, "detector": settings, "marker_size": marker_size,
+                       "chunk_frames": chunk_frames, "version": VERSION}, sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_path(cache_dir, key, start, stop):
+    return os.path.join(cache_dir, key, f"chunk_{start:08d}_{stop:08d}.npy")
+
+
+def _camera_matrix(width, height):
+    # Focal length calibrated at 960 px width, scaled for other recordings
+    focal = FORWARD_FOCAL_PX * width / 960.0
+    return np.array([[focal, 0, width / 2], [0, focal, height / 2], [0, 0, 1]], dtype=np.float64)
+
+
+def _pose(corners, marker_size, camera_matrix):
+    """ rvec, tvec (cm) of a square marker of marker_size cm from its image corners """
+    half = marker_size / 2.0
+    object_points = np.array([[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]],
+                             dtype=np.float32)
+    ok, rvec, tvec = cv2.solvePnP(object_points, corners.astype(np.float32), camera_matrix, None,
+                                  flags=cv2.SOLVEPNP_IPPE_SQUARE)
+    if not ok:
+        return np.zeros(3), np.zeros(3)
+    return rvec.ravel(), tvec.ravel()
+
+
+def label_chunk(task):
+    """ Labels for frames [start, stop) of one video, cached as .npy. Runs in a pool worker. """
+    path, key, start, stop, dictionary, profile, marker_size, cache_dir = task
+    cache_path = chunk_path(cache_dir, key, start, stop)
+    if os.path.exists(cache_path):
+        return path, start, stop - start, True
+
+    cv2.setNumThreads(1)  # One core per chunk, the pool runs one chunk per core
+    detector = create_detector(dictionary, profile=profile)
+    capture = cv2.VideoCapture(path)
+    capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    camera_matrix = None
+
+    records = []
+    previous_gray = None
+    tracks = {}  # marker ID -> (corners, frames since last detection)
+    frame_index = start
+    while frame_index < stop:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if camera_matrix is None:
+            camera_matrix = _camera_matrix(gray.shape[1], gray.shape[0])
+
+        found = {}
+        for detection in detect_markers(detector, gray):
+            found[detection.marker_id] = (np.asarray(detection.corners, dtype=np.float32), 0)
+
+        # Carry markers the detector lost (blur, glare) along with optical flow for a few frames
+        lost = [marker_id for marker_id in tracks if marker_id not in found]
+        if lost and previous_gray is not None:
+            points = np.concatenate([tracks[marker_id][0] for marker_id in lost]).reshape(-1, 1, 2)
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(previous_gray, gray, points, None)
+            for i, marker_id in enumerate(lost):
+                age = tracks[marker_id][1] + 1
+                if age <= TRACK_FRAMES and status[4 * i:4 * i + 4].all():
+                    found[marker_id] = (moved[4 * i:4 * i + 4].reshape(4, 2), age)
+
+        for marker_id, (corners, age) in sorted(found.items()):
+            rvec, tvec = _pose(corners, marker_size, camera_matrix)
+            records.append((frame_index, marker_id, FLAG_TRACKED if age else 0, corners, rvec, tvec))
+
+        tracks = found
+        previous_gray = gray
+        frame_index += 1
+    capture.release()
+
+    labels = np.array(records, dtype=LABEL_DTYPE) if records else np.zeros(0, dtype=LABEL_DTYPE)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    np.save(cache_path + ".tmp.npy", labels)
+    os.replace(cache_path + ".tmp.npy", cache_path)  # A killed run never leaves a half chunk
+    return path, start, frame_index - start, False
+
+
+def write_labels(path, labels, frame_count, marker_size, key):
+    index = np.zeros(frame_count + 1, dtype="<u4")
+    counts = np.bincount(labels["frame"], minlength=frame_count)[:frame_count] if len(labels) else 0
+    index[1:] = np.cumsum(counts)
+    with open(path + ".tmp", "wb") as labels_file:
+        labels_file.write(FILE_HEADER.pack(MAGIC, VERSION, frame_count, len(labels), marker_size,
+                                           bytes.fromhex(key)))
+        labels_file.write(index.tobytes())
+        labels_file.write(labels.tobytes())
+    os.replace(path + ".tmp", path)
+
+
+class LabelFile(object):
+    """ Reads a .labels file without loading it: labels.frame(i) gives the records of frame i """
+
+    def __init__(self, path):
+        with open(path, "rb") as labels_file:
+            magic, version, self.frame_count, self.record_count, self.marker_size, key = \
+                FILE_HEADER.unpack(labels_file.read(FILE_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} labels file")
+        self.key = key.hex()
+        self.index = np.memmap(path, dtype="<u4", mode="r", offset=FILE_HEADER.size, shape=(self.frame_count + 1,))
+        offset = FILE_HEADER.size + self.index.nbytes
+        self.records = np.memmap(path, dtype=LABEL_DTYPE, mode="r", offset=offset, shape=(self.record_count,)) \
+            if self.record_count else np.zeros(0, dtype=LABEL_DTYPE)
+
+    def __len__(self):
+        return self.frame_count
+
+    def frame(self, index):
+        return self.records[self.index[index]:self.index[index + 1]]
+
+    def track(self, marker_id):
+        """ All records of one marker, in frame order """
+        return self.records[self.records["marker_id"] == marker_id]
+
+
+def label_videos(videos, out_dir, dictionary="DICT_6X6_250", profile=None, marker_size=20.0, workers=None,
+                 chunk_frames=CHUNK_FRAMES):
+    workers = workers or os.cpu_count() or 1
+    cache_dir = os.path.join(out_dir, "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    start_time = time.perf_counter()
+
+    context = mp.get_context("spawn")
+    with context.Pool(workers) as pool:
+        # Hash the videos in parallel, the cache key depends on their content
+        hashes = dict(pool.map(file_hash, videos))
+
+        tasks = []
+        jobs = {}
+        for video in videos:
+            key = detector_key(hashes[video], dictionary, profile, marker_size, chunk_frames)
+            stem = os.path.splitext(os.path.basename(video))[0]
+            output = os.path.join(out_dir, f"{stem}.{key[:12]}.labels")
+            if os.path.exists(output):
+                print(f"{video}: up to date ({output})")
+                continue
+            capture = cv2.VideoCapture(video)
+            frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            capture.release()
+            jobs[video] = (key, output, frame_count)
+            for start in range(0, frame_count, chunk_frames):
+                tasks.append((video, key, start, min(start + chunk_frames, frame_count), dictionary, profile,
+                              marker_size, cache_dir))
+
+        # Chunks go to whichever core is free, in any order
+        decoded = cached = 0
+        for video, start, frames, from_cache in pool.imap_unordered(label_chunk, tasks):
+            if from_cache:
+                cached += frames
+            else:
+                decoded += frames
+
+    for video, (key, output, frame_count) in jobs.items():
+        # Exactly the chunks of this run, in frame order
+        chunks = [chunk_path(cache_dir, key, start, min(start + chunk_frames, frame_count))
+                  for start in range(0, frame_count, chunk_frames)]
+        labels = np.concatenate([np.load(chunk) for chunk in chunks]) if chunks else np.zeros(0, dtype=LABEL_DTYPE)
+        write_labels(output, labels, frame_count, marker_size, key)
+        print(f"{video}: {frame_count} frames, {len(labels)} labels -> {output}")
+
+    seconds = time.perf_counter() - start_time
+    print(f"Decoded {decoded} frames in {seconds:.1f} s ({decoded / seconds:.0f} frames/s on {workers} processes), "
+          f"{cached} frames from the cache")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Label ArUco markers in recorded flights")
+    parser.add_argument("videos", nargs="+", help="video files, e.g. recordings/*.avi")
+    parser.add_argument("--out", default="labels", help="folder for the .labels files and the cache")
+    parser.add_argument("--dictionary", default="DICT_6X6_250")
+    parser.add_argument("--profile", default=None, help="detector profile from common.detector_tuning")
+    parser.add_argument("--marker-size", type=float, default=20.0, help="printed marker width in cm, for the pose")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-frames", type=int, default=CHUNK_FRAMES)
+    args = parser.parse_args()
+
+    videos = sorted({video for pattern in args.videos for video in glob.glob(pattern)})
+    label_videos(videos, args.out, args.dictionary, args.profile, args.marker_size, args.workers, args.chunk_frames)
@@ -0,0 +1,295 @@
+import bisect
+import math
+import random
+import threading
+import time
+from collections import deque, namedtuple
+
+# Video latency compensation for controllers that act on marker detections.
+#
+# A frame handed out by get_frame_read() was captured VIDEO_LATENCY seconds earlier. While the
+# drone turns, the marker has moved on in the image since then. MarkerPredictor moves the
+# detection forward to command time: the yaw turned since the capture (from the IMU yaw of the
+# state stream, or from the commanded yaw rate when no state estimator runs) shifts the marker
+# bearing, and the forward motion over the same time scales its width.
+#
+# What this buys in the missions: YawAligner sends a blocking rotate and then waits its own
+# VIDEO_LATENCY (0.3 s) before the next frame, so the drone is still when predict() runs. While
+# the real latency stays below that wait the correction is about zero. Above it the next frame
+# still shows the heading from before the turn, and without the prediction the aligner turns
+# the same error a second time. The approach uses the predicted width, which only differs while
+# the drone still drifts forward.
+#
+# The latency itself starts at the configured value and is refined in flight: markers do not
+# move, so marker bearing + drone yaw at capture time is constant. The lag that makes it most
+# constant over a window of turning flight is the video latency. The missions feed it every
+# sighting of the target through observe(), the search rotation and the alignment turns give it
+# the yaw changes it needs.
+#
+# The real YawAligner and MarkerPredictor against a simulated drone and video latency, from the
+# ArucoTagScripts folder:
+#     python -m common.latency_compensation
+
+VIDEO_LATENCY = 0.25  # s from capture to get_frame_read().frame, configured start value
+LATENCY_RANGE = (0.05, 0.8)
+LATENCY_STEP = 0.01
+MIN_TURN = 5.0  # deg of yaw change a window needs before the latency is re-estimated
+
+Prediction = namedtuple("Prediction", ["center_x", "center_y", "width", "yaw_change", "age"])
+
+
+def _interpolate(times, values, t):
+    """ Linear interpolation in a sorted history, clamped at both ends """
+    i = bisect.bisect_left(times, t)
+    if i <= 0:
+        return values[0]
+    if i >= len(times):
+        return values[-1]
+    t0, t1 = times[i - 1], times[i]
+    share = (t - t0) / (t1 - t0) if t1 > t0 else 0.0
+    return values[i - 1] + share * (values[i] - values[i - 1])
+
+
+class LatencyModel(object):
+    """ Video latency, configured and re-estimated from marker bearings against the IMU yaw """
+
+    def __init__(self, latency=VIDEO_LATENCY, window=40, adapt=True):
+        self.latency = latency
+        self.adapt = adapt
+        self.samples = deque(maxlen=window)  # (frame time, marker ID, bearing in deg)
+        self.estimates = 0
+
+    def observe(self, t_frame, marker_id, bearing, yaw_at):
+        self.samples.append((t_frame, marker_id, bearing))
+        if self.adapt and len(self.samples) == self.samples.maxlen:
+            self._estimate(yaw_at)
+
+    def _estimate(self, yaw_at):
+        samples = list(self.samples)
+        marker_id = samples[-1][1]
+        samples = [(t, bearing) for t, found_id, bearing in samples if found_id == marker_id]
+        if len(samples) < 15:
+            return
+        yaws = [yaw_at(t - self.latency) for t, _ in samples]
+        if max(yaws) - min(yaws) < MIN_TURN:
+            return  # Not enough turning to tell the lags apart
+
+        best, best_spread = self.latency, None
+        lag = LATENCY_RANGE[0]
+        while lag <= LATENCY_RANGE[1]:
+            world = [bearing + yaw_at(t - lag) for t, bearing in samples]
+            mean = sum(world) / len(world)
+            spread = sum((value - mean) ** 2 for value in world)
+            if best_spread is None or spread < best_spread:
+                best, best_spread = lag, spread
+            lag += LATENCY_STEP
+        # Move slowly, one window of bad detections must not throw the model off
+        self.latency += 0.3 * (best - self.latency)
+        self.estimates += 1
+        self.samples.clear()
+
+
+class MarkerPredictor(object):
+    """ Moves marker detections from their capture time to command time.
+        With an estimator the yaw history comes from the state stream at packet rate, without one
+        the controller reports what it commands with command(yaw_rate, forward_speed).
+    """
+
+    def __init__(self, estimator=None, focal_px=774.0, native_width=960, latency=None, history=3.0):
+        self.focal_px = focal_px
+        self.native_width = native_width
+        self.latency = latency or LatencyModel(adapt=estimator is not None)
+        self.history = history
+        self.times = []
+        self.yaws = []  # Unwrapped yaw in degrees, clockwise positive
+        self.forward_speeds = []  # cm/s along the drone's nose
+        self.lock = threading.Lock()
+        self.commanded = (0.0, 0.0, None)  # yaw rate deg/s, forward cm/s, since when
+
+        self.predictions = 0
+        self.shift_total = 0.0  # Sum of |predicted - detected| center_x in px
+        if estimator is not None:
+            estimator.subscribe(self._on_pose)
+
+    def _on_pose(self, pose):
+        with self.lock:
+            yaw = pose.yaw
+            if self.yaws:
+                # Unwrap so interpolation across +-180 works
+                yaw = self.yaws[-1] + (yaw - self.yaws[-1] + 180.0) % 360.0 - 180.0
+            radians = math.radians(pose.yaw)
+            forward = pose.vx * math.cos(radians) + pose.vy * math.sin(radians)
+            self.times.append(pose.t)
+            self.yaws.append(yaw)
+            self.forward_speeds.append(forward)
+            while self.times and self.times[0] < pose.t - self.history:
+                del self.times[0], self.yaws[0], self.forward_speeds[0]
+
+    def command(self, yaw_rate=0.0, forward_speed=0.0):
+        """ Commanded motion, used when there is no IMU history """
+        self.commanded = (yaw_rate, forward_speed, time.monotonic())
+
+    def yaw_at(self, t):
+        with self.lock:
+            if self.times:
+                return _interpolate(self.times, self.yaws, t)
+        yaw_rate, _, since = self.commanded
+        return yaw_rate * (t - since) if since is not None else 0.0
+
+    def _forward_travel(self, t0, t1):
+        with self.lock:
+            if self.times:
+                return _interpolate(self.times, self.forward_speeds, (t0 + t1) / 2) * (t1 - t0)
+        _, forward_speed, since = self.commanded
+        return forward_speed * (t1 - max(t0, since)) if since is not None and t1 > since else 0.0
+
+    def observe(self, marker_id, center_x, frame_width, t_frame):
+        """ A sighting for the latency estimate, call it for every frame the marker is in """
+        focal = self.focal_px * frame_width / self.native_width
+        bearing = math.degrees(math.atan2(center_x - frame_width / 2, focal))
+        self.latency.observe(t_frame, marker_id, bearing, self.yaw_at)
+
+    def predict(self, marker_id, center_x, center_y, width, frame_shape, t_frame, marker_size=None, t_command=None):
+        """ Where the marker is at t_command (now by default) in the frame it was detected in """
+        t_command = time.monotonic() if t_command is None else t_command
+        t_capture = t_frame - self.latency.latency
+        frame_height, frame_width = frame_shape[:2]
+        focal = self.focal_px * frame_width / self.native_width
+
+        bearing = math.degrees(math.atan2(center_x - frame_width / 2, focal))
+
+        # A clockwise turn moves the marker to the left in the image
+        yaw_change = self.yaw_at(t_command) - self.yaw_at(t_capture)
+        predicted_bearing = max(-89.0, min(89.0, bearing - yaw_change))
+        predicted_x = frame_width / 2 + focal * math.tan(math.radians(predicted_bearing))
+
+        predicted_width = width
+        if marker_size and width > 0:
+            distance = focal * marker_size / width
+            closer = distance - self._forward_travel(t_capture, t_command)
+            if closer > 1.0:
+                predicted_width = width * distance / closer
+
+        self.predictions += 1
+        self.shift_total += abs(predicted_x - center_x)
+        return Prediction(predicted_x, center_y, predicted_width, yaw_change, t_command - t_capture)
+
+    def report(self):
+        mean_shift = self.shift_total / self.predictions if self.predictions else 0.0
+        return (f"Latency compensation: video latency {self.latency.latency * 1000:.0f} ms "
+                f"({self.latency.estimates} in-flight estimates), {self.predictions} predictions, "
+                f"mean correction {mean_shift:.1f} px")
+
+
+# --- Simulation -------------------------------------------------------------------------
+
+class _SimClock(object):
+    """ Simulated time for the blocking sleeps of YawAligner, the drone moves while it runs """
+
+    def __init__(self, drone):
+        self.drone = drone
+
+    def monotonic(self):
+        return self.drone.t
+
+    def sleep(self, seconds):
+        self.drone.advance(seconds)
+
+
+class _SimDrone(object):
+    """ Tello stand-in with a yaw that follows rotate and rc commands in simulated time,
+        reporting its pose to the subscribers like StateEstimator does
+    """
+
+    ROTATE_RATE = 90.0  # deg/s
+    COMMAND_DELAY = 0.2  # s from sending a rotate until the turn starts
+    DT = 0.01
+
+    def __init__(self):
+        self.t = 0.0
+        self.yaw = 0.0
+        self.rate = 0.0
+        self.times = [0.0]
+        self.yaws = [0.0]
+        self.listeners = []
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def advance(self, seconds):
+        end = self.t + seconds
+        while self.t < end - 1e-9:
+            step = min(self.DT, end - self.t)
+            self.t += step
+            self.yaw += self.rate * step
+            self.times.append(self.t)
+            self.yaws.append(self.yaw)
+            pose = _SimPose(self.t, 0.0, 0.0, self.yaw)
+            for callback in self.listeners:
+                callback(pose)
+
+    def yaw_at(self, t):
+        return _interpolate(self.times, self.yaws, t)
+
+    def _rotate(self, degrees):
+        self.advance(self.COMMAND_DELAY)
+        self.rate = math.copysign(self.ROTATE_RATE, degrees)
+        self.advance(abs(degrees) / self.ROTATE_RATE)
+        self.rate = 0.0
+
+    def rotate_clockwise(self, degrees):
+        self._rotate(degrees)
+
+    def rotate_counter_clockwise(self, degrees):
+        self._rotate(-degrees)
+
+    def send_rc_control(self, left_right, forward_backward, up_down, yaw):
+        from common.yaw_alignment import RC_YAW, RC_YAW_DEG_PER_S
+        self.rate = yaw / RC_YAW * RC_YAW_DEG_PER_S
+
+
+_SimPose = namedtuple("_SimPose", ["t", "vx", "vy", "yaw"])
+
+
+def simulate_alignment(marker_bearing=40.0, latency=0.45, compensate=True, frame_width=960, focal_px=774.0,
+                       frame_rate=30.0, max_frames=150, seed=0):
+    """ The real YawAligner, fed by the real MarkerPredictor (or the raw detection), onto a marker
+        marker_bearing degrees clockwise with the given video latency. The predictor is configured
+        with the true latency. Returns (overshoot in deg, final error in deg, corrections).
+    """
+    from common import yaw_alignment
+
+    rng = random.Random(seed)
+    drone = _SimDrone()
+    predictor = MarkerPredictor(drone, focal_px=focal_px, latency=LatencyModel(latency, adapt=False))
+    aligner = yaw_alignment.YawAligner(drone, focal_px=focal_px)
+    saved_time, yaw_alignment.time = yaw_alignment.time, _SimClock(drone)
+    try:
+        for _ in range(max_frames):
+            drone.advance(1.0 / frame_rate)  # Wait for the next decoded frame
+            t_frame = drone.t
+            seen = marker_bearing - drone.yaw_at(t_frame - latency)
+            center_x = frame_width / 2 + focal_px * math.tan(math.radians(seen)) + rng.gauss(0.0, 2.0)
+            if compensate:
+                center_x = predictor.predict(0, center_x, 360, 60.0, (720, frame_width), t_frame,
+                                             t_command=drone.t).center_x
+            if aligner.step(0, center_x, frame_width):
+                break
+    finally:
+        yaw_alignment.time = saved_time
+    overshoot = max(0.0, max(math.copysign(1, marker_bearing) * (yaw - marker_bearing) for yaw in drone.yaws))
+    return overshoot, abs(marker_bearing - drone.yaw), aligner.stats[0]['corrections']
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+
+    for latency in (0.2, 0.45, 0.7):
+        for marker_bearing in (15.0, 40.0):
+            with contextlib.redirect_stdout(io.StringIO()):  # The aligner prints every correction
+                raw = simulate_alignment(marker_bearing, latency, compensate=False)
+                predicted = simulate_alignment(marker_bearing, latency, compensate=True)
+            print(f"Latency {latency:.2f} s, marker at {marker_bearing:.0f} deg: raw frames overshoot {raw[0]:.1f} deg, "
+                  f"{raw[2]} corrections, error {raw[1]:.1f} deg; predicted overshoot {predicted[0]:.1f} deg, "
+                  f"{predicted[2]} corrections, error {predicted[1]:.1f} deg")
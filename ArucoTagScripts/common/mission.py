@@ -0,0 +1,392 @@
+import argparse
+import json
+import math
+import time
+from collections import namedtuple
+
+from common.aruco_detection import DICTIONARIES, find_marker
+from common.camera_scheduler import DOWNWARD, FORWARD, CameraScheduler
+from common.detection_confirmation import DetectionConfirmer
+from common.energy import BATTERY_LOG_PATH, MOVE_COMMANDS, ROTATE_COMMANDS, ROTATE_SPEED, SETTLE_TIME, EnergyModel
+from common.state_estimator import TOF_MAX, TOF_MIN
+
+# Declarative missions: a JSON mission file is compiled into a flat command plan before takeoff,
+# and the runtime only executes that plan. See missions/floor_route.json for an example.
+#
+# Mission file:
+#   name, dictionary, camera ("forward" / "downward", the one the stations are verified with), speed (cm/s),
+#   tag_size (printed marker width in cm, default for the stations), takeoff_height (cm after takeoff and the first height change), return_home (bool),
+#   reserve (battery % kept for landing), fallbacks: {"marker_not_found": "search" | "skip" | "land"},
+#   stations: [{marker_id, x, y (cm from the takeoff point, x forward, y right), height, tag_size,
+#               hover (s), verify (bool)}]
+#
+# The compiler checks the SDK ranges, turns the marker map into rotate / move commands with
+# precomputed headings and distances, merges redundant moves, and estimates duration and energy.
+# Before every leg the plan holds a checkpoint with the battery needed for that leg plus the way
+# home from its end; below it the runtime flies the precompiled return instead.
+#
+# Compile only, from the ArucoTagScripts folder:
+#     python -m common.mission missions/floor_route.json
+
+TAKEOFF_HEIGHT = 80  # cm the Tello climbs to on takeoff
+MOVE_MIN, MOVE_MAX = 20, 500
+ROTATE_MIN, ROTATE_MAX = 1, 360
+SPEED_MIN, SPEED_MAX = 10, 100
+HEIGHT_MAX = 500
+TAKEOFF_TIME = 5.0
+VERIFY_TIME = 2.0  # s looking for the station marker
+SEARCH_STEP = 30  # deg per search rotation
+
+CAMERAS = ("forward", "downward")
+FALLBACKS = ("search", "skip", "land")
+
+Step = namedtuple("Step", ["command", "value", "station"])
+Plan = namedtuple("Plan", ["name", "dictionary", "camera", "fallback", "tag_sizes", "steps", "returns", "duration",
+                           "energy", "warnings"])
+TAG_SIZE = 20  # cm, printed marker width when the mission file gives none
+
+# Move directions as (command, opposite command)
+OPPOSITES = {"move_up": "move_down", "move_down": "move_up", "move_forward": "move_back",
+             "move_back": "move_forward", "move_left": "move_right", "move_right": "move_left"}
+
+
+class MissionError(Exception):
+    """ The mission file cannot be flown, message lists every problem found """
+
+
+def load_mission(path):
+    with open(path) as mission_file:
+        return json.load(mission_file)
+
+
+def _check(mission):
+    """ Every problem in the mission file, as messages """
+    problems = []
+    if mission.get("dictionary", "DICT_6X6_250") not in DICTIONARIES:
+        problems.append(f"unknown dictionary {mission.get('dictionary')}")
+    if mission.get("camera", "forward") not in CAMERAS:
+        problems.append(f"camera must be one of {CAMERAS}")
+    speed = mission.get("speed", 40)
+    if not SPEED_MIN <= speed <= SPEED_MAX:
+        problems.append(f"speed {speed} outside the SDK range {SPEED_MIN}-{SPEED_MAX} cm/s")
+    fallback = mission.get("fallbacks", {}).get("marker_not_found", "search")
+    if fallback not in FALLBACKS:
+        problems.append(f"marker_not_found fallback must be one of {FALLBACKS}")
+    takeoff_height = mission.get("takeoff_height", TAKEOFF_HEIGHT)
+    if not 20 <= takeoff_height <= HEIGHT_MAX:
+        problems.append(f"takeoff_height {takeoff_height} outside 20-{HEIGHT_MAX} cm")
+
+    stations = mission.get("stations", [])
+    if not stations:
+        problems.append("no stations")
+    seen = set()
+    for i, station in enumerate(stations):
+        where = f"station {i} (marker {station.get('marker_id')})"
+        if "marker_id" not in station or "x" not in station or "y" not in station:
+            problems.append(f"{where}: marker_id, x and y are required")
+            continue
+        if station["marker_id"] in seen:
+            problems.append(f"{where}: marker ID used twice")
+        seen.add(station["marker_id"])
+        if station.get("tag_size", mission.get("tag_size", TAG_SIZE)) <= 0:
+            problems.append(f"{where}: tag_size must be positive")
+        if not 20 <= station.get("height", takeoff_height) <= HEIGHT_MAX:
+            problems.append(f"{where}: height outside 20-{HEIGHT_MAX} cm")
+        if station.get("hover", 0) < 0:
+            problems.append(f"{where}: negative hover time")
+    return problems
+
+
+def _signed_rotation(step):
+    return step.value if step.command == "rotate_clockwise" else -step.value
+
+
+def _rotation(degrees, station):
+    """ Shortest rotate command for a signed angle, [] for none """
+    degrees = (degrees + 180) % 360 - 180
+    degrees = int(round(degrees))
+    if abs(degrees) < ROTATE_MIN:
+        return []
+    return [Step("rotate_clockwise" if degrees > 0 else "rotate_counter_clockwise", abs(degrees), station)]
+
+
+def _moves(command, distance, station):
+    """ One move command split into equal pieces the SDK accepts, [] below the minimum """
+    distance = int(round(distance))
+    if distance < MOVE_MIN:
+        return []
+    count = -(-distance // MOVE_MAX)
+    pieces = [distance // count + (1 if i < distance % count else 0) for i in range(count)]
+    return [Step(command, piece, station) for piece in pieces]
+
+
+def merge_steps(steps):
+    """ Combine consecutive rotations, add up or cancel consecutive moves along one axis """
+    merged = []
+    for step in steps:
+        previous = merged[-1] if merged else None
+        if previous is not None and previous.station == step.station:
+            if step.command in ROTATE_COMMANDS and previous.command in ROTATE_COMMANDS:
+                merged.pop()
+                merged.extend(_rotation(_signed_rotation(previous) + _signed_rotation(step), step.station))
+                continue
+            if step.command in OPPOSITES and previous.command in (step.command, OPPOSITES[step.command]):
+                merged.pop()
+                total = previous.value + (step.value if previous.command == step.command else -step.value)
+                command = previous.command if total > 0 else OPPOSITES[previous.command]
+                merged.extend(_moves(command, abs(total), step.station))
+                continue
+        merged.append(step)
+    return merged
+
+
+def _leg_steps(position, heading, height, target, target_height, station, warnings):
+    """ Steps from (position, heading, height) to target; returns steps and the new heading and height """
+    steps = []
+    dx, dy = target[0] - position[0], target[1] - position[1]
+    distance = math.hypot(dx, dy)
+    if distance >= MOVE_MIN:
+        bearing = math.degrees(math.atan2(dy, dx))  # Clockwise from the takeoff heading
+        steps.extend(_rotation(bearing - heading, station))
+        heading = bearing
+        steps.extend(_moves("move_forward", distance, station))
+    elif distance > 0:
+        warnings.append(f"leg to station {station} is {distance:.0f} cm, below the {MOVE_MIN} cm move minimum, "
+                        f"flown as part of the search")
+
+    climb = target_height - height
+    if abs(climb) >= MOVE_MIN:
+        steps.extend(_moves("move_up" if climb > 0 else "move_down", abs(climb), station))
+        height = target_height
+    elif climb:
+        warnings.append(f"height change of {climb:.0f} cm at station {station} is below the move minimum, skipped")
+    return steps, heading, height
+
+
+def estimate(steps, model, speed):
+    """ (seconds, battery %) to fly a list of steps """
+    seconds = energy = 0.0
+    for step in steps:
+        if step.command in MOVE_COMMANDS:
+            seconds += step.value / speed + SETTLE_TIME
+            energy += model.command_cost(step.command, step.value, speed)
+        elif step.command in ROTATE_COMMANDS:
+            seconds += step.value / ROTATE_SPEED + SETTLE_TIME
+            energy += model.command_cost(step.command, step.value)
+        elif step.command == "hover":
+            seconds += step.value
+            energy += model.hover_cost(step.value)
+        elif step.command == "verify":
+            seconds += VERIFY_TIME
+            energy += model.hover_cost(VERIFY_TIME)
+        elif step.command in ("takeoff", "land"):
+            seconds += TAKEOFF_TIME
+            energy += model.hover_cost(TAKEOFF_TIME)
+    return seconds, energy
+
+
+def compile_mission(mission, model=None):
+    """ Mission dict -> Plan, raises MissionError listing every problem """
+    problems = _check(mission)
+    if problems:
+        raise MissionError("; ".join(problems))
+    model = model or EnergyModel()
+    speed = mission.get("speed", 40)
+    reserve = mission.get("reserve", 15)
+    takeoff_height = mission.get("takeoff_height", TAKEOFF_HEIGHT)
+    fallback = mission.get("fallbacks", {}).get("marker_not_found", "search")
+    warnings = []
+
+    home = (0.0, 0.0)
+    steps = [Step("set_speed", speed, None), Step("takeoff", 0, None)]
+    climb = takeoff_height - TAKEOFF_HEIGHT
+    if abs(climb) >= MOVE_MIN:
+        steps.extend(_moves("move_up" if climb > 0 else "move_down", abs(climb), None))
+
+    # Legs between stations, with the way home from the end of each leg
+    position, heading, height = home, 0.0, takeoff_height
+    legs = []
+    returns = {}
+    for index, station in enumerate(mission["stations"]):
+        target = (station["x"], station["y"])
+        leg, heading, height = _leg_steps(position, heading, height, target,
+                                          station.get("height", takeoff_height), index, warnings)
+        if station.get("verify", True):
+            leg.append(Step("verify", station["marker_id"], index))
+        if station.get("hover", 0):
+            leg.append(Step("hover", station["hover"], index))
+        position = target
+
+        back, _, _ = _leg_steps(position, heading, height, home, takeoff_height, index, [])
+        returns[index] = merge_steps(back) + [Step("land", 0, index)]
+        legs.append(merge_steps(leg))
+
+    for index, leg in enumerate(legs):
+        # Battery for this leg, the way home from its end, landing and the reserve
+        needed = estimate(leg, model, speed)[1] + estimate(returns[index], model, speed)[1] + reserve
+        steps.append(Step("checkpoint", round(needed, 1), index))
+        steps.extend(leg)
+
+    if mission.get("return_home", True):
+        steps.extend(returns[len(legs) - 1])
+    else:
+        steps.append(Step("land", 0, None))
+
+    duration, energy = estimate(steps, model, speed)
+    # Marker ID -> printed width, the runtime turns the marker width in pixels into a distance with it
+    tag_sizes = {station["marker_id"]: station.get("tag_size", mission.get("tag_size", TAG_SIZE))
+                 for station in mission["stations"]}
+    return Plan(mission.get("name", "mission"), mission.get("dictionary", "DICT_6X6_250"),
+                mission.get("camera", "forward"), fallback, tag_sizes, steps, returns, duration, energy, warnings)
+
+
+def plan_summary(plan):
+    lines = [f"Mission {plan.name}: {len(plan.steps)} steps, about {plan.duration:.0f} s "
+             f"and {plan.energy:.0f}% battery"]
+    lines.extend(f"  {step.command} {step.value}" + (f"  (station {step.station})" if step.station is not None else "")
+                 for step in plan.steps)
+    lines.extend(f"  warning: {warning}" for warning in plan.warnings)
+    return "\n".join(lines)
+
+
+def save_plan(plan, path):
+    with open(path, "w") as plan_file:
+        json.dump({"name": plan.name, "dictionary": plan.dictionary, "camera": plan.camera, "fallback": plan.fallback,
+                   "tag_sizes": {str(k): v for k, v in plan.tag_sizes.items()},
+                   "steps": [list(step) for step in plan.steps],
+                   "returns": {str(k): [list(step) for step in v] for k, v in plan.returns.items()},
+                   "duration": plan.duration, "energy": plan.energy, "warnings": plan.warnings},
+                  plan_file, indent=1)
+
+
+class MissionAbort(Exception):
+    """ A fallback decided to end the mission, the caller lands """
+
+
+class MissionRunner(object):
+    """ Executes a compiled plan step by step. The only decisions in flight are the ones the plan
+        prepared: checkpoints compare the battery to a precomputed number, verify looks for the
+        station marker and applies the marker_not_found fallback.
+    """
+
+    def __init__(self, tello, plan, display=None, calibrations=None):
+        self.tello = tello
+        self.plan = plan
+        self.fallback = plan.fallback
+        self.display = display
+        # Both cameras with the plan's dictionary and the drone's focal lengths (load_calibration),
+        # the stations are verified with plan.camera
+        focal = {name: calibration.focal_px for name, calibration in (calibrations or {}).items()}
+        self.cameras = CameraScheduler(tello, (
+            FORWARD._replace(dictionary=plan.dictionary, focal_px=focal.get("forward", FORWARD.focal_px)),
+            DOWNWARD._replace(dictionary=plan.dictionary, focal_px=focal.get("downward", DOWNWARD.focal_px))))
+        self.confirmer = DetectionConfirmer()
+        self.executed = 0
+        self.start = None
+
+    def run(self):
+        self.start = time.monotonic()
+        if not self.cameras.use(self.plan.camera):
+            print(f"The {self.plan.camera} camera is not confirmed yet, verify waits for its frames")
+        for step in self.plan.steps:
+            if step.command == "checkpoint":
+                battery = self.tello.get_battery()
+                if battery < step.value:
+                    print(f"Battery {battery}% below the {step.value}% needed for station {step.station}, "
+                          f"returning")
+                    self._return_from(step.station - 1)
+                    return False
+            elif step.command == "verify":
+                if not self._verify(step.value):
+                    print(f"Marker {step.value} not found at station {step.station}")
+                    if self.fallback == "land":
+                        raise MissionAbort(f"marker {step.value} not found")
+            elif step.command == "hover":
+                time.sleep(step.value)
+            elif step.command in ("takeoff", "land"):
+                getattr(self.tello, step.command)()
+            else:
+                getattr(self.tello, step.command)(step.value)
+            self.executed += 1
+        return True
+
+    def _return_from(self, station):
+        if station < 0:
+            self.tello.land()
+            return
+        for step in self.plan.returns[station]:
+            if step.command == "land":
+                self.tello.land()
+            else:
+                getattr(self.tello, step.command)(step.value)
+
+    def _look(self, marker_id, seconds):
+        """ True once several frames agree on the marker, one misread frame does not count """
+        deadline = time.monotonic() + seconds
+        self.confirmer.reset("verify", expected_distance=self._expected_distance())
+        while time.monotonic() < deadline:
+            # Only new frames of the plan's camera, the same frame must not vote twice
+            frame = self.cameras.frame()
+            if frame is None:
+                time.sleep(0.005)
+                continue
+            detections = self.cameras.detect(frame)
+            if self.display is not None:
+                self.display.show(frame, detections, f"Looking for marker {marker_id}")
+            marker = find_marker(detections, marker_id)
+            if marker is None:
+                self.confirmer.miss()
+            else:
+                # Pinhole distance from the station's tag size, the confirmer checks its range
+                distance = self.plan.tag_sizes.get(marker_id, TAG_SIZE) * self.cameras.focal_px(frame) / marker.width
+                if self.confirmer.observe(marker.center_x, marker.center_y, marker.width, marker.height,
+                                          frame.shape[1], distance) is not None:
+                    return True
+            time.sleep(0.03)
+        self.confirmer.reset()
+        return False
+
+    def _expected_distance(self):
+        """ ToF height for a marker below the downward camera, None when there is no independent distance """
+        if self.plan.camera != "downward":
+            return None
+        tof = self.tello.get_distance_tof()
+        return tof if TOF_MIN <= tof <= TOF_MAX else None
+
+    def _verify(self, marker_id):
+        if self._look(marker_id, VERIFY_TIME):
+            return True
+        if self.fallback != "search":
+            return False
+        # Turn around in steps and turn back afterwards, so the precomputed headings stay valid
+        turned = 0
+        found = False
+        while turned < 360 - SEARCH_STEP and not found:
+            self.tello.rotate_clockwise(SEARCH_STEP)
+            turned += SEARCH_STEP
+            found = self._look(marker_id, 1.0)
+        if turned:
+            self.tello.rotate_counter_clockwise(turned)
+        return found
+
+    def report(self):
+        seconds = time.monotonic() - self.start if self.start else 0.0
+        return (f"Mission {self.plan.name}: {self.executed}/{len(self.plan.steps)} steps in {seconds:.0f} s "
+                f"(planned {self.plan.duration:.0f} s)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile a mission file into a command plan")
+    parser.add_argument("mission")
+    parser.add_argument("--battery-log", default=BATTERY_LOG_PATH, help="BatteryLogger CSV for the energy model")
+    parser.add_argument("--save", help="write the plan as JSON")
+    args = parser.parse_args()
+
+    try:
+        plan = compile_mission(load_mission(args.mission), EnergyModel.fit_from_log(args.battery_log))
+    except MissionError as error:
+        print(f"Mission rejected: {error}")
+        raise SystemExit(1)
+    print(plan_summary(plan))
+    if args.save:
+        save_plan(plan, args.save)
@@ -0,0 +1,321 @@
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from common.display import InlineDisplay, _Timed, draw_overlay
+
+# MJPEG preview of the camera feed over HTTP, for missions that run on a headless field box.
+#
+# The control thread only hands the frame over: show() returns right away when nobody watches
+# or the frame comes too early for the current rate. Otherwise the frame replaces the one that
+# is waiting for the encoder thread, so a busy encoder skips frames instead of queueing them.
+# The encoder downscales, draws the detections and encodes one JPEG that every viewer shares.
+# Each viewer connection has its own thread and always gets the newest JPEG, a slow viewer
+# misses frames but holds up nobody.
+#
+# Rate and quality adapt after every encoded frame:
+#   rate     at most max_fps, and at most cpu_share of one core spent encoding, halved under load
+#   quality  max_quality minus QUALITY_PER_VIEWER for every viewer after the first (bandwidth grows
+#            with every viewer), lowered further under load
+# Load is the 1 minute load average per core, where the platform has one.
+#
+#     python Floor/main.py --headless --preview          then open http://<field box>:8080/
+#     python -m common.preview_server --source 0         webcam preview to try it without a drone
+
+PREVIEW_PORT = 8080
+PREVIEW_WIDTH = 480
+MAX_FPS = 10.0
+MIN_FPS = 1.0
+CPU_SHARE = 0.15  # Of one core
+MAX_QUALITY = 70
+MIN_QUALITY = 30
+QUALITY_PER_VIEWER = 8
+HIGH_LOAD = 0.9  # Load average per core above which the preview backs off
+BOUNDARY = b"frame"
+
+PAGE = b"""<html><head><title>Tello preview</title></head>
+<body style="margin:0;background:#111;color:#ccc;font-family:sans-serif">
+<img src="/stream.mjpg" style="display:block;max-width:100%">
+<pre id="stats"></pre>
+<script>
+setInterval(function () {
+    fetch("/stats").then(function (r) { return r.json(); }).then(function (s) {
+        document.getElementById("stats").textContent = JSON.stringify(s);
+    });
+}, 1000);
+</script>
+</body></html>
+"""
+
+
+def cpu_load():
+    """ 1 minute load average per core, 0 where the platform has none """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 0.0
+
+
+class _PreviewHandler(BaseHTTPRequestHandler):
+    """ /, /stream.mjpg, /snapshot.jpg and /stats """
+
+    timeout = 10  # A viewer that stops reading is dropped instead of holding its thread forever
+
+    def do_GET(self):
+        preview = self.server.preview
+        if self.path == "/":
+            self._send(200, "text/html", PAGE)
+        elif self.path == "/stats":
+            self._send(200, "application/json", json.dumps(preview.stats()).encode("utf-8"))
+        elif self.path == "/snapshot.jpg":
+            jpeg, _ = preview.wait_jpeg(0, timeout=2.0)
+            if jpeg is None:
+                self._send(503, "text/plain", b"no frame yet")
+            else:
+                self._send(200, "image/jpeg", jpeg)
+        elif self.path == "/stream.mjpg":
+            self._stream(preview)
+        else:
+            self._send(404, "text/plain", b"not found")
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, preview):
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={BOUNDARY.decode()}")
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        preview.add_viewer(1)
+        seq = 0
+        try:
+            while preview.running:
+                jpeg, new_seq = preview.wait_jpeg(seq, timeout=1.0)
+                if jpeg is None:
+                    continue
+                seq = new_seq
+                self.wfile.write(b"--" + BOUNDARY + b"\r\nContent-Type: image/jpeg\r\n"
+                                 + f"Content-Length: {len(jpeg)}\r\n\r\n".encode("ascii") + jpeg + b"\r\n")
+                preview.sent(len(jpeg))
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            pass  # Viewer went away
+        finally:
+            preview.add_viewer(-1)
+
+    def log_message(self, format, *args):
+        pass  # No line per request on the mission's console
+
+
+class PreviewServer(object):
+    """ Serves the newest frames as MJPEG, see the top of the file """
+
+    def __init__(self, port=PREVIEW_PORT, host="0.0.0.0", width=PREVIEW_WIDTH, max_fps=MAX_FPS,
+                 cpu_share=CPU_SHARE):
+        self.width = width
+        self.max_fps = max_fps
+        self.cpu_share = cpu_share
+        self.fps = max_fps
+        self.quality = MAX_QUALITY
+        self.running = True
+
+        self.viewers = 0
+        self.peak_viewers = 0
+        self.next_frame = 0.0
+        self.pending = None  # (frame, detections, text) waiting for the encoder
+        self.pending_lock = threading.Condition()
+        self.jpeg = None
+        self.jpeg_seq = 0
+        self.jpeg_lock = threading.Condition()
+
+        self.offered = 0
+        self.skipped = 0
+        self.encoded = 0
+        self.encode_seconds = 0.0
+        self.encode_mean = 0.0  # s, moving average that drives the rate
+        self.bytes_sent = 0
+
+        self.httpd = ThreadingHTTPServer((host, port), _PreviewHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.preview = self
+        self.port = self.httpd.server_address[1]
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.encoder_thread = threading.Thread(target=self._encode_loop, daemon=True)
+        self.server_thread.start()
+        self.encoder_thread.start()
+
+    # --- Control thread ---
+
+    def offer(self, frame, detections=(), text=None, copy=False):
+        """ Hand a frame over, never waits. The frame must not be written to afterwards unless
+            copy is set, then a copy is handed over (only of the frames the encoder gets).
+        """
+        if not self.viewers or frame is None:
+            return
+        now = time.monotonic()
+        if now < self.next_frame:
+            self.skipped += 1
+            return
+        self.next_frame = now + 1.0 / self.fps
+        if copy:
+            frame = frame.copy()
+        with self.pending_lock:
+            if self.pending is not None:
+                self.skipped += 1  # The encoder did not get to the previous one
+            self.pending = (frame, list(detections), text)
+            self.pending_lock.notify()
+        self.offered += 1
+
+    # --- Encoder thread ---
+
+    def _encode_loop(self):
+        while self.running:
+            with self.pending_lock:
+                while self.pending is None and self.running:
+                    self.pending_lock.wait(0.5)
+                if not self.running:
+                    return
+                frame, detections, text = self.pending
+                self.pending = None
+
+            start = time.perf_counter()
+            jpeg = self._encode(frame, detections, text)
+            seconds = time.perf_counter() - start
+            self.encoded += 1
+            self.encode_seconds += seconds
+            self.encode_mean = seconds if self.encoded == 1 else 0.8 * self.encode_mean + 0.2 * seconds
+            self._adapt()
+
+            if jpeg is not None:
+                with self.jpeg_lock:
+                    self.jpeg = jpeg
+                    self.jpeg_seq += 1
+                    self.jpeg_lock.notify_all()
+
+    def _encode(self, frame, detections, text):
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.width / width)
+        if scale < 1.0:
+            image = cv2.resize(frame, (self.width, int(height * scale)), interpolation=cv2.INTER_AREA)
+        else:
+            image = frame.copy()
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        detections = [detection._replace(corners=np.asarray(detection.corners, dtype=np.float32) * scale)
+                      for detection in detections]
+        draw_overlay(image, detections, text)
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return encoded.tobytes() if ok else None
+
+    def _adapt(self):
+        loaded = cpu_load() > HIGH_LOAD
+        fps = min(self.max_fps, self.cpu_share / max(self.encode_mean, 1e-4))
+        if loaded:
+            fps /= 2
+        self.fps = max(MIN_FPS, fps)
+        quality = MAX_QUALITY - QUALITY_PER_VIEWER * max(0, self.viewers - 1) - (15 if loaded else 0)
+        self.quality = max(MIN_QUALITY, quality)
+
+    # --- Viewer threads ---
+
+    def add_viewer(self, change):
+        with self.jpeg_lock:
+            self.viewers += change
+            self.peak_viewers = max(self.peak_viewers, self.viewers)
+        self._adapt()
+
+    def wait_jpeg(self, last_seq, timeout):
+        """ The newest JPEG once it is newer than last_seq, (None, last_seq) after timeout seconds """
+        with self.jpeg_lock:
+            if self.jpeg_seq == last_seq or self.jpeg is None:
+                self.jpeg_lock.wait(timeout)
+            if self.jpeg_seq == last_seq or self.jpeg is None:
+                return None, last_seq
+            return self.jpeg, self.jpeg_seq
+
+    def sent(self, size):
+        self.bytes_sent += size
+
+    def stats(self):
+        return {"viewers": self.viewers, "fps": round(self.fps, 1), "quality": self.quality, "width": self.width,
+                "encode_ms": round(self.encode_mean * 1000, 2), "encoded": self.encoded, "skipped": self.skipped,
+                "load": round(cpu_load(), 2)}
+
+    def report(self):
+        mean = self.encode_seconds / self.encoded * 1000 if self.encoded else 0.0
+        return (f"Preview on port {self.port}: {self.encoded} frames encoded ({mean:.1f} ms mean, off the control "
+                f"thread), {self.skipped} skipped, peak {self.peak_viewers} viewers, "
+                f"{self.bytes_sent / 1e6:.1f} MB sent")
+
+    def close(self):
+        self.running = False
+        with self.pending_lock:
+            self.pending_lock.notify()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.encoder_thread.join(timeout=2)
+
+
+class PreviewDisplay(_Timed):
+    """ Any other display plus the MJPEG preview, the control thread pays for offer() only """
+
+    def __init__(self, display, port=PREVIEW_PORT):
+        super().__init__()
+        self.display = display
+        # The inline display draws the overlays into the frame itself, the encoder needs its own copy
+        self.copy = isinstance(display, InlineDisplay)
+        self.server = PreviewServer(port)
+        print(f"Camera preview on http://0.0.0.0:{self.server.port}/")
+
+    def show(self, frame, detections=(), text=None):
+        start = time.perf_counter()
+        # Before the inner display, which may draw into the frame
+        self.server.offer(frame, detections, text, copy=self.copy)
+        self.display.show(frame, detections, text)
+        self.add(time.perf_counter() - start)
+
+    def stop_requested(self):
+        return self.display.stop_requested()
+
+    def summary(self):
+        return f"{super().summary()}\n{self.server.report()}"
+
+    def close(self):
+        self.server.close()
+        self.display.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MJPEG preview of a webcam or video file")
+    parser.add_argument("--source", default="0", help="camera index or video file")
+    parser.add_argument("--port", type=int, default=PREVIEW_PORT)
+    args = parser.parse_args()
+
+    capture = cv2.VideoCapture(int(args.source) if args.source.isdigit() else args.source)
+    server = PreviewServer(args.port)
+    print(f"Preview on http://localhost:{server.port}/, Ctrl+C to stop")
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, 0)  # Loop video files
+                time.sleep(0.03)
+                continue
+            server.offer(frame, text=json.dumps(server.stats()))
+            time.sleep(1 / 30)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(server.report())
+        server.close()
+        capture.release()
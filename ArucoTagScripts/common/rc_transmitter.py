@@ -0,0 +1,113 @@
+import threading
+import time
+
+# rc stick stream for manual control, sent from its own thread.
+#
+# The keyboard sets target velocities with set(). The transmitter ramps the velocities it sends
+# towards the target at ramp units per second and sends an rc packet only when the rounded
+# values changed, at most max_rate packets per second. While nothing changes it repeats the
+# last packet keepalive times per second so the drone keeps the velocity and the link stays up.
+#
+# Latency is measured from set() to the first packet carrying the full target.
+
+
+def _percentile(values, share):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+class RcTransmitter(object):
+    """ Send-on-change, rate-limited rc sender with keepalive and velocity ramping """
+
+    def __init__(self, tello, max_rate=30.0, keepalive=5.0, ramp=600.0, tick=0.005):
+        self.tello = tello
+        self.min_gap = 1.0 / max_rate
+        self.keepalive_gap = 1.0 / keepalive
+        self.ramp = ramp  # Stick units per second, 600 goes from 0 to 60 in 0.1 s
+        self.tick = tick
+
+        self.target = (0, 0, 0, 0)  # left_right, for_back, up_down, yaw
+        self.current = [0.0, 0.0, 0.0, 0.0]
+        self.last_sent = None
+        self.last_send_time = 0.0
+        self.enabled = False
+        self.changed_at = None  # Time of the set() whose target has not been sent in full yet
+
+        self.packets = 0
+        self.keepalives = 0
+        self.latencies = []
+        self.started = None
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.started = time.monotonic()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+
+    def set(self, left_right, for_back, up_down, yaw):
+        target = (left_right, for_back, up_down, yaw)
+        with self.lock:
+            if target != self.target:
+                self.target = target
+                self.changed_at = time.monotonic()
+
+    def enable(self, enabled):
+        """ Start or stop sending, e.g. after takeoff and before land. Velocities restart from zero. """
+        with self.lock:
+            self.enabled = enabled
+            self.current = [0.0, 0.0, 0.0, 0.0]
+            self.last_sent = None
+            self.changed_at = None
+
+    def _run(self):
+        previous = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            dt = now - previous
+            previous = now
+            with self.lock:
+                enabled = self.enabled
+                target = self.target
+                step = self.ramp * dt
+                for i in range(4):
+                    difference = target[i] - self.current[i]
+                    self.current[i] += max(-step, min(step, difference))
+                values = tuple(int(round(value)) for value in self.current)
+                changed_at = self.changed_at
+
+            if enabled:
+                since = now - self.last_send_time
+                if values != self.last_sent and since >= self.min_gap:
+                    self._send(values, now)
+                    if changed_at is not None and values == target:
+                        with self.lock:
+                            if self.changed_at == changed_at:
+                                self.changed_at = None
+                        self.latencies.append(now - changed_at)
+                elif since >= self.keepalive_gap:
+                    self._send(values, now)
+                    self.keepalives += 1
+            time.sleep(self.tick)
+
+    def _send(self, values, now):
+        self.tello.send_rc_control(*values)
+        self.last_sent = values
+        self.last_send_time = now
+        self.packets += 1
+
+    def report(self):
+        seconds = time.monotonic() - self.started if self.started else 0.0
+        rate = self.packets / seconds if seconds else 0.0
+        return (f"rc stream: {self.packets} packets in {seconds:.0f} s ({rate:.1f}/s), {self.keepalives} keepalives, "
+                f"control latency p50 {_percentile(self.latencies, 0.5) * 1000:.0f} ms, "
+                f"p90 {_percentile(self.latencies, 0.9) * 1000:.0f} ms")
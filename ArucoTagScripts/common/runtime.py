@@ -0,0 +1,34 @@
+import argparse
+
+# Command line flags shared by the mission scripts, e.g.
+#     python Floor/main.py --headless            no GUI work at all on the control path
+#     python Floor/main.py --headless --viewer   camera view drawn by a separate viewer process
+#     python Floor/main.py --trajectory          fly past the stations recorded by the last flight
+#     python Floor/runMission.py --mission missions/floor_route.json --plan-only
+#     python Floor/main.py --headless --preview  MJPEG preview on http://<this machine>:8080/
+#     python Floor/main.py --feed multicast      publish detections for python -m common.detection_feed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Tello ArUco mission")
+    parser.add_argument("--headless", action="store_true",
+                        help="do not draw or show anything on the control thread")
+    parser.add_argument("--viewer", action="store_true",
+                        help="show the camera feed and detections in a separate viewer process")
+    parser.add_argument("--detector-profile", default=None,
+                        help="tuned detector profile from common.detector_tuning, e.g. forward_960x720_balanced")
+    parser.add_argument("--trajectory", action="store_true",
+                        help="fly the route recorded by an earlier leg-by-leg flight as one smooth trajectory")
+    parser.add_argument("--mission", default=None,
+                        help="declarative mission file compiled into a command plan before takeoff")
+    parser.add_argument("--plan-only", action="store_true",
+                        help="compile and print the mission plan without connecting to the drone")
+    parser.add_argument("--preview", type=int, nargs="?", const=8080, default=None, metavar="PORT",
+                        help="serve a downscaled MJPEG preview with the detections over HTTP")
+    parser.add_argument("--feed", default=None, choices=["multicast", "unix"],
+                        help="publish every frame's detections and telemetry to local subscribers")
+    parser.add_argument("--marker-width", type=float, default=None, metavar="CM",
+                        help="printed width of the tags in cm, it scales every distance the wall missions fly")
+    # Unknown flags are ignored so scripts can add their own
+    args, _ = parser.parse_known_args(argv)
+    return args
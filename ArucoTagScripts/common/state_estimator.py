@@ -0,0 +1,405 @@
+import bisect
+import csv
+import math
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# Frames used here follow the Tello: x forward, y right, z down, yaw positive clockwise.
+# The world frame is the body frame at takeoff, so height = -z.
+GRAVITY = 981.0  # cm/s^2
+ACCEL_SCALE = GRAVITY / 1000.0  # agx/agy/agz are reported in milli-g
+VELOCITY_SCALE = 10.0  # vgx/vgy/vgz are reported in dm/s
+TOF_MIN = 15  # cm, the ToF reports about 10 when it has no valid reading
+TOF_MAX = 800
+
+Pose = namedtuple("Pose", ["t", "x", "y", "z", "vx", "vy", "vz", "yaw", "height"])
+
+
+def _rz(yaw):
+    c, s = math.cos(yaw), math.sin(yaw)
+    return np.array([[c, -s], [s, c]])
+
+
+def _rz_derivative(yaw):
+    c, s = math.cos(yaw), math.sin(yaw)
+    return np.array([[-s, -c], [c, -s]])
+
+
+def _tilt(roll, pitch):
+    """ Rotation from the body frame to the level (yaw-only) frame """
+    cr, sr = math.cos(roll), math.sin(roll)
+    cp, sp = math.cos(pitch), math.sin(pitch)
+    rx = np.array([[1, 0, 0], [0, cr, -sr], [0, sr, cr]])
+    ry = np.array([[cp, 0, sp], [0, 1, 0], [-sp, 0, cp]])
+    return ry @ rx
+
+
+def _wrap(angle):
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+class StateEstimator(object):
+    """ Extended Kalman filter fusing the Tello state stream with ArUco marker measurements.
+        State: position (x, y, z) and velocity (vx, vy, vz) in cm and cm/s, and yaw in radians.
+        Accelerations drive the prediction, velocities, ToF height and yaw from the state
+        packet are measurements, and markers give position fixes.
+
+        Camera measurements arrive a few hundred ms late. Every processed packet is kept for
+        history_seconds together with the filter state after it; a late measurement rewinds to
+        the last state before its capture time, is applied there, and the newer packets are replayed.
+    """
+
+    def __init__(self, accel_noise=60.0, yaw_noise=0.05, velocity_noise=10.0, height_noise=3.0,
+                 yaw_measurement_noise=0.02, history_seconds=1.5):
+        self.accel_noise = accel_noise  # cm/s^2 white noise on the acceleration input
+        self.yaw_noise = yaw_noise  # rad/sqrt(s) random walk of the yaw state
+        self.velocity_noise = velocity_noise  # cm/s
+        self.height_noise = height_noise  # cm
+        self.yaw_measurement_noise = yaw_measurement_noise  # rad
+        self.history_seconds = history_seconds
+
+        self.x = np.zeros(7)
+        self.P = np.diag([1.0, 1.0, 1.0, 10.0, 10.0, 10.0, 0.1]) ** 2
+        self.t = None
+
+        # (time, kind, data) events with the filter state after each one, for latency compensation
+        self.events = []
+        self.event_times = []
+        self.snapshots = []
+
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.delayed_updates = 0
+
+    # --- Filter steps ---------------------------------------------------------------------
+
+    def _predict(self, dt, accel_body, roll, pitch):
+        if dt <= 0:
+            return
+        yaw = self.x[6]
+        accel_level = _tilt(roll, pitch) @ accel_body  # Specific force in the yaw-only frame
+        horizontal = accel_level[:2]
+        accel_world = np.empty(3)
+        accel_world[:2] = _rz(yaw) @ horizontal
+        accel_world[2] = accel_level[2] + GRAVITY
+
+        self.x[0:3] += self.x[3:6] * dt + 0.5 * accel_world * dt * dt
+        self.x[3:6] += accel_world * dt
+
+        F = np.eye(7)
+        F[0:3, 3:6] = np.eye(3) * dt
+        d_accel = _rz_derivative(yaw) @ horizontal
+        F[0:2, 6] = 0.5 * dt * dt * d_accel
+        F[3:5, 6] = dt * d_accel
+
+        G = np.vstack([np.eye(3) * 0.5 * dt * dt, np.eye(3) * dt])
+        Q = np.zeros((7, 7))
+        Q[0:6, 0:6] = G @ G.T * self.accel_noise ** 2
+        Q[6, 6] = self.yaw_noise ** 2 * dt
+        self.P = F @ self.P @ F.T + Q
+
+    def _update(self, innovation, H, R):
+        S = H @ self.P @ H.T + R
+        K = self.P @ H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ innovation
+        self.x[6] = _wrap(self.x[6])
+        self.P = (np.eye(7) - K @ H) @ self.P
+
+    def _update_velocity(self, velocity_body):
+        yaw = self.x[6]
+        predicted = np.empty(3)
+        predicted[:2] = _rz(yaw).T @ self.x[3:5]
+        predicted[2] = self.x[5]
+        H = np.zeros((3, 7))
+        H[0:2, 3:5] = _rz(yaw).T
+        H[0:2, 6] = _rz_derivative(yaw).T @ self.x[3:5]
+        H[2, 5] = 1.0
+        self._update(velocity_body - predicted, H, np.eye(3) * self.velocity_noise ** 2)
+
+    def _update_height(self, height):
+        H = np.zeros((1, 7))
+        H[0, 2] = -1.0
+        self._update(np.array([height + self.x[2]]), H, np.array([[self.height_noise ** 2]]))
+
+    def _update_yaw(self, yaw):
+        H = np.zeros((1, 7))
+        H[0, 6] = 1.0
+        self._update(np.array([_wrap(yaw - self.x[6])]), H, np.array([[self.yaw_measurement_noise ** 2]]))
+
+    def _update_position(self, position, noise):
+        H = np.zeros((3, 7))
+        H[:, 0:3] = np.eye(3)
+        self._update(np.asarray(position, dtype=float) - self.x[0:3], H, np.eye(3) * noise ** 2)
+
+    def _update_marker(self, marker_world, offset_body, noise):
+        """ offset_body: marker position relative to the drone as (forward, right, down) in cm """
+        yaw = self.x[6]
+        delta = np.asarray(marker_world, dtype=float) - self.x[0:3]
+        predicted = np.empty(3)
+        predicted[:2] = _rz(yaw).T @ delta[:2]
+        predicted[2] = delta[2]
+        H = np.zeros((3, 7))
+        H[0:2, 0:2] = -_rz(yaw).T
+        H[2, 2] = -1.0
+        H[0:2, 6] = _rz_derivative(yaw).T @ delta[:2]
+        self._update(np.asarray(offset_body, dtype=float) - predicted, H, np.eye(3) * noise ** 2)
+
+    # --- Events -----------------------------------------------------------------------------
+
+    def _apply(self, t, kind, data):
+        if kind == 'state':
+            if self.t is not None:
+                self._predict(t - self.t, data['accel'], data['roll'], data['pitch'])
+            self.t = t
+            self._update_yaw(data['yaw'])
+            self._update_velocity(data['velocity'])
+            if data['height'] is not None:
+                self._update_height(data['height'])
+        elif kind == 'position':
+            self._update_position(data['position'], data['noise'])
+        elif kind == 'marker':
+            self._update_marker(data['marker_world'], data['offset'], data['noise'])
+
+    def _record(self, t, kind, data):
+        index = bisect.bisect_right(self.event_times, t)
+        if index < len(self.events):
+            if index == 0:
+                return  # Older than the whole history window, nothing to rewind to
+            # Late measurement: rewind to the state before it and replay the newer packets
+            self.delayed_updates += 1
+            x, P, t_previous = self.snapshots[index - 1]
+            self.x, self.P, self.t = x.copy(), P.copy(), t_previous
+            replay = self.events[index:]
+            del self.events[index:], self.event_times[index:], self.snapshots[index:]
+            self._add(t, kind, data)
+            for event in replay:
+                self._add(*event)
+        else:
+            self._add(t, kind, data)
+
+        # Forget events older than the history window
+        cutoff = bisect.bisect_left(self.event_times, self.event_times[-1] - self.history_seconds)
+        if cutoff > 0:
+            del self.events[:cutoff], self.event_times[:cutoff], self.snapshots[:cutoff]
+
+    def _add(self, t, kind, data):
+        self._apply(t, kind, data)
+        self.events.append((t, kind, data))
+        self.event_times.append(t)
+        self.snapshots.append((self.x.copy(), self.P.copy(), self.t))
+
+    # --- Public interface --------------------------------------------------------------------
+
+    def process_state(self, state, t=None):
+        """ Feed one state packet as returned by tello.get_current_state() """
+        t = time.monotonic() if t is None else t
+        tof = float(state.get('tof', 0))
+        height = tof if TOF_MIN <= tof <= TOF_MAX else (float(state['h']) if 'h' in state else None)
+        data = {
+            'accel': np.array([float(state['agx']), float(state['agy']), float(state['agz'])]) * ACCEL_SCALE,
+            'velocity': np.array([float(state['vgx']), float(state['vgy']), float(state['vgz'])]) * VELOCITY_SCALE,
+            'roll': math.radians(float(state['roll'])),
+            'pitch': math.radians(float(state['pitch'])),
+            'yaw': math.radians(float(state['yaw'])),
+            'height': height,
+        }
+        with self.lock:
+            self._record(t, 'state', data)
+            pose = self.pose_locked()
+        self._publish(pose)
+        return pose
+
+    def add_position(self, t_capture, position, noise=8.0):
+        """ Drone position (x, y, z) in cm from a camera frame captured at t_capture """
+        with self.lock:
+            self._record(t_capture, 'position', {'position': position, 'noise': noise})
+            pose = self.pose_locked()
+        self._publish(pose)
+        return pose
+
+    def add_marker(self, t_capture, marker_world, offset_body, noise=8.0):
+        """ A marker with known map position seen at offset_body = (forward, right, down) cm """
+        with self.lock:
+            self._record(t_capture, 'marker', {'marker_world': marker_world, 'offset': offset_body, 'noise': noise})
+            pose = self.pose_locked()
+        self._publish(pose)
+        return pose
+
+    def pose_locked(self):
+        x = self.x
+        return Pose(self.t, x[0], x[1], x[2], x[3], x[4], x[5], math.degrees(x[6]), -x[2])
+
+    def pose(self):
+        with self.lock:
+            return self.pose_locked()
+
+    def subscribe(self, callback):
+        """ Call callback(pose) after every packet, i.e. at state-packet rate """
+        self.listeners.append(callback)
+
+    def _publish(self, pose):
+        for callback in self.listeners:
+            callback(pose)
+
+
+class MarkerMap(object):
+    """ Floor markers as landmarks for the estimator. A marker's world position comes from a recorded
+        route or from the pose at its first sighting; every later sighting is a position fix through
+        add_marker, so the drift of the moves between sightings does not add up. A sighting further
+        than max_jump cm from where the pose expects the marker is not applied (wrong ID, bad width).
+    """
+
+    def __init__(self, estimator, noise=8.0, noise_per_cm=0.05, max_jump=100.0):
+        self.estimator = estimator
+        self.noise = noise  # cm, at zero distance
+        self.noise_per_cm = noise_per_cm  # Added per cm of distance, the width gets less exact far away
+        self.max_jump = max_jump
+        self.positions = {}
+        self.fixes = 0
+        self.rejected = 0
+
+    def set(self, marker_id, x, y, z=0.0):
+        """ Known world position in cm, z = 0 is the floor at takeoff """
+        self.positions[marker_id] = (x, y, z)
+
+    def observe(self, marker_id, t_capture, forward, right, height, noise=None):
+        """ Marker seen at (forward, right) cm from the drone on the floor height cm below.
+            Returns the corrected pose, or None when the sighting only placed the marker or was rejected.
+        """
+        if height is None:
+            return None
+        pose = self.estimator.pose()
+        yaw = math.radians(pose.yaw)
+        offset = _rz(yaw) @ np.array([forward, right])
+        seen = (pose.x + offset[0], pose.y + offset[1], pose.z + height)
+        known = self.positions.get(marker_id)
+        if known is None:
+            self.positions[marker_id] = seen
+            return None
+        if math.hypot(seen[0] - known[0], seen[1] - known[1]) > self.max_jump:
+            self.rejected += 1
+            return None
+        if noise is None:
+            noise = self.noise + self.noise_per_cm * math.hypot(forward, right)
+        self.fixes += 1
+        return self.estimator.add_marker(t_capture, known, (forward, right, height), noise)
+
+    def report(self):
+        return (f"Marker map: {len(self.positions)} markers, {self.fixes} position fixes, "
+                f"{self.rejected} sightings rejected")
+
+
+class StateFeed(object):
+    """ Background thread that polls the Tello state and feeds the estimator.
+        djitellopy receives the state packets itself, a packet is new when its content changes.
+        If recorder_path is given, every packet is also written to CSV for replay_state_log.
+    """
+
+    def __init__(self, tello, estimator, rate=100, recorder_path=None):
+        self.tello = tello
+        self.estimator = estimator
+        self.period = 1.0 / rate
+        self.running = False
+        self.thread = None
+        self.recorder_path = recorder_path
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        last = None
+        writer = None
+        log_file = None
+        while self.running:
+            state = self.tello.get_current_state()
+            if state and state != last:
+                t = time.monotonic()
+                self.estimator.process_state(state, t)
+                if self.recorder_path is not None:
+                    if writer is None:
+                        log_file = open(self.recorder_path, 'w', newline='')
+                        writer = csv.DictWriter(log_file, fieldnames=['t'] + list(state.keys()))
+                        writer.writeheader()
+                    writer.writerow(dict(state, t=f"{t:.4f}"))
+                last = dict(state)
+            time.sleep(self.period)
+        if log_file is not None:
+            log_file.close()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+
+
+def replay_state_log(path, estimator=None):
+    """ Run a CSV written by StateFeed through the estimator and return the list of poses """
+    estimator = estimator or StateEstimator()
+    poses = []
+    with open(path, newline='') as log_file:
+        for row in csv.DictReader(log_file):
+            t = float(row.pop('t'))
+            poses.append(estimator.process_state(row, t))
+    return poses
+
+
+# --- Simulation -------------------------------------------------------------------------
+# Run from the ArucoTagScripts folder: python -m common.state_estimator
+
+def simulate(duration=20.0, state_rate=50.0, vision_rate=10.0, vision_latency=0.25,
+             compensate=True, seed=0):
+    """ Fly a figure eight with a constant yaw rate, generate noisy state packets and delayed marker
+        position fixes, and return the position RMSE of the estimate in cm.
+    """
+    rng = np.random.default_rng(seed)
+    estimator = StateEstimator()
+    dt = 1.0 / state_rate
+    vision_every = int(state_rate / vision_rate)
+    pending = []  # (arrival time, capture time, position)
+    errors = []
+
+    for step in range(int(duration * state_rate)):
+        t = step * dt
+        w = 2 * math.pi / 10.0
+        position = np.array([200 * math.sin(w * t), 100 * math.sin(2 * w * t), -100.0])
+        velocity = np.array([200 * w * math.cos(w * t), 200 * w * math.cos(2 * w * t), 0.0])
+        accel = np.array([-200 * w * w * math.sin(w * t), -400 * w * w * math.sin(2 * w * t), 0.0])
+        yaw = _wrap(0.3 * t)
+
+        # Body-frame measurements as the Tello would report them (level flight)
+        accel_body = np.empty(3)
+        accel_body[:2] = _rz(yaw).T @ accel[:2]
+        accel_body[2] = -GRAVITY
+        velocity_body = _rz(yaw).T @ velocity[:2]
+        state = {
+            'agx': (accel_body[0] + rng.normal(0, 30)) / ACCEL_SCALE,
+            'agy': (accel_body[1] + rng.normal(0, 30)) / ACCEL_SCALE,
+            'agz': (accel_body[2] + rng.normal(0, 30)) / ACCEL_SCALE,
+            'vgx': (velocity_body[0] + rng.normal(0, 8)) / VELOCITY_SCALE,
+            'vgy': (velocity_body[1] + rng.normal(0, 8)) / VELOCITY_SCALE,
+            'vgz': rng.normal(0, 8) / VELOCITY_SCALE,
+            'roll': 0.0, 'pitch': 0.0, 'yaw': math.degrees(yaw) + rng.normal(0, 1),
+            'tof': -position[2] + rng.normal(0, 2), 'h': -position[2],
+        }
+        estimator.process_state(state, t)
+
+        if step % vision_every == 0:
+            pending.append((t + vision_latency, t, position + rng.normal(0, 5, 3)))
+        while pending and pending[0][0] <= t:
+            _, t_capture, measured = pending.pop(0)
+            estimator.add_position(t_capture if compensate else t, measured)
+
+        estimate = estimator.pose()
+        errors.append(np.linalg.norm(np.array([estimate.x, estimate.y, estimate.z]) - position))
+
+    return float(np.sqrt(np.mean(np.square(errors[int(state_rate):]))))
+
+
+if __name__ == '__main__':
+    print(f"RMSE with latency compensation:    {simulate(compensate=True):.1f} cm")
+    print(f"RMSE without latency compensation: {simulate(compensate=False):.1f} cm")
@@ -0,0 +1,149 @@
+import argparse
+import multiprocessing as mp
+import os
+import random
+import socket
+import tempfile
+import time
+
+from common.station_transfer import (ERROR, GET, HEADER, MAGIC, META_REQ, StationClient, make_meta,
+                                     pack_data, pack_meta, unpack, unpack_get)
+
+# Local stand-in for a WSN sensor station, for testing and benchmarking StationClient offline.
+# Run from the ArucoTagScripts folder:
+#     python -m common.station_emulator --port 9100 --size 2000000 --loss 0.05
+#     python -m common.station_emulator --benchmark
+
+
+def sensor_dataset(size, seed=0):
+    """ CSV of slowly changing sensor readings, compresses about as well as real station logs """
+    rng = random.Random(seed)
+    temperature, humidity = 20.0, 50.0
+    lines = []
+    length = 0
+    timestamp = 1700000000
+    while length < size:
+        temperature += rng.uniform(-0.05, 0.05)
+        humidity += rng.uniform(-0.2, 0.2)
+        line = f"{timestamp},{temperature:.2f},{humidity:.1f},{rng.randint(0, 1023)}\n"
+        lines.append(line)
+        length += len(line)
+        timestamp += 60
+    return "".join(lines).encode("ascii")[:size]
+
+
+class StationEmulator(object):
+    """ Serves datasets over the station_transfer protocol with configurable packet loss.
+        loss drops that share of packets in both directions, bandwidth (bytes/s) limits the link.
+    """
+
+    def __init__(self, datasets, host="127.0.0.1", port=9100, loss=0.0, bandwidth=None, seed=0):
+        self.datasets = datasets
+        self.address = (host, port)
+        self.loss = loss
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        self.metas = {name: make_meta(data) for name, data in datasets.items()}
+        self.packets = {}  # (dataset, chunk index) -> DATA packet, compressed once
+        self.current = None  # Dataset of the last META request, GET refers to it
+
+    def _packet(self, name, index):
+        key = (name, index)
+        if key not in self.packets:
+            meta = self.metas[name]
+            chunk = self.datasets[name][index * meta.chunk_size:(index + 1) * meta.chunk_size]
+            self.packets[key] = pack_data(index, chunk)
+        return self.packets[key]
+
+    def _lost(self):
+        return self.loss > 0 and self.random.random() < self.loss
+
+    def serve_forever(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+        sock.bind(self.address)
+        budget_start = time.monotonic()
+        sent_bytes = 0
+
+        while True:
+            packet, client = sock.recvfrom(65535)
+            if self._lost():
+                continue
+            kind, body = unpack(packet)
+
+            if kind == META_REQ:
+                name = body.decode("utf-8", "replace")
+                if name not in self.metas:
+                    sock.sendto(HEADER.pack(MAGIC, ERROR) + b"unknown dataset", client)
+                    continue
+                self.current = name
+                sock.sendto(pack_meta(self.metas[name]), client)
+
+            elif kind == GET and self.current is not None:
+                meta = self.metas[self.current]
+                for index in unpack_get(body):
+                    if index >= meta.chunk_count:
+                        continue
+                    data = self._packet(self.current, index)
+                    if self.bandwidth:
+                        # Token bucket: wait until the link would have carried this packet
+                        sent_bytes += len(data)
+                        delay = sent_bytes / self.bandwidth - (time.monotonic() - budget_start)
+                        if delay > 0:
+                            time.sleep(delay)
+                        elif delay < -0.1:
+                            budget_start, sent_bytes = time.monotonic(), 0  # Link was idle
+                    if self._lost():
+                        continue
+                    sock.sendto(data, client)
+
+
+def run_emulator(port, size, loss, bandwidth=None, dataset="station"):
+    StationEmulator({dataset: sensor_dataset(size)}, port=port, loss=loss, bandwidth=bandwidth).serve_forever()
+
+
+def benchmark(sizes=(200_000, 2_000_000), losses=(0.0, 0.05, 0.2), port=9100):
+    """ Throughput of StationClient against the emulator, plus one resumed transfer """
+    with tempfile.TemporaryDirectory() as folder:
+        for size in sizes:
+            for loss in losses:
+                process = mp.Process(target=run_emulator, args=(port, size, loss), daemon=True)
+                process.start()
+                time.sleep(0.5)
+
+                path = os.path.join(folder, f"station_{size}_{loss}.csv")
+                result = StationClient().collect(("127.0.0.1", port), "station", path)
+                print(f"{size / 1e6:5.1f} MB, loss {loss:4.0%}: complete={result.complete} in {result.seconds:5.2f} s, "
+                      f"{result.throughput / 1e6:6.2f} MB/s, {result.requests} GETs, {result.retransmits} retransmits")
+
+                process.terminate()
+                process.join()
+                port += 1
+
+        # A visit cut short by the hover budget, then resumed at the next visit
+        process = mp.Process(target=run_emulator, args=(port, 5_000_000, 0.05, 500_000), daemon=True)
+        process.start()
+        time.sleep(0.5)
+        path = os.path.join(folder, "resumed.csv")
+        first = StationClient().collect(("127.0.0.1", port), "station", path, max_time=1.0)
+        second = StationClient().collect(("127.0.0.1", port), "station", path)
+        print(f"resume: first visit {first.received_bytes / 1e6:.2f} MB (complete={first.complete}), "
+              f"second visit {second.received_bytes / 1e6:.2f} MB (complete={second.complete})")
+        process.terminate()
+        process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local WSN station stand-in")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--size", type=int, default=2_000_000, help="dataset size in bytes")
+    parser.add_argument("--loss", type=float, default=0.0, help="packet loss rate in both directions")
+    parser.add_argument("--bandwidth", type=float, default=None, help="link limit in bytes/s")
+    parser.add_argument("--benchmark", action="store_true")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark()
+    else:
+        print(f"Station emulator on port {args.port}: {args.size} bytes, loss {args.loss:.0%}")
+        run_emulator(args.port, args.size, args.loss, args.bandwidth)
@@ -0,0 +1,246 @@
+import hashlib
+import os
+import socket
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+# Bulk transfer protocol between the drone (client) and a WSN station (server), over UDP.
+#
+#   META_REQ  client -> station   dataset name
+#   META      station -> client   total size, chunk size, chunk count, sha256 of the dataset
+#   GET       client -> station   list of chunk indices (one window)
+#   DATA      station -> client   chunk index, crc32 of the raw chunk, flags, payload
+#
+# The client keeps requesting the chunks it is missing, with up to `window` chunks in flight,
+# until every chunk is there. Received chunks are written straight into a .part file and a
+# .chunks bitmap, so a transfer cut short by the hover budget resumes at the next visit.
+
+MAGIC = b"WS"
+META_REQ = 1
+META = 2
+GET = 3
+DATA = 4
+ERROR = 5
+
+FLAG_COMPRESSED = 1
+
+HEADER = struct.Struct("!2sB")
+META_BODY = struct.Struct("!QHI32s")
+GET_COUNT = struct.Struct("!H")
+DATA_HEADER = struct.Struct("!IIBH")
+
+CHUNK_SIZE = 1200  # Raw bytes per chunk, keeps every datagram below a typical MTU
+MAX_GET = 256  # Chunk indices per GET packet
+
+Meta = namedtuple("Meta", ["size", "chunk_size", "chunk_count", "sha256"])
+TransferResult = namedtuple("TransferResult", ["complete", "received_bytes", "seconds", "throughput",
+                                               "requests", "retransmits", "path"])
+
+
+def pack_meta_request(dataset):
+    return HEADER.pack(MAGIC, META_REQ) + dataset.encode("utf-8")
+
+
+def pack_meta(meta):
+    return HEADER.pack(MAGIC, META) + META_BODY.pack(meta.size, meta.chunk_size, meta.chunk_count, meta.sha256)
+
+
+def pack_get(indices):
+    return HEADER.pack(MAGIC, GET) + GET_COUNT.pack(len(indices)) + struct.pack(f"!{len(indices)}I", *indices)
+
+
+def pack_data(index, chunk, compress=True):
+    """ DATA packet for one raw chunk, compressed if that makes it smaller """
+    payload = chunk
+    flags = 0
+    if compress:
+        packed = zlib.compress(chunk, 1)
+        if len(packed) < len(chunk):
+            payload = packed
+            flags = FLAG_COMPRESSED
+    return HEADER.pack(MAGIC, DATA) + DATA_HEADER.pack(index, zlib.crc32(chunk), flags, len(payload)) + payload
+
+
+def unpack(packet):
+    """ Returns (packet type, body) or (None, None) for anything that is not ours """
+    if len(packet) < HEADER.size:
+        return None, None
+    magic, kind = HEADER.unpack_from(packet, 0)
+    if magic != MAGIC:
+        return None, None
+    return kind, packet[HEADER.size:]
+
+
+def unpack_get(body):
+    count, = GET_COUNT.unpack_from(body, 0)
+    return struct.unpack_from(f"!{count}I", body, GET_COUNT.size)
+
+
+def unpack_data(body):
+    """ Returns (index, raw chunk) or (index, None) if the checksum does not match """
+    index, crc, flags, length = DATA_HEADER.unpack_from(body, 0)
+    payload = body[DATA_HEADER.size:DATA_HEADER.size + length]
+    try:
+        chunk = zlib.decompress(payload) if flags & FLAG_COMPRESSED else payload
+    except zlib.error:
+        return index, None
+    if zlib.crc32(chunk) != crc:
+        return index, None
+    return index, chunk
+
+
+def make_meta(data, chunk_size=CHUNK_SIZE):
+    chunk_count = (len(data) + chunk_size - 1) // chunk_size
+    return Meta(len(data), chunk_size, chunk_count, hashlib.sha256(data).digest())
+
+
+class StationClient(object):
+    """ Collects one dataset from a station, resuming where an earlier visit stopped.
+        window is the number of chunks in flight, rto the time after which an unanswered
+        chunk is requested again.
+    """
+
+    def __init__(self, window=128, rto=0.15, meta_timeout=0.5, meta_retries=6):
+        self.window = window
+        self.rto = rto
+        self.meta_timeout = meta_timeout
+        self.meta_retries = meta_retries
+
+    def _request_meta(self, sock, address, dataset):
+        sock.settimeout(self.meta_timeout)
+        for _ in range(self.meta_retries):
+            sock.sendto(pack_meta_request(dataset), address)
+            try:
+                while True:
+                    packet, _ = sock.recvfrom(65535)
+                    kind, body = unpack(packet)
+                    if kind == META:
+                        return Meta(*META_BODY.unpack_from(body, 0))
+                    if kind == ERROR:
+                        raise IOError(f"Station refused dataset {dataset}: {body.decode('utf-8', 'replace')}")
+            except socket.timeout:
+                continue
+        return None
+
+    def _open_partial(self, path, meta):
+        """ Open (or create) the .part file and the received-chunks bitmap for a dataset """
+        part_path = path + ".part"
+        bitmap_path = path + ".chunks"
+        meta_path = path + ".meta"
+
+        resume = False
+        if os.path.exists(part_path) and os.path.exists(bitmap_path) and os.path.exists(meta_path):
+            with open(meta_path, "rb") as meta_file:
+                resume = meta_file.read() == pack_meta(meta)
+
+        if resume:
+            with open(bitmap_path, "rb") as bitmap_file:
+                received = bytearray(bitmap_file.read())
+            part = open(part_path, "r+b")
+        else:
+            received = bytearray(meta.chunk_count)
+            part = open(part_path, "w+b")
+            part.truncate(meta.size)
+            with open(meta_path, "wb") as meta_file:
+                meta_file.write(pack_meta(meta))
+        return part, received
+
+    def collect(self, address, dataset, path, max_time=30.0):
+        """ Fetch dataset from the station at address=(host, port) into path.
+            Stops after max_time seconds (the hover budget) and keeps the partial state.
+        """
+        start = time.monotonic()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        try:
+            meta = self._request_meta(sock, address, dataset)
+            if meta is None:
+                print(f"Station {address} did not answer")
+                return TransferResult(False, 0, time.monotonic() - start, 0.0, 0, 0, None)
+
+            part, received = self._open_partial(path, meta)
+            missing = [i for i in range(meta.chunk_count) if not received[i]]
+            already = meta.chunk_count - len(missing)
+            in_flight = {}  # chunk index -> time requested
+            requests = 0
+            retransmits = 0
+            next_missing = 0  # Position in `missing` of the next chunk never requested yet
+            done = already
+            received_bytes = 0  # Payload of this visit, the last chunk is usually shorter
+            sock.settimeout(self.rto / 3)
+
+            while done < meta.chunk_count and time.monotonic() - start < max_time:
+                now = time.monotonic()
+
+                # Re-request chunks whose answer got lost, then fill the window with new ones
+                request = [index for index, sent in in_flight.items() if now - sent > self.rto]
+                retransmits += len(request)
+                while len(in_flight) < self.window and next_missing < len(missing):
+                    index = missing[next_missing]
+                    next_missing += 1
+                    in_flight[index] = now
+                    request.append(index)
+                for offset in range(0, len(request), MAX_GET):
+                    batch = request[offset:offset + MAX_GET]
+                    sock.sendto(pack_get(batch), address)
+                    requests += 1
+                for index in request:
+                    in_flight[index] = now
+
+                # Drain whatever has arrived
+                try:
+                    while True:
+                        packet, _ = sock.recvfrom(65535)
+                        kind, body = unpack(packet)
+                        if kind != DATA:
+                            continue
+                        index, chunk = unpack_data(body)
+                        if chunk is None or index >= meta.chunk_count or received[index]:
+                            continue  # Corrupt or duplicate, a retransmit will follow
+                        part.seek(index * meta.chunk_size)
+                        part.write(chunk)
+                        received[index] = 1
+                        in_flight.pop(index, None)
+                        done += 1
+                        received_bytes += len(chunk)
+                        sock.settimeout(0)
+                except (socket.timeout, BlockingIOError):
+                    pass
+                sock.settimeout(self.rto / 3)
+
+            seconds = time.monotonic() - start
+            complete = done == meta.chunk_count
+            part.close()
+
+            if complete:
+                complete = self._finish(path, meta)
+            else:
+                with open(path + ".chunks", "wb") as bitmap_file:
+                    bitmap_file.write(received)
+
+            return TransferResult(complete, received_bytes, seconds, received_bytes / seconds if seconds else 0.0,
+                                  requests, retransmits, path if complete else path + ".part")
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _finish(path, meta):
+        """ Check the whole file against the station's sha256 and move it into place """
+        sha = hashlib.sha256()
+        with open(path + ".part", "rb") as part:
+            for block in iter(lambda: part.read(1 << 20), b""):
+                sha.update(block)
+        if sha.digest() != meta.sha256:
+            # Start over next time, a chunk passed its crc32 but the file is wrong
+            for suffix in (".part", ".chunks", ".meta"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            return False
+
+        os.replace(path + ".part", path)
+        for suffix in (".chunks", ".meta"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        return True
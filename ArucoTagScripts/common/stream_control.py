@@ -0,0 +1,198 @@
+import csv
+import threading
+import time
+from collections import deque, namedtuple
+
+# Adaptive H.264 stream settings for the Tello video on UDP 11111.
+#
+# The mission reports every frame it acts on (record). StreamController tracks
+#   - glass-to-decision latency: age of the frame when the decision was made plus the
+#     encoder/network delay of the current level,
+#   - loss: share of frames the FrameQualityGate rejects as torn or blocky, which is what
+#     lost UDP packets turn into after decoding,
+#   - delivery: new frames per second against the configured fps,
+#   - detector utilisation: detection time per frame against the frame interval,
+# and moves one step down the LEVELS ladder when any of them is out of bounds, one step
+# up after a calm period. Every switch is printed and appended to stream_log.csv.
+
+StreamLevel = namedtuple("StreamLevel", ["name", "resolution", "fps", "bitrate", "width", "frames_per_second",
+                                         "pipeline_delay"])
+
+# bitrate is the setbitrate argument (1-5 Mbps), resolution/fps the setresolution/setfps arguments.
+# pipeline_delay is the encoder + network + decoder delay measured at that level, in seconds.
+LEVELS = [
+    StreamLevel("720p30 5M", "high", "high", 5, 960, 30, 0.20),
+    StreamLevel("720p30 3M", "high", "high", 3, 960, 30, 0.20),
+    StreamLevel("720p15 2M", "high", "middle", 2, 960, 15, 0.24),
+    StreamLevel("480p15 1M", "low", "middle", 1, 640, 15, 0.18),
+    StreamLevel("480p5 1M", "low", "low", 1, 640, 5, 0.30),
+]
+CLOSE_RANGE_LEVEL = 3  # Near a marker 480p is enough
+
+Switch = namedtuple("Switch", ["t", "old", "new", "reason", "latency", "loss", "delivery", "utilisation"])
+
+
+class FrameArrivals(object):
+    """ Polls the djitellopy frame reader and keeps the arrival time of each new frame """
+
+    def __init__(self, frame_read, rate=500, keep=64):
+        self.frame_read = frame_read
+        self.period = 1.0 / rate
+        self.arrivals = deque(maxlen=keep)  # (id of the frame array, arrival time)
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        last = None
+        while self.running:
+            frame = self.frame_read.frame
+            if frame is not None and frame is not last:
+                with self.lock:
+                    self.arrivals.append((id(frame), time.monotonic()))
+                last = frame
+            time.sleep(self.period)
+
+    def arrival(self, frame):
+        """ Arrival time of frame, None if it is too old to be tracked """
+        key = id(frame)
+        with self.lock:
+            for frame_id, t in reversed(self.arrivals):
+                if frame_id == key:
+                    return t
+        return None
+
+    def rate(self, window=2.0):
+        """ New frames per second over the last window seconds """
+        now = time.monotonic()
+        with self.lock:
+            recent = [t for _, t in self.arrivals if now - t <= window]
+        return len(recent) / window
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+
+
+class StreamController(object):
+    """ Steps the stream settings down when the latency target, the loss limit, the frame
+        delivery or the detector budget is missed, and back up after calm_seconds without
+        trouble. A switch restarts the encoder, so levels are held for at least dwell seconds.
+    """
+
+    def __init__(self, tello, target_latency=0.35, max_loss=0.15, min_delivery=0.7, max_utilisation=0.8,
+                 window=2.0, dwell=5.0, calm_seconds=15.0, log_path="stream_log.csv", level=1):
+        self.tello = tello
+        self.target_latency = target_latency
+        self.max_loss = max_loss
+        self.min_delivery = min_delivery
+        self.max_utilisation = max_utilisation
+        self.window = window
+        self.dwell = dwell
+        self.calm_seconds = calm_seconds
+        self.log_path = log_path
+
+        self.arrivals = FrameArrivals(tello.get_frame_read())
+        self.samples = deque()  # (t, latency, corrupt, detect seconds)
+        self.level = level
+        self.best_level = 0  # Best level allowed, CLOSE_RANGE_LEVEL near markers
+        self.last_switch = 0.0
+        self.last_trouble = time.monotonic()
+        self.switches = []
+
+    def start(self):
+        self._apply(LEVELS[self.level])
+        self.last_switch = time.monotonic()
+        self.arrivals.start()
+
+    def stop(self):
+        self.arrivals.stop()
+
+    def close_range(self, close):
+        """ Near a marker full resolution is not needed, cap the stream at 480p """
+        self.best_level = CLOSE_RANGE_LEVEL if close else 0
+
+    def record(self, frame, detect_seconds=0.0, corrupt=False):
+        """ Call once per frame the mission acted on, right after the decision """
+        now = time.monotonic()
+        arrival = self.arrivals.arrival(frame)
+        age = now - arrival if arrival is not None else None
+        latency = age + LEVELS[self.level].pipeline_delay if age is not None else None
+        self.samples.append((now, latency, corrupt, detect_seconds))
+        while self.samples and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        self._update(now)
+
+    def metrics(self):
+        latencies = sorted(s[1] for s in self.samples if s[1] is not None)
+        latency = latencies[int(0.9 * (len(latencies) - 1))] if latencies else 0.0
+        loss = sum(s[2] for s in self.samples) / len(self.samples) if self.samples else 0.0
+        level = LEVELS[self.level]
+        delivery = self.arrivals.rate(self.window) / level.frames_per_second
+        detect_times = [s[3] for s in self.samples]
+        utilisation = (sum(detect_times) / len(detect_times)) * level.frames_per_second if detect_times else 0.0
+        return latency, loss, delivery, utilisation
+
+    def _update(self, now):
+        if now - self.last_switch < self.dwell or len(self.samples) < 5:
+            return
+        latency, loss, delivery, utilisation = self.metrics()
+
+        reasons = []
+        if latency > self.target_latency:
+            reasons.append(f"latency {latency * 1000:.0f} ms")
+        if loss > self.max_loss:
+            reasons.append(f"loss {loss:.0%}")
+        if delivery < self.min_delivery:
+            reasons.append(f"delivery {delivery:.0%}")
+        if utilisation > self.max_utilisation:
+            reasons.append(f"detector {utilisation:.0%} busy")
+
+        if reasons:
+            self.last_trouble = now
+            if self.level < len(LEVELS) - 1:
+                self._switch(self.level + 1, ", ".join(reasons), latency, loss, delivery, utilisation)
+        elif self.level < self.best_level:
+            self._switch(self.best_level, "close range", latency, loss, delivery, utilisation)
+        elif self.level > self.best_level and now - self.last_trouble > self.calm_seconds:
+            self._switch(self.level - 1, "calm", latency, loss, delivery, utilisation)
+
+    def _apply(self, level):
+        self.tello.set_video_resolution(level.resolution)
+        self.tello.set_video_fps(level.fps)
+        self.tello.set_video_bitrate(level.bitrate)
+
+    def _switch(self, new_level, reason, latency, loss, delivery, utilisation):
+        old = LEVELS[self.level]
+        new = LEVELS[new_level]
+        # Only the settings that change, each one makes the encoder start a new GOP
+        if new.resolution != old.resolution:
+            self.tello.set_video_resolution(new.resolution)
+        if new.fps != old.fps:
+            self.tello.set_video_fps(new.fps)
+        if new.bitrate != old.bitrate:
+            self.tello.set_video_bitrate(new.bitrate)
+
+        now = time.monotonic()
+        switch = Switch(now, old.name, new.name, reason, latency, loss, delivery, utilisation)
+        self.switches.append(switch)
+        print(f"Stream {old.name} -> {new.name}: {reason}")
+        with open(self.log_path, "a", newline="") as log_file:
+            csv.writer(log_file).writerow([f"{time.time():.3f}", old.name, new.name, reason, f"{latency:.3f}",
+                                           f"{loss:.3f}", f"{delivery:.2f}", f"{utilisation:.2f}"])
+
+        self.level = new_level
+        self.last_switch = now
+        self.samples.clear()
+
+    def report(self):
+        latency, loss, delivery, utilisation = self.metrics()
+        return (f"Stream at {LEVELS[self.level].name} after {len(self.switches)} switches, "
+                f"p90 latency {latency * 1000:.0f} ms, loss {loss:.0%}, delivery {delivery:.0%}, "
+                f"detector {utilisation:.0%} busy")
@@ -0,0 +1,244 @@
+import json
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# Smooth routes through known station positions instead of stopping at every marker.
+#
+# The leg-by-leg missions record the estimated position at every marker (save_route). Afterwards
+# a trajectory flight builds a Catmull-Rom spline through those points, gives it a speed profile
+# limited by speed, acceleration and curvature, and streams rc velocities along it while the
+# camera checks each station as the drone passes.
+#
+# Positions use the state_estimator world frame: x forward, y right, z down, in cm.
+
+RC_PER_CM_S = 1.0  # rc stick units per cm/s, roughly 100 cm/s at full stick
+RC_MAX = 60  # Stick limit during trajectories
+YAW_GAIN = 1.5  # rc yaw units per degree of heading error
+YAW_RC_MAX = 40
+
+Waypoint = namedtuple("Waypoint", ["marker_id", "x", "y", "z"])
+RouteReport = namedtuple("RouteReport", ["seconds", "planned_seconds", "verified", "missed", "commands"])
+
+
+def save_route(path, waypoints, leg_seconds):
+    """ Store the station positions of a leg-by-leg flight and how long that flight took """
+    with open(path, "w") as route_file:
+        json.dump({"leg_seconds": leg_seconds, "waypoints": [w._asdict() for w in waypoints]}, route_file, indent=2)
+
+
+def load_route(path):
+    """ Returns (waypoints, leg_seconds) written by save_route """
+    with open(path) as route_file:
+        route = json.load(route_file)
+    return [Waypoint(**w) for w in route["waypoints"]], route["leg_seconds"]
+
+
+def catmull_rom(points, samples_per_segment=20):
+    """ Centripetal Catmull-Rom spline through points (N x 3).
+        Returns the dense curve and the sample index of each input point.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 2:
+        raise ValueError("a spline needs at least two points")
+    # Mirror the end points so the curve starts and ends at the first and last waypoint
+    padded = np.vstack([2 * points[0] - points[1], points, 2 * points[-1] - points[-2]])
+
+    curve = [points[0]]
+    indices = [0]
+    for i in range(1, len(padded) - 2):
+        p0, p1, p2, p3 = padded[i - 1:i + 3]
+        t0 = 0.0
+        t1 = t0 + max(np.linalg.norm(p1 - p0), 1e-6) ** 0.5
+        t2 = t1 + max(np.linalg.norm(p2 - p1), 1e-6) ** 0.5
+        t3 = t2 + max(np.linalg.norm(p3 - p2), 1e-6) ** 0.5
+        for t in np.linspace(t1, t2, samples_per_segment + 1)[1:]:
+            a1 = (t1 - t) / (t1 - t0) * p0 + (t - t0) / (t1 - t0) * p1
+            a2 = (t2 - t) / (t2 - t1) * p1 + (t - t1) / (t2 - t1) * p2
+            a3 = (t3 - t) / (t3 - t2) * p2 + (t - t2) / (t3 - t2) * p3
+            b1 = (t2 - t) / (t2 - t0) * a1 + (t - t0) / (t2 - t0) * a2
+            b2 = (t3 - t) / (t3 - t1) * a2 + (t - t1) / (t3 - t1) * a3
+            curve.append((t2 - t) / (t2 - t1) * b1 + (t - t1) / (t2 - t1) * b2)
+        indices.append(len(curve) - 1)
+    return np.array(curve), indices
+
+
+def _circumradius(a, b, c):
+    area = np.linalg.norm(np.cross(b - a, c - a)) / 2
+    if area < 1e-9:
+        return math.inf
+    return np.linalg.norm(b - a) * np.linalg.norm(c - b) * np.linalg.norm(c - a) / (4 * area)
+
+
+class TimedPath(object):
+    """ A dense curve with a speed profile: as fast as max_speed, max_accel and the lateral
+        acceleration in curves allow, starting and ending at rest. Waypoints listed in
+        stop_indices (sample indices) are passed at zero speed, e.g. to hover at a station.
+    """
+
+    def __init__(self, curve, waypoint_indices, max_speed=60.0, max_accel=40.0, max_lateral_accel=60.0,
+                 stop_indices=()):
+        self.curve = curve
+        self.waypoint_indices = waypoint_indices
+        self.stop_indices = set(stop_indices)
+        steps = np.linalg.norm(np.diff(curve, axis=0), axis=1)
+        self.s = np.concatenate([[0.0], np.cumsum(steps)])
+
+        # Speed limit from the curvature of each sample and its neighbours
+        limit = np.full(len(curve), max_speed)
+        for i in range(1, len(curve) - 1):
+            radius = _circumradius(curve[i - 1], curve[i], curve[i + 1])
+            limit[i] = min(max_speed, math.sqrt(max_lateral_accel * radius))
+        limit[0] = limit[-1] = 0.0
+        for i in stop_indices:
+            limit[i] = 0.0
+
+        # Forward and backward pass: v^2 <= v_prev^2 + 2 a ds
+        speed = limit.copy()
+        for i in range(1, len(curve)):
+            speed[i] = min(speed[i], math.sqrt(speed[i - 1] ** 2 + 2 * max_accel * steps[i - 1]))
+        for i in range(len(curve) - 2, -1, -1):
+            speed[i] = min(speed[i], math.sqrt(speed[i + 1] ** 2 + 2 * max_accel * steps[i]))
+        self.speed = speed
+
+        # Time at every sample, using the mean speed of each step
+        dt = [2 * ds / (v0 + v1) if v0 + v1 > 1e-6 else 0.0 for ds, v0, v1 in zip(steps, speed[:-1], speed[1:])]
+        self.t = np.concatenate([[0.0], np.cumsum(dt)])
+        self.duration = float(self.t[-1])
+
+    def waypoint_times(self):
+        return [float(self.t[i]) for i in self.waypoint_indices]
+
+    def sample(self, t):
+        """ Target position and velocity (cm, cm/s) at time t """
+        t = min(max(t, 0.0), self.duration)
+        i = min(int(np.searchsorted(self.t, t, side="right")), len(self.t) - 1)
+        i = max(i, 1)
+        span = self.t[i] - self.t[i - 1]
+        share = (t - self.t[i - 1]) / span if span > 0 else 1.0
+        position = self.curve[i - 1] + share * (self.curve[i] - self.curve[i - 1])
+        direction = self.curve[i] - self.curve[i - 1]
+        length = np.linalg.norm(direction)
+        speed = self.speed[i - 1] + share * (self.speed[i] - self.speed[i - 1])
+        velocity = direction / length * speed if length > 0 else np.zeros(3)
+        return position, velocity
+
+
+def plan_route(start, waypoints, stop_ids=(), **limits):
+    """ TimedPath from the current position through all waypoints, at least one """
+    if not waypoints:
+        raise ValueError("no waypoints to plan a route through")
+    points = [start] + [(w.x, w.y, w.z) for w in waypoints]
+    curve, indices = catmull_rom(points)
+    stops = [index for index, w in zip(indices[1:], waypoints) if w.marker_id in stop_ids]
+    return TimedPath(curve, indices[1:], stop_indices=stops, **limits)
+
+
+def _to_body(vector, yaw_deg):
+    """ World (x forward, y right, z down) to body (forward, right, down) for heading yaw_deg """
+    yaw = math.radians(yaw_deg)
+    c, s = math.cos(yaw), math.sin(yaw)
+    return c * vector[0] + s * vector[1], -s * vector[0] + c * vector[1], vector[2]
+
+
+def _clamp(value, limit):
+    return max(-limit, min(limit, value))
+
+
+class TrajectoryFollower(object):
+    """ Streams rc velocities along a TimedPath at rate Hz: the path velocity as feed-forward
+        plus gain * position error from the state estimator, heading along the path.
+        observe() is called every tick and returns the marker IDs seen in the newest frame;
+        a station counts as verified if its marker is seen within verify_window seconds of
+        its waypoint time. at_stop(marker_id) runs while the drone hovers at a stop waypoint.
+    """
+
+    def __init__(self, tello, estimator, rate=20, gain=0.8, verify_window=2.0):
+        self.tello = tello
+        self.estimator = estimator
+        self.period = 1.0 / rate
+        self.gain = gain
+        self.verify_window = verify_window
+
+    def fly(self, path, waypoints, observe=None, at_stop=None, stop_requested=None):
+        seen = {}  # marker ID -> path times at which it was seen
+        commands = 0
+        waypoint_times = path.waypoint_times()
+        pending_stops = [(t, w) for t, w, index in zip(waypoint_times, waypoints, path.waypoint_indices)
+                         if index in path.stop_indices]
+
+        start = time.monotonic()
+        paused = 0.0
+        next_tick = start
+        while True:
+            path_time = time.monotonic() - start - paused
+            if path_time > path.duration or (stop_requested is not None and stop_requested()):
+                break
+
+            if pending_stops and path_time >= pending_stops[0][0]:
+                stop_time, waypoint = pending_stops.pop(0)
+                self.tello.send_rc_control(0, 0, 0, 0)
+                commands += 1
+                pause_start = time.monotonic()
+                if at_stop is not None:
+                    at_stop(waypoint.marker_id)
+                paused += time.monotonic() - pause_start
+                next_tick = time.monotonic()
+                continue
+
+            target, velocity = path.sample(path_time)
+            pose = self.estimator.pose()
+            command = velocity + self.gain * (target - np.array([pose.x, pose.y, pose.z]))
+            forward, right, down = _to_body(command, pose.yaw)
+
+            # Face along the path so the forward camera sees the next station coming
+            heading_error = 0.0
+            if np.linalg.norm(velocity[:2]) > 5.0:
+                heading = math.degrees(math.atan2(velocity[1], velocity[0]))
+                heading_error = (heading - pose.yaw + 180) % 360 - 180
+            self.tello.send_rc_control(int(_clamp(right * RC_PER_CM_S, RC_MAX)),
+                                       int(_clamp(forward * RC_PER_CM_S, RC_MAX)),
+                                       int(_clamp(-down * RC_PER_CM_S, RC_MAX)),
+                                       int(_clamp(heading_error * YAW_GAIN, YAW_RC_MAX)))
+            commands += 1
+
+            if observe is not None:
+                for marker_id in observe():
+                    seen.setdefault(marker_id, []).append(path_time)
+
+            next_tick += self.period
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+
+        self.tello.send_rc_control(0, 0, 0, 0)
+        commands += 1
+
+        verified, missed = [], []
+        for t, waypoint in zip(waypoint_times, waypoints):
+            times = seen.get(waypoint.marker_id, [])
+            if any(abs(t_seen - t) <= self.verify_window for t_seen in times):
+                verified.append(waypoint.marker_id)
+            else:
+                missed.append(waypoint.marker_id)
+        return RouteReport(time.monotonic() - start, path.duration, verified, missed, commands)
+
+
+def route_summary(report, leg_seconds):
+    missed = f", missed {report.missed}" if report.missed else ""
+    saved = f" ({leg_seconds - report.seconds:.1f} s faster)" if leg_seconds else ""
+    return (f"Trajectory: {report.seconds:.1f} s (planned {report.planned_seconds:.1f} s), leg by leg: "
+            f"{leg_seconds:.1f} s{saved}. {report.commands} rc commands, verified {report.verified}{missed}")
+
+
+if __name__ == '__main__':
+    # Speed profile of a five-station zig-zag, no drone needed
+    stations = [Waypoint(i, 150.0 * (i + 1), 80.0 * (-1) ** i, -60.0) for i in range(5)]
+    route = plan_route((0.0, 0.0, -60.0), stations)
+    length = route.s[-1]
+    print(f"{len(stations)} stations, {length:.0f} cm of spline, {route.duration:.1f} s")
+    print("Station times:", ", ".join(f"{t:.1f} s" for t in route.waypoint_times()))
+    # Leg by leg at the same top speed: accelerate, cruise, brake and settle for every leg
+    legs = np.linalg.norm(np.diff([(0.0, 0.0, -60.0)] + [(w.x, w.y, w.z) for w in stations], axis=0), axis=1)
+    stop_and_go = sum(d / 60.0 + 60.0 / 40.0 + 2.0 for d in legs)
+    print(f"Stop-and-go estimate with 2 s settling per leg: {stop_and_go:.1f} s")
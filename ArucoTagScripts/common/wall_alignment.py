@@ -0,0 +1,126 @@
+import math
+import time
+
+# Forward camera focal length in pixels, same calibration as f = 77.4 (x10) in the floor missions
+FORWARD_FOCAL_PX = 774.0
+
+# SDK limits of the go command
+GO_MIN = 20  # At least one axis has to be 20 cm or more
+GO_MAX = 500
+GO_SPEED = 40  # cm/s
+
+# Offsets below the go minimum are corrected with a short rc burst
+RC_VALUE = 20  # rc stick value used for the burst
+RC_CM_PER_S = 20.0  # Approximate speed the burst moves at
+CENTER_TOLERANCE_CM = 6  # Lateral and vertical offset that counts as centered
+
+# Frames arriving this long after a command returned still show the view from before or during
+# the move (video latency plus settling), acting on them would repeat the move
+SETTLE_TIME = 0.8  # s
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class WallAligner(object):
+    """ Turns the pose of a wall marker into one combined go x y z speed command.
+        The sideways and vertical offset in cm follow from the pixel offset scaled by
+        marker_width_cm / pixel width, the forward distance from the pinhole model.
+        The target is the distance at which the marker diagonal reaches close_enough_size
+        pixels, the same threshold the wall missions used before.
+    """
+
+    def __init__(self, tello, marker_width_cm, close_enough_size=200, focal_px=FORWARD_FOCAL_PX,
+                 speed=GO_SPEED):
+        self.tello = tello
+        self.marker_width_cm = marker_width_cm
+        self.focal_px = focal_px
+        self.speed = speed
+        self.settle_until = 0.0
+        # Distance at which the diagonal of the marker is close_enough_size pixels
+        self.standoff_cm = math.sqrt(2) * marker_width_cm * focal_px / close_enough_size
+
+        # Iterations (frames acted on) and commands sent, per marker ID
+        self.stats = {}
+
+    def moved(self):
+        """ Call after any other command that moves the drone, e.g. a search rotation """
+        self.settle_until = time.monotonic() + SETTLE_TIME
+
+    def settling(self):
+        """ True while new frames still show the view from before the last move """
+        return time.monotonic() < self.settle_until
+
+    def offset(self, detection, frame_shape):
+        """ (forward, left, up) in cm from the drone to the standoff point in front of the marker """
+        cm_per_px = self.marker_width_cm / detection.width
+        frame_center_x = frame_shape[1] // 2
+        frame_center_y = frame_shape[0] // 2
+
+        distance = self.marker_width_cm * self.focal_px / detection.width
+        forward = distance - self.standoff_cm
+        left = (frame_center_x - detection.center_x) * cm_per_px  # go y is positive to the left
+        up = (frame_center_y - detection.center_y) * cm_per_px
+        return forward, left, up
+
+    def step(self, detection, frame_shape):
+        """ Issue one correction for the detected marker. Returns True once the drone is in place.
+            Frames while settling() are ignored, they show the marker from before the last move.
+        """
+        if self.settling():
+            return False
+        stats = self.stats.setdefault(detection.marker_id, {'iterations': 0, 'commands': 0, 'travel': [0, 0, 0]})
+        stats['iterations'] += 1
+
+        forward, left, up = self.offset(detection, frame_shape)
+        x = int(round(_clamp(forward, -GO_MAX, GO_MAX)))
+        y = int(round(_clamp(left, -GO_MAX, GO_MAX)))
+        z = int(round(_clamp(up, -GO_MAX, GO_MAX)))
+
+        if max(abs(x), abs(y), abs(z)) >= GO_MIN:
+            # One combined move covers forward, sideways and height at once
+            print(f"go {x} {y} {z} {self.speed}")
+            self.tello.go_xyz_speed(x, y, z, self.speed)
+            self.moved()
+            stats['commands'] += 1
+            stats['travel'] = [stats['travel'][0] + x, stats['travel'][1] + y, stats['travel'][2] + z]
+            return False
+
+        if abs(y) > CENTER_TOLERANCE_CM or abs(z) > CENTER_TOLERANCE_CM:
+            # Too small for go, nudge sideways / vertically with a short rc burst
+            self.rc_burst(y, z)
+            stats['commands'] += 2  # Burst plus the stop command
+            return False
+
+        return True
+
+    def rc_burst(self, left, up):
+        """ Move a few cm with the sticks, then stop """
+        left_right = -RC_VALUE if left > CENTER_TOLERANCE_CM else RC_VALUE if left < -CENTER_TOLERANCE_CM else 0
+        up_down = RC_VALUE if up > CENTER_TOLERANCE_CM else -RC_VALUE if up < -CENTER_TOLERANCE_CM else 0
+        duration = max(abs(left), abs(up)) / RC_CM_PER_S
+        print(f"rc burst {left_right} 0 {up_down} 0 for {duration:.2f} s")
+        self.tello.send_rc_control(left_right, 0, up_down, 0)
+        time.sleep(duration)
+        self.tello.send_rc_control(0, 0, 0, 0)
+        self.moved()
+
+    def return_from(self, marker_id):
+        """ Fly the summed go vectors of a marker back in one command.
+            rc bursts are not counted, they only add a few cm.
+        """
+        stats = self.stats.get(marker_id)
+        if stats is None:
+            return
+        x, y, z = [-_clamp(value, -GO_MAX, GO_MAX) for value in stats['travel']]
+        if max(abs(x), abs(y), abs(z)) >= GO_MIN:
+            print(f"go {x} {y} {z} {self.speed}")
+            self.tello.go_xyz_speed(x, y, z, self.speed)
+            self.moved()
+            stats['commands'] += 1
+
+    def report(self):
+        """ Iteration and command count per marker """
+        return "\n".join(f"Marker {marker_id}: {stats['iterations']} iterations, {stats['commands']} commands"
+                         for marker_id, stats in sorted(self.stats.items()))
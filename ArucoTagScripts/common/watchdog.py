@@ -0,0 +1,235 @@
+import threading
+import time
+from collections import deque
+
+# Link watchdog for the Tello command channel.
+#
+# Two signals describe the link: the state packets the drone sends on its own about ten times
+# a second (their gaps and loss show trouble within a fraction of a second, even while a
+# blocking command is waiting for its answer) and the time every command takes beyond the
+# motion it asked for. WatchdogTello times each command; the watchdog thread reacts in
+# bounded time, independent of a command that hangs in djitellopy:
+#
+#   ok        nothing to do
+#   throttled p90 command delay or state loss above the limits: commands are spaced out
+#   hover     no state packet for hover_after seconds: rc 0 0 0 0 is sent, new commands wait
+#   return    throttled or hovering for return_after seconds: should_return() turns True
+#   land      no state packet for land_after seconds: land is sent without waiting for an answer,
+#             the next command raises LinkLost so the mission ends up in its finally block
+
+STATE_RATE = 10.0  # State packets per second the Tello sends
+
+# Commands that move the drone: expected duration = motion / speed + COMMAND_OVERHEAD
+MOVE_COMMANDS = {"move_up", "move_down", "move_left", "move_right", "move_forward", "move_back"}
+ROTATE_COMMANDS = {"rotate_clockwise", "rotate_counter_clockwise"}
+TIMED_COMMANDS = MOVE_COMMANDS | ROTATE_COMMANDS | {
+    "go_xyz_speed", "curve_xyz_speed", "takeoff", "land", "set_speed", "streamon", "streamoff",
+    "set_video_bitrate", "set_video_resolution", "set_video_fps", "set_video_direction",
+}
+COMMAND_OVERHEAD = 1.0  # s, acceleration and settling of a motion command
+ROTATE_RATE = 90.0  # deg/s
+TAKEOFF_TIME = 5.0
+DEFAULT_SPEED = 40.0  # cm/s, until set_speed is called
+
+OK, THROTTLED, HOVER, RETURN, LAND = "ok", "throttled", "hover", "return", "land"
+
+
+class LinkLost(Exception):
+    """ Raised on the next command after the watchdog has landed the drone """
+
+
+def _percentile(values, share):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+class WatchdogTello(object):
+    """ Stands in for the Tello: times every command and waits while the watchdog throttles or hovers """
+
+    def __init__(self, tello, watchdog):
+        self._tello = tello
+        self._watchdog = watchdog
+
+    def __getattr__(self, name):
+        attribute = getattr(self._tello, name)
+        if name not in TIMED_COMMANDS:
+            return attribute
+
+        def command(*args, **kwargs):
+            self._watchdog.before_command(name)
+            start = time.monotonic()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception:
+                self._watchdog.after_command(name, args, start, failed=True)
+                raise
+            self._watchdog.after_command(name, args, start)
+            return result
+        return command
+
+
+class CommandWatchdog(object):
+    """ Rolling RTT and loss model of the link with automatic safe actions, see the top of the file """
+
+    def __init__(self, tello, rtt_limit=0.8, loss_limit=0.3, hover_after=0.6, land_after=4.0, return_after=10.0,
+                 throttle_gap=0.5, window=3.0, rate=50):
+        self.tello = tello
+        self.rtt_limit = rtt_limit  # s of delay beyond the expected command duration
+        self.loss_limit = loss_limit
+        self.hover_after = hover_after
+        self.land_after = land_after
+        self.return_after = return_after
+        self.throttle_gap = throttle_gap
+        self.window = window
+        self.period = 1.0 / rate
+
+        self.level = OK
+        self.degraded_since = None
+        self.returning = False  # Stays set once the return level was reached
+        self.silent = False  # No state packets for hover_after seconds, hover sent
+        self.speed = DEFAULT_SPEED
+        self.delays = deque(maxlen=20)  # Recent command delays for the throttle decision
+        self.flight_delays = []  # Every command delay of the flight, for the report
+        self.failures = 0
+        self.packets = deque()  # Arrival times of state packets within the window
+        self.started = time.monotonic()
+        self.last_packet = time.monotonic()
+        self.last_command_end = 0.0
+        self.transitions = []  # (time, old level, new level)
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def wrap(self):
+        """ The Tello to use for the rest of the mission """
+        return WatchdogTello(self.tello, self)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        with self.lock:
+            self.silent = False  # Nothing would ever clear it again
+
+    def expected_duration(self, name, args):
+        if name in MOVE_COMMANDS and args:
+            return abs(args[0]) / self.speed + COMMAND_OVERHEAD
+        if name in ROTATE_COMMANDS and args:
+            return abs(args[0]) / ROTATE_RATE + COMMAND_OVERHEAD
+        if name == "go_xyz_speed" and len(args) >= 4:
+            x, y, z, speed = args[:4]
+            return (x * x + y * y + z * z) ** 0.5 / max(speed, 10) + COMMAND_OVERHEAD
+        if name == "curve_xyz_speed" and len(args) >= 7:
+            x1, y1, z1, x2, y2, z2, speed = args[:7]
+            # Two straight pieces through the middle point, a little shorter than the arc
+            length = (x1 * x1 + y1 * y1 + z1 * z1) ** 0.5 + ((x2 - x1) ** 2 + (y2 - y1) ** 2 + (z2 - z1) ** 2) ** 0.5
+            return length / max(speed, 10) + COMMAND_OVERHEAD
+        if name in ("takeoff", "land"):
+            return TAKEOFF_TIME
+        return 0.0
+
+    def before_command(self, name):
+        """ Runs before each command on the mission thread, waits while throttled or hovering """
+        while True:
+            if not self.running:
+                return  # Stopped, no longer guarding the link
+            with self.lock:
+                level = self.level
+                silent = self.silent
+                gap = time.monotonic() - self.last_command_end
+            if level == LAND and name != "land":
+                raise LinkLost("Link lost, the watchdog has landed the drone")
+            if silent and level != LAND and name != "land":
+                time.sleep(self.period)
+                continue
+            if level == THROTTLED and gap < self.throttle_gap:
+                time.sleep(self.throttle_gap - gap)
+            return
+
+    def after_command(self, name, args, start, failed=False):
+        end = time.monotonic()
+        if name == "set_speed" and args and not failed:
+            self.speed = float(args[0])
+        delay = max(0.0, end - start - self.expected_duration(name, args))
+        with self.lock:
+            self.last_command_end = end
+            self.delays.append(delay)
+            self.flight_delays.append(delay)
+            self.failures += failed
+
+    def loss(self):
+        """ Share of expected state packets missing over the window """
+        with self.lock:
+            received = len(self.packets)
+        window = min(self.window, time.monotonic() - self.started)
+        if window < 1.0:
+            return 0.0
+        return max(0.0, 1.0 - received / (window * STATE_RATE))
+
+    def should_return(self):
+        """ True once the link has been bad for return_after seconds, the mission should head home """
+        return self.returning
+
+    def _set_level(self, level):
+        if level in (RETURN, LAND):
+            self.returning = True
+        if level != self.level:
+            self.transitions.append((time.monotonic(), self.level, level))
+            print(f"Link watchdog: {self.level} -> {level} (p90 delay {_percentile(list(self.delays), 0.9):.2f} s, "
+                  f"state loss {self.loss():.0%})")
+            self.level = level
+
+    def _run(self):
+        last_state = None
+        while self.running:
+            now = time.monotonic()
+            state = self.tello.get_current_state()
+            with self.lock:
+                # djitellopy builds a new dict for every state packet
+                if state is not None and state is not last_state:
+                    last_state = state
+                    self.last_packet = now
+                    self.packets.append(now)
+                while self.packets and now - self.packets[0] > self.window:
+                    self.packets.popleft()
+                silence = now - self.last_packet
+                delay = _percentile(list(self.delays), 0.9)
+            loss = self.loss()
+
+            if self.level == LAND:
+                pass  # Stays landed, the mission ends
+            elif silence > self.land_after:
+                # Nobody is listening for the answer, so the blocked mission thread is not disturbed
+                self.tello.send_command_without_return("land")
+                self._set_level(LAND)
+            elif silence > self.hover_after:
+                if not self.silent:
+                    self.tello.send_command_without_return("rc 0 0 0 0")
+                    self.silent = True
+                self.degraded_since = self.degraded_since or now
+                self._set_level(RETURN if now - self.degraded_since > self.return_after else HOVER)
+            elif delay > self.rtt_limit or loss > self.loss_limit:
+                self.silent = False
+                self.degraded_since = self.degraded_since or now
+                bad_for = now - self.degraded_since
+                self._set_level(RETURN if bad_for > self.return_after else THROTTLED)
+            else:
+                self.silent = False
+                self.degraded_since = None
+                self._set_level(OK)
+            time.sleep(self.period)
+
+    def report(self):
+        delays = self.flight_delays
+        levels = ", ".join(f"{old}->{new}" for _, old, new in self.transitions) or "none"
+        return (f"Command delay over {len(delays)} commands: p50 {_percentile(delays, 0.5) * 1000:.0f} ms, "
+                f"p90 {_percentile(delays, 0.9) * 1000:.0f} ms, p99 {_percentile(delays, 0.99) * 1000:.0f} ms, "
+                f"{self.failures} failed. Watchdog transitions: {levels}")
@@ -0,0 +1,78 @@
+import math
+import time
+
+from common.wall_alignment import FORWARD_FOCAL_PX
+
+# Yaw alignment onto a marker in one correction.
+#
+# The horizontal pixel offset of the marker center and the focal length give the yaw error
+# directly: atan(offset / focal). Large errors are turned in one rotate command of that size,
+# errors too small for a rotate (the Tello overshoots them) with a short rc yaw burst. The result
+# is checked on the next frame decoded after the turn, video latency included, so a correction
+# never acts on a frame from before it.
+
+NATIVE_WIDTH = 960  # Frame width FORWARD_FOCAL_PX was calibrated at
+TOLERANCE_PX = 30  # Offset that counts as centered, same as the missions used before
+ROTATE_MIN_DEG = 5  # Below this the error is turned with an rc burst instead of a rotate
+RC_YAW = 30  # rc yaw stick value for the burst
+RC_YAW_DEG_PER_S = 30.0  # Approximate turn rate at RC_YAW
+VIDEO_LATENCY = 0.3  # s until the first frame after a turn shows the new heading
+MAX_CORRECTIONS = 4  # Corrections per marker before the alignment is accepted as is
+
+
+class YawAligner(object):
+    """ Turns the drone onto a marker from its pixel offset and counts time and commands per marker """
+
+    def __init__(self, tello, focal_px=FORWARD_FOCAL_PX, tolerance_px=TOLERANCE_PX):
+        self.tello = tello
+        self.focal_px = focal_px
+        self.tolerance_px = tolerance_px
+        self.last_turn = 0  # Signed degrees of the last correction, clockwise positive
+        self.stats = {}  # marker ID -> {'start', 'seconds', 'commands', 'corrections'}
+
+    def yaw_error(self, center_x, frame_width):
+        """ Degrees the drone has to turn clockwise to face the marker """
+        focal = self.focal_px * frame_width / NATIVE_WIDTH
+        return math.degrees(math.atan2(center_x - frame_width / 2, focal))
+
+    def step(self, marker_id, center_x, frame_width):
+        """ One check and at most one correction. True once the marker is centered. """
+        stats = self.stats.setdefault(marker_id, {'start': time.monotonic(), 'seconds': 0.0, 'commands': 0,
+                                                  'corrections': 0})
+        self.last_turn = 0
+        offset = center_x - frame_width / 2
+        if abs(offset) <= self.tolerance_px or stats['corrections'] >= MAX_CORRECTIONS:
+            if stats['corrections'] >= MAX_CORRECTIONS and abs(offset) > self.tolerance_px:
+                print(f"Marker {marker_id} still {offset:.0f} px off after {MAX_CORRECTIONS} corrections, going on")
+            stats['seconds'] = time.monotonic() - stats['start']
+            return True
+
+        error = self.yaw_error(center_x, frame_width)
+        degrees = int(round(error))
+        if abs(degrees) >= ROTATE_MIN_DEG:
+            print(f"Rotating {degrees} degrees onto marker {marker_id}")
+            if degrees > 0:
+                self.tello.rotate_clockwise(degrees)
+            else:
+                self.tello.rotate_counter_clockwise(-degrees)
+            stats['commands'] += 1
+            self.last_turn = degrees
+        else:
+            duration = abs(error) / RC_YAW_DEG_PER_S
+            print(f"rc yaw burst {error:.1f} degrees onto marker {marker_id} ({duration:.2f} s)")
+            self.tello.send_rc_control(0, 0, 0, RC_YAW if error > 0 else -RC_YAW)
+            time.sleep(duration)
+            self.tello.send_rc_control(0, 0, 0, 0)
+            stats['commands'] += 2  # Burst plus the stop command
+            self.last_turn = int(round(error))
+        stats['corrections'] += 1
+
+        # The next frame the caller reads has to show the new heading
+        time.sleep(VIDEO_LATENCY)
+        return False
+
+    def report(self):
+        """ Alignment time and command count per marker """
+        return "\n".join(f"Yaw alignment marker {marker_id}: {stats['seconds']:.1f} s, {stats['commands']} commands, "
+                         f"{stats['corrections']} corrections"
+                         for marker_id, stats in sorted(self.stats.items()))
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The tests import the shared helpers like the mission scripts do, from the ArucoTagScripts folder.
+# Run them from the repository or the ArucoTagScripts folder:
+#     python -m pytest -q
+# Modules that need numpy or cv2 are skipped where those are not installed.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,100 @@
+from common.detection_confirmation import DetectionConfirmer, simulate
+
+FRAME = 1 / 30  # s between frames
+
+
+def observe(confirmer, t, center_x=480.0, width=60.0, distance=None):
+    return confirmer.observe(center_x, 360.0, width, width * 0.9, 960, distance, t)
+
+
+def test_confirms_after_required_frames():
+    confirmer = DetectionConfirmer()
+    confirmer.reset("search")  # 3 of the last 5 frames
+    assert observe(confirmer, 0 * FRAME) is None
+    assert observe(confirmer, 1 * FRAME) is None
+    confirmation = observe(confirmer, 2 * FRAME)
+    assert confirmation is not None
+    assert confirmation.votes == 3
+    assert confirmer.confirmed == 1
+
+
+def test_misses_in_between_still_count_the_window():
+    confirmer = DetectionConfirmer()
+    confirmer.reset("search")
+    assert observe(confirmer, 0 * FRAME) is None
+    assert confirmer.miss(1 * FRAME)  # Still pending, the caller must not turn away
+    assert observe(confirmer, 2 * FRAME) is None
+    assert observe(confirmer, 3 * FRAME) is not None
+
+
+def test_votes_fall_out_of_the_window():
+    confirmer = DetectionConfirmer()
+    confirmer.reset("search")
+    observe(confirmer, 0 * FRAME)
+    observe(confirmer, 1 * FRAME)
+    for i in range(2, 5):
+        confirmer.miss(i * FRAME)
+    # Only two sightings are left in the window of five frames
+    assert observe(confirmer, 5 * FRAME) is None
+
+
+def test_single_misread_is_prevented():
+    confirmer = DetectionConfirmer()
+    confirmer.reset("search")
+    assert observe(confirmer, 0.0) is None
+    assert not confirmer.miss(2.0)  # Older than max_age, given up
+    assert confirmer.prevented == 1
+    assert confirmer.confirmed == 0
+
+
+def test_disagreeing_positions_do_not_vote_together():
+    confirmer = DetectionConfirmer()
+    confirmer.reset("search")
+    assert observe(confirmer, 0 * FRAME, center_x=100.0) is None
+    assert observe(confirmer, 1 * FRAME, center_x=800.0) is None
+    assert observe(confirmer, 2 * FRAME, center_x=100.0) is None
+    assert observe(confirmer, 3 * FRAME, center_x=450.0, width=20.0) is None
+
+
+def test_single_frame_checks():
+    confirmer = DetectionConfirmer()
+    confirmer.observe(480.0, 360.0, 4.0, 4.0, 960, t=0.0)
+    confirmer.observe(480.0, 360.0, 60.0, 10.0, 960, t=FRAME)
+    confirmer.observe(480.0, 360.0, 60.0, 60.0, 960, distance=900.0, t=2 * FRAME)
+    assert confirmer.rejected == {"tiny": 1, "aspect": 1, "range": 1}
+
+
+def test_size_check_against_the_expected_distance():
+    confirmer = DetectionConfirmer()
+    confirmer.reset("center", expected_distance=80.0)
+    assert observe(confirmer, 0 * FRAME, distance=200.0) is None  # A misdecoded small quad
+    assert confirmer.rejected == {"size": 1}
+    observe(confirmer, 1 * FRAME, distance=85.0)
+    assert observe(confirmer, 2 * FRAME, distance=78.0) is not None
+    confirmer.reset()  # The expected distance is given again with every reset
+    observe(confirmer, 3 * FRAME, distance=200.0)
+    assert confirmer.rejected == {"size": 1}
+
+
+def test_confirmation_uses_median_of_the_votes():
+    confirmer = DetectionConfirmer()
+    confirmer.reset("search")
+    observe(confirmer, 0 * FRAME, width=60.0, distance=100.0)
+    observe(confirmer, 1 * FRAME, width=64.0, distance=140.0)
+    confirmation = observe(confirmer, 2 * FRAME, width=62.0, distance=110.0)
+    assert confirmation.width == 62.0
+    assert confirmation.distance == 110.0
+
+
+def test_phase_changes_the_required_votes():
+    confirmer = DetectionConfirmer()
+    confirmer.reset("center")  # 2 of the last 3 frames
+    assert observe(confirmer, 0 * FRAME) is None
+    assert observe(confirmer, 1 * FRAME) is not None
+
+
+def test_simulated_misdecodes_are_never_confirmed():
+    wrong_sightings, wrong_confirmations, confirmer = simulate(frames=5000, misdecode_rate=0.05)
+    assert wrong_sightings > 0
+    assert wrong_confirmations == 0
+    assert confirmer.confirmed > 0
@@ -0,0 +1,57 @@
+import math
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+from common.focal_calibration import CameraCalibration, fit_calibration
+
+MARKER_SIZE = 20  # cm
+
+
+def synthetic_samples(focal_px=900.0, radial=0.05, offset_cm=4.0, noise_px=0.1, outliers=0, seed=0):
+    """ Widths a camera with the given calibration sees at known distances, at 960 x 720 and 480 x 360 """
+    rng = random.Random(seed)
+    samples = []
+    for distance in range(40, 401, 20):
+        for center_x, center_y in ((480, 360), (150, 360), (800, 150), (480, 650)):
+            for scale in (1, 2):
+                frame_width, frame_height = 960 // scale, 720 // scale
+                x, y = center_x / scale, center_y / scale
+                r = math.hypot(x - frame_width / 2, y - frame_height / 2) / (frame_width / 2)
+                native = focal_px * MARKER_SIZE * (1 + radial * r * r) / (distance + offset_cm)
+                width = native / scale + rng.gauss(0, noise_px)
+                samples.append((distance, width, x, y, frame_width, frame_height))
+    for i in range(outliers):
+        distance, width, *rest = samples[i * 7]
+        samples[i * 7] = (distance, width * 1.6, *rest)  # A corner detected on the wrong edge
+    return samples
+
+
+def test_fit_recovers_the_calibration():
+    calibration = fit_calibration(synthetic_samples(), MARKER_SIZE)
+    assert calibration.focal_px == pytest.approx(900.0, rel=0.01)
+    assert calibration.radial == pytest.approx(0.05, abs=0.01)
+    assert calibration.offset_cm == pytest.approx(4.0, abs=1.0)
+    assert calibration.width == 960
+    assert calibration.rms_cm < 2.0
+
+
+def test_fit_ignores_outliers():
+    calibration = fit_calibration(synthetic_samples(outliers=8), MARKER_SIZE)
+    assert calibration.focal_px == pytest.approx(900.0, rel=0.02)
+    assert calibration.offset_cm == pytest.approx(4.0, abs=2.0)
+
+
+def test_fit_needs_enough_samples():
+    with pytest.raises(ValueError):
+        fit_calibration(synthetic_samples()[:5], MARKER_SIZE)
+
+
+def test_distance_inverts_the_model():
+    calibration = CameraCalibration("forward", 900.0, radial=0.05, offset_cm=4.0)
+    for distance, width, center_x, center_y, frame_width, frame_height in synthetic_samples(noise_px=0.0):
+        measured = calibration.distance(MARKER_SIZE, width, center_x, center_y, frame_width, frame_height)
+        assert measured == pytest.approx(distance, abs=1e-6)
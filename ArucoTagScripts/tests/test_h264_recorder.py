@@ -0,0 +1,60 @@
+import os
+
+from common.h264_recorder import _SegmentWriter, extract_clip, read_index
+
+SPS = b"\x00\x00\x00\x01\x67\x4d\x40\x28" + b"\x11" * 20
+PPS = b"\x00\x00\x00\x01\x68\xee\x3c\x80"
+IDR = b"\x00\x00\x00\x01\x65\x88" + b"\x22" * 300
+P_SLICE = b"\x00\x00\x00\x01\x41\x9a" + b"\x33" * 100
+
+
+def gop(frames=3):
+    """ Datagrams of one group of pictures the way the Tello sends them: parameter sets on their own """
+    return [SPS, PPS, IDR] + [P_SLICE] * frames
+
+
+def record(tmp_path, packets, segment_bytes=10 ** 9):
+    writer = _SegmentWriter(str(tmp_path), "f", segment_seconds=3600, segment_bytes=segment_bytes)
+    for i, packet in enumerate(packets):
+        writer.feed(packet, t=float(i))
+    writer.close()
+    return sorted(os.path.join(tmp_path, name) for name in os.listdir(tmp_path) if name.endswith(".h264"))
+
+
+def test_segment_starts_with_the_parameter_sets(tmp_path):
+    segments = record(tmp_path, [P_SLICE, P_SLICE] + gop())  # Joined in the middle of a group
+    assert len(segments) == 1
+    with open(segments[0], "rb") as video:
+        assert video.read() == SPS + PPS + IDR + P_SLICE * 3
+    entries = read_index(segments[0])
+    assert [(e.offset, e.keyframe) for e in entries] == [
+        (0, True), (len(SPS + PPS + IDR), False), (len(SPS + PPS + IDR + P_SLICE), False),
+        (len(SPS + PPS + IDR + P_SLICE * 2), False)]
+
+
+def test_rollover_keeps_the_parameter_sets_with_their_keyframe(tmp_path):
+    segments = record(tmp_path, gop() + gop(), segment_bytes=100)
+    assert len(segments) == 2
+    for path in segments:
+        with open(path, "rb") as video:
+            assert video.read() == SPS + PPS + IDR + P_SLICE * 3
+        assert read_index(path)[0].offset == 0
+
+
+def test_start_code_split_across_packets(tmp_path):
+    stream = b"".join(gop())
+    cut = len(SPS) + len(PPS) + 2  # Inside the start code of the IDR slice
+    segments = record(tmp_path, [stream[:cut], stream[cut:]])
+    with open(segments[0], "rb") as video:
+        assert video.read() == stream
+    assert [e.keyframe for e in read_index(segments[0])] == [True, False, False, False]
+
+
+def test_clip_starts_at_the_sps(tmp_path):
+    segments = record(tmp_path, gop() + gop())
+    clip = os.path.join(tmp_path, "clip.bin")
+    # Packets 6-8 are the parameter sets and the IDR of the second group, 9 its first P frame
+    skip = extract_clip(segments[0], 9.5, 20.0, clip)
+    with open(clip, "rb") as video:
+        assert video.read() == SPS + PPS + IDR + P_SLICE * 3
+    assert skip == 2
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+from common.energy import EnergyModel
+from common.mission import MissionError, Step, compile_mission, load_mission, merge_steps
+
+FLOOR_ROUTE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'missions', 'floor_route.json')
+
+
+@pytest.fixture
+def plan():
+    return compile_mission(load_mission(FLOOR_ROUTE), EnergyModel())
+
+
+def test_floor_route_commands(plan):
+    commands = [(step.command, step.value) for step in plan.steps if step.command != "checkpoint"]
+    assert commands == [
+        ("set_speed", 40), ("takeoff", 0),
+        ("move_forward", 200), ("verify", 0),
+        ("rotate_clockwise", 90), ("move_forward", 150), ("verify", 1), ("hover", 2),
+        ("rotate_counter_clockwise", 90), ("move_forward", 220), ("move_up", 50), ("verify", 2),
+        # The way home from the last station, back down to the takeoff height
+        ("rotate_counter_clockwise", 160), ("move_forward", 446), ("move_down", 50), ("land", 0),
+    ]
+
+
+def test_floor_route_checkpoints(plan):
+    checkpoints = [(index, step) for index, step in enumerate(plan.steps) if step.command == "checkpoint"]
+    assert [step.station for _, step in checkpoints] == [0, 1, 2]
+    for index, step in checkpoints:
+        # Before the first command of its leg, and never below the reserve
+        assert plan.steps[index + 1].station == step.station
+        assert step.value > 15
+
+
+def test_floor_route_returns(plan):
+    assert sorted(plan.returns) == [0, 1, 2]
+    for steps in plan.returns.values():
+        assert steps[-1].command == "land"
+    assert [step.command for step in plan.returns[0]] == ["rotate_counter_clockwise", "move_forward", "land"]
+    assert plan.returns[0][0].value == 180
+    assert plan.returns[0][1].value == 200
+
+
+def test_floor_route_header(plan):
+    assert plan.name == "floor_route"
+    assert plan.camera == "forward"
+    assert plan.fallback == "search"
+    assert plan.tag_sizes == {0: 20, 1: 20, 2: 15}
+    assert plan.warnings == []
+    assert plan.duration > 0 and plan.energy > 0
+
+
+def test_mission_errors_are_listed_together():
+    mission = load_mission(FLOOR_ROUTE)
+    mission["camera"] = "sideways"
+    mission["speed"] = 500
+    mission["stations"][1]["tag_size"] = 0
+    mission["stations"].append({"marker_id": 0, "x": 0, "y": 0})
+    with pytest.raises(MissionError) as error:
+        compile_mission(mission)
+    message = str(error.value)
+    assert "camera" in message and "speed" in message and "marker ID used twice" in message
+    assert "tag_size must be positive" in message
+
+
+def test_merge_steps():
+    steps = [Step("rotate_clockwise", 90, 0), Step("rotate_counter_clockwise", 30, 0),
+             Step("move_forward", 100, 0), Step("move_back", 40, 0), Step("move_forward", 480, 0)]
+    assert merge_steps(steps) == [Step("rotate_clockwise", 60, 0), Step("move_forward", 270, 0),
+                                  Step("move_forward", 270, 0)]
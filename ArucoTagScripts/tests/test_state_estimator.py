@@ -0,0 +1,93 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from common.state_estimator import MarkerMap, StateEstimator
+
+RATE = 50.0  # state packets per second
+
+
+def packet(vgx=0.0, vgy=0.0, yaw=0.0, tof=80.0):
+    """ State packet of level flight at constant velocity (vg* in dm/s, gravity only on agz) """
+    return {'agx': 0.0, 'agy': 0.0, 'agz': -1000.0, 'vgx': vgx, 'vgy': vgy, 'vgz': 0.0,
+            'roll': 0.0, 'pitch': 0.0, 'yaw': yaw, 'tof': tof, 'h': tof}
+
+
+def fly(estimator, seconds, start=0.0, **state):
+    t = start
+    for step in range(int(seconds * RATE)):
+        t = start + step / RATE
+        estimator.process_state(packet(**state), t)
+    return t
+
+
+def test_predict_integrates_the_velocity():
+    estimator = StateEstimator()
+    fly(estimator, 2.0, vgx=10.0)  # 100 cm/s forward
+    pose = estimator.pose()
+    assert pose.vx == pytest.approx(100.0, abs=5.0)
+    assert pose.x == pytest.approx(199.0, abs=10.0)
+    assert abs(pose.y) < 5.0
+
+
+def test_velocity_is_rotated_by_the_yaw():
+    estimator = StateEstimator()
+    fly(estimator, 2.0, vgx=10.0, yaw=90.0)  # Forward in the body frame is right in the world frame
+    pose = estimator.pose()
+    assert pose.yaw == pytest.approx(90.0, abs=1.0)
+    assert pose.vy == pytest.approx(100.0, abs=5.0)
+    assert abs(pose.vx) < 5.0
+
+
+def test_height_update_follows_the_tof():
+    estimator = StateEstimator()
+    fly(estimator, 3.0, tof=120.0)
+    assert estimator.pose().height == pytest.approx(120.0, abs=2.0)
+
+
+def test_position_update_pulls_the_estimate_and_shrinks_the_covariance():
+    estimator = StateEstimator()
+    t = fly(estimator, 1.0)
+    variance = estimator.P[0, 0]
+    pose = estimator.add_position(t, (50.0, 0.0, -80.0), noise=5.0)
+    assert 0.0 < pose.x < 50.0
+    assert estimator.P[0, 0] < variance
+
+
+def test_late_measurement_is_replayed():
+    in_order, late = StateEstimator(), StateEstimator()
+    for step in range(int(RATE)):
+        t = step / RATE
+        for estimator in (in_order, late):
+            estimator.process_state(packet(vgx=5.0), t)
+        if step == 25:
+            in_order.add_position(t + 0.001, (30.0, 0.0, -80.0))
+    late.add_position(25 / RATE + 0.001, (30.0, 0.0, -80.0))  # Arrives half a second after capture
+
+    assert late.delayed_updates == 1
+    assert np.allclose(late.x, in_order.x)
+    assert np.allclose(late.P, in_order.P)
+
+
+def test_marker_fix_corrects_the_position():
+    estimator = StateEstimator()
+    t = fly(estimator, 1.0)
+    # A marker known 100 cm ahead on the floor, seen 90 cm ahead: the drone is 10 cm further forward
+    pose = estimator.add_marker(t, (100.0, 0.0, 0.0), (90.0, 0.0, 80.0), noise=2.0)
+    assert 0.0 < pose.x < 10.0
+    for _ in range(20):
+        pose = estimator.add_marker(t, (100.0, 0.0, 0.0), (90.0, 0.0, 80.0), noise=2.0)
+    assert pose.x == pytest.approx(10.0, abs=1.0)
+    assert pose.height == pytest.approx(80.0, abs=2.0)
+
+
+def test_marker_map_places_then_fixes():
+    estimator = StateEstimator()
+    t = fly(estimator, 1.0)
+    marker_map = MarkerMap(estimator)
+    assert marker_map.observe(3, t, 100.0, 20.0, 80.0) is None  # First sighting places the marker
+    assert marker_map.positions[3] == pytest.approx((100.0, 20.0, 0.0), abs=3.0)
+    assert 0.0 < marker_map.observe(3, t, 95.0, 20.0, 80.0, noise=2.0).x <= 5.0
+    assert marker_map.observe(3, t, 400.0, 20.0, 80.0) is None  # Far from where the pose expects it
+    assert (marker_map.fixes, marker_map.rejected) == (1, 1)
+    assert marker_map.observe(4, t, 100.0, 0.0, None) is None  # No height, no fix
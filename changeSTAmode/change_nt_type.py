@@ -1,8 +1,14 @@
 from djitellopy import Tello
+import os
+import sys
 
-# Replace with your Wi-Fi network SSID and password
-wifi_ssid = "TP_LinkF4D0"  # Your router's SSID (network name)
-wifi_password = "05229611"  # Your router's password
+# Your router's SSID (network name) and password, from the command line or the environment.
+# For more than one drone use provision_fleet.py, it switches them all in parallel.
+#     python change_nt_type.py <ssid> <password>
+wifi_ssid = sys.argv[1] if len(sys.argv) > 2 else os.environ.get("TELLO_WIFI_SSID")
+wifi_password = sys.argv[2] if len(sys.argv) > 2 else os.environ.get("TELLO_WIFI_PASSWORD")
+if not wifi_ssid or not wifi_password:
+    sys.exit("Usage: python change_nt_type.py <ssid> <password> (or set TELLO_WIFI_SSID and TELLO_WIFI_PASSWORD)")
 
 # Initialize Tello
 tello = Tello()
@@ -10,10 +16,6 @@ tello = Tello()
 # Connect to the Tello drone
 tello.connect()
 
-
-tello.takeoff()
-tello.land()
-
 # Send the 'ap' command to switch the drone to STA mode
 tello.send_control_command(f"ap {wifi_ssid} {wifi_password}")
 
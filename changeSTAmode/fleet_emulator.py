@@ -0,0 +1,104 @@
+import argparse
+import socket
+import threading
+import time
+
+# Local UDP stand-ins for Tello drones, to test provision_fleet.py without hardware.
+#
+# Every emulated drone answers SDK commands on its own loopback address as if it were the
+# 192.168.10.1 of its access point. After `ap ssid pass` it goes quiet for reboot_seconds and
+# then answers on its station address in a stand-in router subnet (127.0.1.0/24 by default,
+# all of 127.0.0.0/8 is loopback on Linux).
+#     python fleet_emulator.py --count 8
+
+COMMAND_PORT = 8889
+
+
+class EmulatedDrone(object):
+    """ One drone: AP mode on ap_ip until it gets its credentials, station mode on sta_ip afterwards """
+
+    def __init__(self, serial, ap_ip, sta_ip, port=COMMAND_PORT, reboot_seconds=3.0, reject_ap=False):
+        self.serial = serial
+        self.ap_ip = ap_ip
+        self.sta_ip = sta_ip
+        self.port = port
+        self.reboot_seconds = reboot_seconds
+        self.reject_ap = reject_ap  # Answer the ap command with an error, for testing failures
+        self.ssid = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join(timeout=2)
+
+    def _serve(self, ip, station_mode):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((ip, self.port))
+        sock.settimeout(0.2)
+        try:
+            while self.running:
+                try:
+                    data, sender = sock.recvfrom(1024)
+                except socket.timeout:
+                    continue
+                command = data.decode("utf-8", "replace").strip()
+                if command == "command":
+                    reply = "ok"
+                elif command == "sn?":
+                    reply = self.serial
+                elif command == "battery?":
+                    reply = "87"
+                elif command.startswith("ap ") and not station_mode:
+                    parts = command.split()
+                    if self.reject_ap or len(parts) != 3:
+                        reply = "error"
+                    else:
+                        self.ssid = parts[1]
+                        sock.sendto(b"ok", sender)
+                        return True  # Reboot into station mode
+                else:
+                    reply = "error"
+                sock.sendto(reply.encode("utf-8"), sender)
+        finally:
+            sock.close()
+        return False
+
+    def _run(self):
+        if self._serve(self.ap_ip, False):
+            time.sleep(self.reboot_seconds)
+            if self.running:
+                self._serve(self.sta_ip, True)
+
+
+def start_fleet(count, reboot_seconds=3.0, ap_prefix="127.0.2.", sta_prefix="127.0.1.", port=COMMAND_PORT,
+                first_host=10):
+    """ count emulated drones, AP addresses ap_prefix + 1.., station addresses spread over the subnet """
+    drones = []
+    for i in range(count):
+        drones.append(EmulatedDrone(f"0TQZEMU{i:05d}", f"{ap_prefix}{i + 1}", f"{sta_prefix}{first_host + 7 * i}",
+                                    port, reboot_seconds * (1 + 0.2 * (i % 3))).start())
+    return drones
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Emulate a fleet of Tello drones on loopback addresses")
+    parser.add_argument("--count", type=int, default=4)
+    parser.add_argument("--reboot-seconds", type=float, default=3.0)
+    parser.add_argument("--port", type=int, default=COMMAND_PORT)
+    args = parser.parse_args()
+
+    fleet = start_fleet(args.count, args.reboot_seconds, port=args.port)
+    print("Emulated drones, provision them with:")
+    print("    python provision_fleet.py --network 127.0.1.0/24 --ssid test --password secret "
+          + " ".join(f"--drone 127.0.0.1@{drone.ap_ip}:{args.port}" for drone in fleet))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for drone in fleet:
+            drone.stop()
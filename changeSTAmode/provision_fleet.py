@@ -0,0 +1,201 @@
+import argparse
+import ipaddress
+import json
+import os
+import socket
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Moves a whole fleet of Tello EDU drones to station (router) mode at once and finds them again.
+#
+# Every drone in AP mode is 192.168.10.1 on its own Wi-Fi, so the computer needs one Wi-Fi
+# adapter per drone joined to that drone's network. Each drone is given as --drone ADAPTER,
+# where ADAPTER is the adapter's local IP or its interface name (Linux, needs root for
+# SO_BINDTODEVICE). All drones get `command`, `sn?` and `ap ssid pass` in parallel, then one
+# scanner sweeps the router subnet with `command` and `sn?` until every serial number has come
+# back. The serial -> IP map is written to fleet.json.
+#
+# The Wi-Fi credentials come from --ssid/--password or TELLO_WIFI_SSID/TELLO_WIFI_PASSWORD.
+# Try it against local stand-ins (see fleet_emulator.py):
+#     python provision_fleet.py --emulate 8
+
+COMMAND_PORT = 8889
+AP_ADDRESS = "192.168.10.1"
+
+Drone = namedtuple("Drone", ["adapter", "address"])
+Result = namedtuple("Result", ["drone", "serial", "ip", "ap_seconds", "found_seconds", "error"])
+
+
+class ProvisionError(Exception):
+    """ A drone did not accept the switch to station mode """
+
+
+def parse_drone(text):
+    """ ADAPTER[@IP[:PORT]], e.g. wlan1, 192.168.10.2 or 127.0.0.1@127.0.2.1:8889 """
+    adapter, _, address = text.partition("@")
+    host, _, port = (address or AP_ADDRESS).partition(":")
+    return Drone(adapter, (host, int(port or COMMAND_PORT)))
+
+
+def _open_socket(adapter, timeout):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        ipaddress.ip_address(adapter)
+        sock.bind((adapter, 0))
+    except ValueError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, adapter.encode("utf-8"))
+    sock.settimeout(timeout)
+    return sock
+
+
+def query(sock, address, command, retries=3):
+    """ Send an SDK command and return the answer from that address, None after all retries """
+    for _ in range(retries):
+        sock.sendto(command.encode("utf-8"), address)
+        deadline = time.monotonic() + sock.gettimeout()
+        while time.monotonic() < deadline:
+            try:
+                data, sender = sock.recvfrom(1024)
+            except socket.timeout:
+                break
+            if sender[0] == address[0]:
+                return data.decode("utf-8", "replace").strip()
+    return None
+
+
+def switch_to_station(drone, ssid, password, timeout=1.0, retries=3):
+    """ SDK mode, serial number, then the router credentials. Returns the serial number. """
+    sock = _open_socket(drone.adapter, timeout)
+    try:
+        if query(sock, drone.address, "command", retries) != "ok":
+            raise ProvisionError(f"{drone.adapter}: no answer to command from {drone.address[0]}")
+        serial = query(sock, drone.address, "sn?", retries)
+        if not serial:
+            raise ProvisionError(f"{drone.adapter}: no serial number")
+        # The drone reboots right after its ok, a lost answer is not retried so it is never sent twice
+        answer = query(sock, drone.address, f"ap {ssid} {password}", 1)
+        if answer not in ("ok", None):
+            raise ProvisionError(f"{drone.adapter}: drone {serial} answered '{answer}' to ap")
+        return serial
+    finally:
+        sock.close()
+
+
+def scan_subnet(network, wanted, port=COMMAND_PORT, deadline=60.0, interval=1.0, on_found=None):
+    """ Sweep network until every serial in wanted answered. Returns serial -> IP of all drones found. """
+    hosts = [str(host) for host in ipaddress.ip_network(network, strict=False).hosts()]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.05)
+    found = {}
+    known_ips = set()
+    end = time.monotonic() + deadline
+    try:
+        while time.monotonic() < end and not wanted <= set(found):
+            # One command to every host that is not known yet, then collect the answers
+            for host in hosts:
+                if host not in known_ips:
+                    try:
+                        sock.sendto(b"command", (host, port))
+                    except OSError:
+                        pass  # Unreachable hosts are simply skipped
+            sweep_end = time.monotonic() + interval
+            while time.monotonic() < sweep_end:
+                try:
+                    data, sender = sock.recvfrom(1024)
+                except (socket.timeout, ConnectionResetError):
+                    continue
+                answer = data.decode("utf-8", "replace").strip()
+                if answer == "ok" and sender[0] not in known_ips:
+                    sock.sendto(b"sn?", (sender[0], port))
+                elif answer not in ("ok", "error") and sender[0] not in known_ips:
+                    known_ips.add(sender[0])
+                    found[answer] = sender[0]
+                    if on_found is not None:
+                        on_found(answer, sender[0])
+    finally:
+        sock.close()
+    return found
+
+
+def provision(drones, ssid, password, network, port=COMMAND_PORT, timeout=90.0):
+    start = time.monotonic()
+    serials = {}
+    ap_times = {}
+    errors = {}
+
+    # Phase 1: every drone gets its credentials at the same time, one thread per adapter
+    with ThreadPoolExecutor(max_workers=len(drones)) as pool:
+        jobs = {pool.submit(switch_to_station, drone, ssid, password): drone for drone in drones}
+        for job in as_completed(jobs):
+            drone = jobs[job]
+            try:
+                serials[drone] = job.result()
+                ap_times[drone] = time.monotonic() - start
+                print(f"{drone.adapter}: drone {serials[drone]} is joining {ssid}")
+            except (ProvisionError, OSError) as error:
+                errors[drone] = str(error)
+                print(f"{drone.adapter}: {error}")
+
+    # Phase 2: wait for them to come up on the router and verify each by its serial number
+    found_times = {}
+
+    def on_found(serial, ip):
+        found_times[serial] = time.monotonic() - start
+        print(f"Drone {serial} answers at {ip} after {found_times[serial]:.1f} s")
+
+    found = scan_subnet(network, set(serials.values()), port, timeout, on_found=on_found) if serials else {}
+
+    results = []
+    for drone in drones:
+        serial = serials.get(drone)
+        ip = found.get(serial)
+        error = errors.get(drone) or (None if ip else "did not appear on the router subnet")
+        results.append(Result(drone, serial, ip, ap_times.get(drone), found_times.get(serial), error))
+    return results, time.monotonic() - start
+
+
+def save_fleet(results, path="fleet.json"):
+    """ Add the serial -> IP map of the provisioned drones to the fleet file """
+    fleet = {}
+    if os.path.exists(path):
+        with open(path) as fleet_file:
+            fleet = json.load(fleet_file)
+    fleet.update({result.serial: result.ip for result in results if result.ip})
+    with open(path, "w") as fleet_file:
+        json.dump(fleet, fleet_file, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Switch many Tello drones to station mode in parallel")
+    parser.add_argument("--drone", action="append", default=[], help="ADAPTER[@IP[:PORT]], once per drone")
+    parser.add_argument("--ssid", default=os.environ.get("TELLO_WIFI_SSID"))
+    parser.add_argument("--password", default=os.environ.get("TELLO_WIFI_PASSWORD"))
+    parser.add_argument("--network", default="192.168.0.0/24", help="router subnet the drones join")
+    parser.add_argument("--port", type=int, default=COMMAND_PORT)
+    parser.add_argument("--timeout", type=float, default=90.0, help="s to wait for the drones on the router")
+    parser.add_argument("--fleet", default="fleet.json")
+    parser.add_argument("--emulate", type=int, default=0, help="provision this many local stand-in drones")
+    args = parser.parse_args()
+
+    fleet = []
+    if args.emulate:
+        from fleet_emulator import start_fleet
+        fleet = start_fleet(args.emulate, port=args.port)
+        args.drone = [f"127.0.0.1@{drone.ap_ip}:{args.port}" for drone in fleet]
+        args.network = "127.0.1.0/24"
+        args.ssid = args.ssid or "emulated"
+        args.password = args.password or "emulated"
+    if not args.drone or not args.ssid or not args.password:
+        parser.error("give at least one --drone and the Wi-Fi credentials")
+
+    results, seconds = provision([parse_drone(text) for text in args.drone], args.ssid, args.password,
+                                 args.network, args.port, args.timeout)
+    save_fleet(results, args.fleet)
+    ok = [result for result in results if result.ip]
+    for result in results:
+        name = f"{result.drone.adapter}@{result.drone.address[0]}"
+        print(f"  {name:24s} {result.serial or '-':16s} {result.ip or '-':15s} {result.error or 'ok'}")
+    print(f"Provisioned {len(ok)}/{len(results)} drones in {seconds:.1f} s, serial -> IP map in {args.fleet}")
+    for drone in fleet:
+        drone.stop()
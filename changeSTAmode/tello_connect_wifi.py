@@ -1,4 +1,6 @@
+import os
 import socket
+import sys
 import time
 
 def connect_tello_to_router(router_ssid, router_password):
@@ -24,7 +26,7 @@ def connect_tello_to_router(router_ssid, router_password):
             return None
 
     # Set socket timeout for waiting on a response
-    sock.settimeout(5)
+    sock.settimeout(2)
 
     # 1. Send 'command' to initiate SDK mode
     if send_command('command\n') != 'ok':
@@ -40,5 +42,9 @@ def connect_tello_to_router(router_ssid, router_password):
     # Close the socket
     sock.close()
 
-# Example usage
-connect_tello_to_router('TP-Link_F4D0', '05229611')
\ No newline at end of file
+# Router SSID and password, from the command line or the environment
+router_ssid = sys.argv[1] if len(sys.argv) > 2 else os.environ.get("TELLO_WIFI_SSID")
+router_password = sys.argv[2] if len(sys.argv) > 2 else os.environ.get("TELLO_WIFI_PASSWORD")
+if not router_ssid or not router_password:
+    sys.exit("Usage: python tello_connect_wifi.py <ssid> <password> (or set TELLO_WIFI_SSID and TELLO_WIFI_PASSWORD)")
+connect_tello_to_router(router_ssid, router_password)
\ No newline at end of file
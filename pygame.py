@@ -3,10 +3,19 @@ import cv2
 import pygame
 import numpy as np
 import time
+import os
+import sys
+
+# Make the shared helpers in ArucoTagScripts/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ArucoTagScripts'))
+from common.h264_recorder import H264Recorder
+from common.rc_transmitter import RcTransmitter
 
 # Speed of the drone
 S = 60
 FPS = 120  # Frames per second of the pygame window display
+RC_RATE = 30  # Most rc packets per second, only sent when a velocity changes
+RC_KEEPALIVE = 5  # rc packets per second while nothing changes
 
 class FrontEnd(object):
     """ Maintains the Tello display and moves it through the keyboard keys.
@@ -17,7 +26,7 @@ class FrontEnd(object):
             - Arrow keys: Forward, backward, left and right.
             - A and D: Counter clockwise and clockwise rotations (yaw)
             - W and S: Up and down.
-            - R: Start recording video
+            - R: Start recording video (raw H.264 into recordings/, see common/h264_recorder.py)
             - F: Stop recording video
     """
 
@@ -38,22 +47,25 @@ class FrontEnd(object):
         self.up_down_velocity = 0
         self.yaw_velocity = 0
         self.speed = 10
-        self.send_rc_control = False
+
+        # Sends the velocities from its own thread when they change, see common/rc_transmitter.py
+        self.rc = RcTransmitter(self.tello, max_rate=RC_RATE, keepalive=RC_KEEPALIVE)
 
         # Set downward camera mode
         self.downward_camera = True  # We will switch to the downward camera
 
-        # Create update timer
-        pygame.time.set_timer(pygame.USEREVENT + 1, 1000 // FPS)
-
         # Video recording attributes
         self.recording = False  # Flag to indicate recording status
-        self.video_writer = None  # OpenCV VideoWriter object for recording
+        self.recorder = None  # Tee process that writes the raw H.264 stream to disk
 
     def run(self):
         self.tello.connect()
         self.tello.set_speed(self.speed)
 
+        # Route the video through the recorder tee before the stream starts
+        self.recorder = H264Recorder()
+        self.recorder.setup_drone(self.tello)
+
         # In case streaming is on. This happens when we quit this program without the escape key.
         self.tello.streamoff()
         self.tello.streamon()
@@ -63,21 +75,22 @@ class FrontEnd(object):
             self.tello.set_video_direction(Tello.CAMERA_DOWNWARD)
 
         frame_read = self.tello.get_frame_read()
+        self.rc.start()
 
         should_stop = False
         while not should_stop:
             for event in pygame.event.get():
-                if event.type == pygame.USEREVENT + 1:
-                    self.update()
-                elif event.type == pygame.QUIT:
+                if event.type == pygame.QUIT:
                     should_stop = True
                 elif event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
                         should_stop = True
                     else:
                         self.keydown(event.key)
+                        self.update()
                 elif event.type == pygame.KEYUP:
                     self.keyup(event.key)
+                    self.update()
 
             if frame_read.stopped:
                 break
@@ -92,10 +105,6 @@ class FrontEnd(object):
             frame = np.rot90(frame)
             frame = np.flipud(frame)
 
-            # If recording is on, write the frame to the video file
-            if self.recording and self.video_writer is not None:
-                self.video_writer.write(cv2.cvtColor(frame_read.frame, cv2.COLOR_BGR2RGB))  # Write the original frame
-
             frame = pygame.surfarray.make_surface(frame)
             self.screen.blit(frame, (0, 0))
             pygame.display.update()
@@ -105,6 +114,9 @@ class FrontEnd(object):
         # Call it always before finishing. To deallocate resources.
         if self.recording:
             self.stop_recording()  # Stop recording if still on when exiting
+        self.recorder.close()
+        self.rc.stop()
+        print(self.rc.report())
 
         self.tello.end()
 
@@ -143,33 +155,29 @@ class FrontEnd(object):
             self.yaw_velocity = 0
         elif key == pygame.K_t:  # Takeoff
             self.tello.takeoff()
-            self.send_rc_control = True
+            self.rc.enable(True)
         elif key == pygame.K_l:  # Land
+            self.rc.enable(False)
             self.tello.land()
-            self.send_rc_control = False
 
     def update(self):
-        """ Send velocities to Tello """
-        if self.send_rc_control:
-            self.tello.send_rc_control(self.left_right_velocity, self.for_back_velocity, self.up_down_velocity, self.yaw_velocity)
+        """ Hand the velocities to the rc transmitter, it sends them when they changed """
+        self.rc.set(self.left_right_velocity, self.for_back_velocity, self.up_down_velocity, self.yaw_velocity)
 
     def start_recording(self):
         """ Start recording the video stream """
         if not self.recording:
             print("Recording started")
             self.recording = True
-            # Initialize the VideoWriter with codec, frame rate, and size
-            self.video_writer = cv2.VideoWriter('drone_recording.avi', cv2.VideoWriter_fourcc(*'XVID'), FPS, (960, 720))
+            # The tee starts a new segment at the next keyframe
+            self.recorder.start()
 
     def stop_recording(self):
         """ Stop recording the video stream """
         if self.recording:
             print("Recording stopped")
             self.recording = False
-            # Release the video writer
-            if self.video_writer is not None:
-                self.video_writer.release()
-                self.video_writer = None
+            self.recorder.pause()
 
 
 def main():